@@ -0,0 +1,251 @@
+"""
+Archive synthetic submissions end to end through both archive paths, streaming and
+local copy, against local S3 (moto) and FTP (pyftpdlib) stand-ins, and compare the
+results with saved baselines.
+
+    python -m benchmarks.bench_archiver                      # run and compare with baselines
+    python -m benchmarks.bench_archiver --save               # run and save as the new baselines
+    python -m benchmarks.bench_archiver --scenario small --path stream --scale 4
+
+Each run archives in a fresh child process so CPU time and peak RSS are those of the
+archiver alone, not of the S3 and FTP stand-ins in this process. Reported per run:
+MB/s and files/s (of uncompressed input), CPU seconds per GB of input and MB of input
+per CPU second, and peak RSS. Each is shown next to its baseline, a run is a regression
+when any of them is worse than its baseline by more than --tolerance, the exit code is
+then 1.
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+
+from benchmarks.services import start_s3, start_ftp, configure_env, s3_client
+from benchmarks.synthetic import fastq
+
+BUCKET = 'org-hca-data-archive-upload-bench'
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+KB = 1024
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# name: (number of files, size of each, share of files already gzipped)
+SCENARIOS = {
+    'small': (500, 16 * KB, 0),
+    'large': (2, 64 * MB, 0),
+    'mixed': (20, 4 * MB, 0.5),
+}
+PATHS = ('stream', 'localcopy')
+# higher is better for these, lower for the others
+HIGHER_IS_BETTER = ('mb_per_s', 'files_per_s', 'mb_per_cpu_s')
+METRICS = ('mb_per_s', 'files_per_s', 'cpu_s_per_gb', 'mb_per_cpu_s', 'peak_rss_mb')
+
+
+@dataclass
+class Result:
+    scenario: str
+    path: str
+    files: int
+    failed: int
+    bytes: int
+    seconds: float
+    mb_per_s: float
+    files_per_s: float
+    cpu_s_per_gb: float
+    peak_rss_mb: float
+    # not in baselines saved before it was measured
+    mb_per_cpu_s: float = 0.0
+
+    def __str__(self):
+        return (f'{self.scenario:<6} {self.path:<9} {self.files - self.failed:>5}/{self.files} files '
+                f'{self.seconds:8.2f}s {self.mb_per_s:8.2f} MB/s {self.files_per_s:8.1f} files/s '
+                f'{self.cpu_s_per_gb:8.1f} CPU s/GB {self.mb_per_cpu_s:7.2f} MB/CPU s {self.peak_rss_mb:7.1f} MB RSS')
+
+
+def populate(client, scenario, scale):
+    """
+    upload a synthetic submission to S3, returns its uuid and [(file name, key)].
+    """
+    count, size, gzipped = SCENARIOS[scenario]
+    if size >= MB:
+        size = int(size * scale)
+    else:
+        count = max(1, int(count * scale))
+    sub_uuid = str(uuid.uuid4())
+    body = fastq(size)
+    compressed = gzip.compress(body)
+    files = []
+    for n in range(count):
+        name = f'reads_{n}.fastq.gz' if n < count * gzipped else f'reads_{n}.fastq'
+        files.append((name, f'{sub_uuid}/{name}'))
+
+    def put(file):
+        name, key = file
+        client.put_object(Bucket=BUCKET, Key=key, Body=compressed if name.endswith('.gz') else body)
+
+    with ThreadPoolExecutor(16) as executor:
+        list(executor.map(put, files))
+    return sub_uuid, files, sum(len(compressed) if name.endswith('.gz') else len(body) for name, _ in files)
+
+
+def archive(path, sub_uuid, files):
+    """
+    runs in the child process, with the environment already pointing at the stand-ins.
+    """
+    from data.archiver.archiver import Archiver
+    from data.archiver.aws_s3_client import AwsS3
+    from data.archiver.dataclass import DataArchiverResult, FileResult
+
+    res = DataArchiverResult(sub_uuid, files=[FileResult(str(n), name, f's3://{BUCKET}/{key}')
+                                              for n, (name, key) in enumerate(files)])
+    archiver = Archiver(None, AwsS3())
+    start = time.perf_counter()
+    if path == 'stream':
+        archiver.archive_files_via_streaming(res)
+    else:
+        archiver.archive_files_via_localcopy(res)
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'seconds': elapsed,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'peak_rss_mb': peak_rss() / MB,
+        'failed': sum(not file.success for file in res.files),
+    }
+
+
+def peak_rss():
+    """
+    peak resident memory of this process in bytes. ru_maxrss is inherited through fork and
+    would report the parent's peak when it is higher, VmHWM is not.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * KB
+    except OSError:
+        pass
+    # kilobytes on linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * KB
+
+
+def run(scenario, path, client, env, scale):
+    sub_uuid, files, total = populate(client, scenario, scale)
+    with tempfile.TemporaryDirectory() as work_dir:
+        job = os.path.join(work_dir, 'job.json')
+        with open(job, 'w') as f:
+            json.dump({'path': path, 'sub_uuid': sub_uuid, 'files': files}, f)
+        # the local copy path downloads into the working directory
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_archiver', '--child', job],
+                             env=dict(env, ARCHIVER_DATA_DIR=work_dir), cwd=work_dir,
+                             stdout=subprocess.PIPE, check=True)
+    child = json.loads(out.stdout.decode().strip().splitlines()[-1])
+    return Result(scenario, path, len(files), child['failed'], total, child['seconds'],
+                  mb_per_s=total / MB / child['seconds'],
+                  files_per_s=len(files) / child['seconds'],
+                  cpu_s_per_gb=child['cpu_seconds'] / (total / GB),
+                  peak_rss_mb=child['peak_rss_mb'],
+                  mb_per_cpu_s=total / MB / child['cpu_seconds'] if child['cpu_seconds'] else 0.0)
+
+
+def changes(result: Result, baseline: dict):
+    """
+    each metric of the baseline next to the result's.
+    """
+    return ', '.join(f'{metric} {baseline[metric]:.2f} -> {getattr(result, metric):.2f}'
+                     for metric in METRICS if baseline.get(metric))
+
+
+def compare(result: Result, baseline: dict, tolerance):
+    """
+    returns the metrics of the result worse than the baseline by more than tolerance.
+    """
+    regressions = []
+    for metric in METRICS:
+        if metric not in baseline:
+            continue
+        old, new = baseline[metric], getattr(result, metric)
+        change = (new - old) / old if old else 0
+        if metric in HIGHER_IS_BETTER:
+            change = -change
+        if change > tolerance:
+            regressions.append(f'{metric} {old:.2f} -> {new:.2f} ({change:+.0%} worse)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='run only these scenarios, all by default')
+    parser.add_argument('--path', choices=PATHS, action='append', help='run only these paths, both by default')
+    parser.add_argument('--scale', type=float, default=1, help='multiply the number of small files and '
+                                                                'the size of large ones')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baselines')
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.child) as f:
+            job = json.load(f)
+        print(json.dumps(archive(job['path'], job['sub_uuid'], job['files'])))
+        return
+
+    # relative to where it was started, not to wherever the FTP server leaves the working directory
+    args.baselines = os.path.abspath(args.baselines)
+    s3_server, endpoint = start_s3()
+    ftp_root = tempfile.mkdtemp()
+    ftp_server, ftp_address = start_ftp(ftp_root)
+    configure_env(endpoint, ftp_address, ftp_root)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.getenv('PYTHONPATH')])))
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    regressed = False
+    try:
+        client = s3_client(endpoint)
+        client.create_bucket(Bucket=BUCKET)
+        for scenario in args.scenario or SCENARIOS:
+            for path in args.path or PATHS:
+                result = run(scenario, path, client, env, args.scale)
+                # the FTP server changes this process' working directory while serving CWD,
+                # leave the uploads before removing them
+                os.chdir(ftp_root)
+                shutil.rmtree(os.path.join(ftp_root, 'bench'), ignore_errors=True)
+                print(result)
+                key = f'{scenario}/{path}' if args.scale == 1 else f'{scenario}/{path}@{args.scale:g}'
+                if args.save:
+                    baselines[key] = asdict(result)
+                elif key in baselines:
+                    print(f'    baseline: {changes(result, baselines[key])}')
+                    for regression in compare(result, baselines[key], args.tolerance):
+                        regressed = True
+                        print(f'    regression: {regression}')
+    finally:
+        ftp_server.close_all()
+        s3_server.stop()
+        shutil.rmtree(ftp_root, ignore_errors=True)
+
+    if args.save:
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Baselines saved to {args.baselines}')
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare the per-block gzip compression previously used by the streaming path
+with the single stream GzipCompressor and the parallel chunked compressor on synthetic FASTQ.
+
+    python -m benchmarks.bench_compression --size 64 --level 6 --workers 4
+"""
+import argparse
+import gzip
+import hashlib
+import time
+
+from data.archiver.compression import GzipCompressor, ParallelGzipCompressor
+from benchmarks.synthetic import fastq
+
+MB = 1024 * 1024
+
+
+def per_block(data, block_size, level):
+    hash_md5 = hashlib.md5()
+    out = 0
+    for i in range(0, len(data), block_size):
+        cbuf = gzip.compress(data[i:i + block_size], compresslevel=level)
+        hash_md5.update(cbuf)
+        out += len(cbuf)
+    return out
+
+
+def single_stream(data, block_size, level, compressor=None):
+    hash_md5 = hashlib.md5()
+    compressor = compressor or GzipCompressor(level)
+    out = 0
+    for i in range(0, len(data), block_size):
+        cbuf = compressor.compress(data[i:i + block_size])
+        hash_md5.update(cbuf)
+        out += len(cbuf)
+    cbuf = compressor.flush()
+    hash_md5.update(cbuf)
+    return out + len(cbuf)
+
+
+def parallel(workers):
+    def fn(data, block_size, level):
+        return single_stream(data, block_size, level, ParallelGzipCompressor(level, workers))
+    return fn
+
+
+def run(name, fn, data, block_size, level):
+    start = time.perf_counter()
+    out = fn(data, block_size, level)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} block={block_size:>8} out={out:>12} ratio={len(data) / out:6.2f} '
+          f'{len(data) / MB / elapsed:8.1f} MB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64, help='input size in MB')
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    data = fastq(args.size * MB)
+    print(f'input {len(data)} bytes of synthetic FASTQ, level {args.level}')
+    run('gzip.compress per block', per_block, data, 8192, args.level)
+    for block_size in (8192, MB):
+        run('GzipCompressor', single_stream, data, block_size, args.level)
+    run(f'ParallelGzipCompressor x{args.workers}', parallel(args.workers), data, MB, args.level)
+
+
+if __name__ == '__main__':
+    main()
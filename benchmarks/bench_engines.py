@@ -0,0 +1,74 @@
+"""
+Compare the thread pool and asyncio streaming engines on a submission of many small
+files, against local S3 (moto) and FTP (pyftpdlib) stand-ins.
+
+    python -m benchmarks.bench_engines --files 5000 --size 16
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.services import start_s3, start_ftp, configure_env, s3_client
+from benchmarks.synthetic import fastq
+
+BUCKET = 'org-hca-data-archive-upload-bench'
+KB = 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=16, help='file size in KB')
+    args = parser.parse_args()
+
+    s3_server, endpoint = start_s3()
+    ftp_root = tempfile.mkdtemp()
+    data_dir = tempfile.mkdtemp()
+    ftp_server, ftp_address = start_ftp(ftp_root)
+    configure_env(endpoint, ftp_address, data_dir)
+
+    from data.archiver.async_stream import AsyncS3FTPStreamer
+    from data.archiver.dataclass import DataArchiverResult, FileResult
+    from data.archiver.ftp_index import remote_index
+    from data.archiver.ftp_pool import ftp_pool
+    from data.archiver.stream import S3FTPStreamer
+
+    try:
+        sub_uuid = str(uuid.uuid4())
+        client = s3_client(endpoint)
+        client.create_bucket(Bucket=BUCKET)
+        body = fastq(args.size * KB)
+        keys = [f'{sub_uuid}/reads_{n}.fastq' for n in range(args.files)]
+        with ThreadPoolExecutor(32) as executor:
+            list(executor.map(lambda key: client.put_object(Bucket=BUCKET, Key=key, Body=body), keys))
+        print(f'{args.files} files of {len(body)} bytes')
+
+        def submission():
+            return DataArchiverResult(sub_uuid, files=[FileResult(str(n), os.path.basename(key), f's3://{BUCKET}/{key}')
+                                                       for n, key in enumerate(keys)])
+
+        for name, engine in (('threads', S3FTPStreamer), ('asyncio', AsyncS3FTPStreamer)):
+            shutil.rmtree(os.path.join(ftp_root, 'bench'), ignore_errors=True)
+            remote_index.clear()
+            ftp_pool.close()
+            res = submission()
+            start = time.perf_counter()
+            engine().start(res)
+            elapsed = time.perf_counter() - start
+            ok = sum(f.success for f in res.files)
+            print(f'{name:<8} {ok}/{args.files} files in {elapsed:7.2f}s {ok / elapsed:8.1f} files/s '
+                  f'{ok * len(body) / (1024 * 1024) / elapsed:6.2f} MB/s')
+    finally:
+        ftp_pool.close()
+        ftp_server.close_all()
+        s3_server.stop()
+        shutil.rmtree(ftp_root, ignore_errors=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
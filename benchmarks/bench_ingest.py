@@ -0,0 +1,52 @@
+"""
+Fetch the sequence files of a large submission from a local mock of the Ingest API,
+following next links page by page (as before) versus larger pages fetched concurrently.
+
+    python -m benchmarks.bench_ingest --files 50000 --latency 20
+"""
+import argparse
+import os
+import time
+import tracemalloc
+import uuid
+
+from benchmarks.mock_ingest import MockIngest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--latency', type=float, default=20, help='ms added to every request')
+    args = parser.parse_args()
+
+    sub_uuid = str(uuid.uuid4())
+    files = [{'uuid': str(uuid.uuid4()), 'file_name': f'reads_{n}.fastq.gz',
+              'cloud_url': f's3://org-hca-data-archive-upload-bench/{sub_uuid}/reads_{n}.fastq.gz'}
+             for n in range(args.files)]
+    mock = MockIngest(sub_uuid, files, latency=args.latency / 1000)
+    os.environ['INGEST_API'] = mock.start()
+
+    from data.archiver.ingest_api import Ingest
+
+    try:
+        for name, page_size, concurrency in (('next links', 20, 1),
+                                             ('large pages', 500, 1),
+                                             ('concurrent', 500, 8)):
+            mock.requests = 0
+            ingest = Ingest(page_size=page_size, concurrency=concurrency)
+            tracemalloc.start()
+            start = time.perf_counter()
+            sequence_files = ingest.get_sequence_files(sub_uuid)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            ingest.close()
+            assert len(sequence_files) == args.files, len(sequence_files)
+            print(f'{name:<12} size {page_size:>4} x{concurrency} {mock.requests:>5} requests {elapsed:7.2f}s '
+                  f'{args.files / elapsed:9.0f} files/s peak {peak / 1024 / 1024:6.1f} MB')
+    finally:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Compare a single sequential s3fs stream with RangedS3Reader against a local moto S3 server.
+
+    python -m benchmarks.bench_s3_reader --size 2048 --part-size 8 --concurrency 8
+
+Set --endpoint to benchmark against an existing S3 compatible server (e.g. MinIO) instead.
+"""
+import argparse
+import logging
+import os
+import time
+
+import boto3
+import s3fs
+
+from data.archiver.s3_reader import RangedS3Reader
+
+MB = 1024 * 1024
+BUCKET = 'bench-reader'
+KEY = 'object.bin'
+
+
+def start_moto():
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f'http://{host}:{port}'
+
+
+def upload(endpoint, size):
+    client = boto3.client('s3', endpoint_url=endpoint, aws_access_key_id='bench', aws_secret_access_key='bench',
+                          region_name='us-east-1')
+    client.create_bucket(Bucket=BUCKET)
+    part = os.urandom(MB)
+    mpu = client.create_multipart_upload(Bucket=BUCKET, Key=KEY)
+    parts = []
+    for n, offset in enumerate(range(0, size, 64 * MB), start=1):
+        body = part * (min(64 * MB, size - offset) // MB)
+        etag = client.upload_part(Bucket=BUCKET, Key=KEY, PartNumber=n, UploadId=mpu['UploadId'], Body=body)['ETag']
+        parts.append({'PartNumber': n, 'ETag': etag})
+    client.complete_multipart_upload(Bucket=BUCKET, Key=KEY, UploadId=mpu['UploadId'],
+                                     MultipartUpload={'Parts': parts})
+
+
+def drain(fp, block_size):
+    total = 0
+    while 1:
+        buf = fp.read(block_size)
+        if not buf:
+            return total
+        total += len(buf)
+
+
+def run(name, open_fn, size, block_size):
+    start = time.perf_counter()
+    with open_fn() as fp:
+        total = drain(fp, block_size)
+    elapsed = time.perf_counter() - start
+    assert total == size
+    print(f'{name:<36} {size / MB / elapsed:8.1f} MB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1024, help='object size in MB')
+    parser.add_argument('--part-size', type=int, default=8, help='ranged GET size in MB')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--block-size', type=int, default=1024 * 1024, help='consumer read size in bytes')
+    parser.add_argument('--endpoint', help='existing S3 compatible endpoint, otherwise moto is started')
+    args = parser.parse_args()
+
+    server = None
+    endpoint = args.endpoint
+    if not endpoint:
+        server, endpoint = start_moto()
+    try:
+        size = args.size * MB
+        upload(endpoint, size)
+        s3 = s3fs.S3FileSystem(key='bench', secret='bench', client_kwargs={'endpoint_url': endpoint})
+        url = f's3://{BUCKET}/{KEY}'
+        run('s3fs sequential', lambda: s3.open(url, 'rb'), size, args.block_size)
+        run(f'RangedS3Reader {args.part_size}M x{args.concurrency}',
+            lambda: RangedS3Reader(s3, url, size, args.part_size * MB, args.concurrency), size, args.block_size)
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Minimal stand-in for the Ingest API: one submission with paginated HAL file listings,
+file lookup by uuid and PATCH of file archive results.
+"""
+import json
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
+
+
+class MockIngest:
+
+    def __init__(self, sub_uuid, files, latency=0.0):
+        """
+        files are dicts with uuid, file_name and cloud_url. latency is added to every request.
+        """
+        self.sub_uuid = sub_uuid
+        self.files = files
+        self.by_uuid = {f['uuid']: f for f in files}
+        self.latency = latency
+        self.patches = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def entity(self, file):
+        return {
+            'uuid': {'uuid': file['uuid']},
+            'content': {'describedBy': 'https://schema.humancellatlas.org/type/file/9.5.0/sequence_file',
+                        'file_core': {'file_name': file['file_name']}},
+            'cloudUrl': file['cloud_url'],
+            '_links': {'self': {'href': f'{self.url}files/{file["uuid"]}'}}
+        }
+
+    def files_page(self, page, size):
+        size = min(size, MAX_PAGE_SIZE)
+        total_pages = (len(self.files) + size - 1) // size
+        files_url = f'{self.url}submissionEnvelopes/1/files'
+        response = {
+            '_embedded': {'files': [self.entity(f) for f in self.files[page * size:(page + 1) * size]]},
+            '_links': {'self': {'href': f'{files_url}?page={page}&size={size}'}},
+            'page': {'size': size, 'totalElements': len(self.files), 'totalPages': total_pages, 'number': page}
+        }
+        if page + 1 < total_pages:
+            response['_links']['next'] = {'href': f'{files_url}?page={page + 1}&size={size}'}
+        return response
+
+    def _handler(self):
+        ingest = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=None):
+                data = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/hal+json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def begin(self):
+                with ingest.lock:
+                    ingest.requests += 1
+                if ingest.latency:
+                    time.sleep(ingest.latency)
+                url = urlparse(self.path)
+                return url.path, {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            def do_GET(self):
+                path, query = self.begin()
+                if path == '/submissionEnvelopes/search/findByUuidUuid':
+                    self.reply(HTTPStatus.OK, {
+                        'uuid': {'uuid': ingest.sub_uuid},
+                        'stagingDetails': None,
+                        '_links': {'files': {'href': f'{ingest.url}submissionEnvelopes/1/files'}}
+                    })
+                elif path == '/submissionEnvelopes/1/files':
+                    self.reply(HTTPStatus.OK, ingest.files_page(int(query.get('page', 0)),
+                                                                int(query.get('size', DEFAULT_PAGE_SIZE))))
+                elif path == '/files/search/findByUuid' and query.get('uuid') in ingest.by_uuid:
+                    self.reply(HTTPStatus.OK, ingest.entity(ingest.by_uuid[query['uuid']]))
+                else:
+                    self.reply(HTTPStatus.NOT_FOUND)
+
+            def do_PATCH(self):
+                path, _ = self.begin()
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+                uuid = path.rsplit('/', 1)[-1]
+                if path.startswith('/files/') and uuid in ingest.by_uuid:
+                    with ingest.lock:
+                        ingest.patches[uuid] = body
+                    self.reply(HTTPStatus.ACCEPTED, body)
+                else:
+                    self.reply(HTTPStatus.NOT_FOUND)
+
+        return Handler
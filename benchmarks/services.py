@@ -0,0 +1,60 @@
+"""
+Local stand-ins for S3 (moto server) and the ENA FTP server (pyftpdlib) for benchmarks.
+
+configure_env() must run before anything from data.archiver is imported, as the
+archiver reads its configuration from the environment at import time.
+"""
+import logging
+import os
+import threading
+
+FTP_USER = 'Webin-0'
+FTP_PWD = 'bench'
+AWS_KEY = 'bench'
+
+
+def start_s3():
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f'http://{host}:{port}'
+
+
+def start_ftp(root):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+    config_logging(level=logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PWD, root, perm='elradfmwMT')
+    handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    server.max_cons = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.address
+
+
+def configure_env(s3_endpoint, ftp_address, data_dir):
+    host, port = ftp_address
+    os.environ.update({
+        'INGEST_API': os.getenv('INGEST_API', 'http://localhost:8080/'),
+        'INGEST_S3_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': AWS_KEY,
+        'AWS_ACCESS_KEY_SECRET': AWS_KEY,
+        'AWS_S3_ENDPOINT': s3_endpoint,
+        'ENA_FTP_HOST': host,
+        'ENA_FTP_PORT': str(port),
+        'ENA_FTP_DIR': 'bench',
+        'ENA_WEBIN_USERNAME': FTP_USER,
+        'ENA_WEBIN_PASSWORD': FTP_PWD,
+        'ARCHIVER_DATA_DIR': data_dir,
+    })
+
+
+def s3_client(endpoint):
+    import boto3
+    return boto3.client('s3', endpoint_url=endpoint, aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_KEY,
+                        region_name='us-east-1')
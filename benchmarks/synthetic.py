@@ -0,0 +1,27 @@
+import random
+
+BASES = 'ACGT'
+
+
+def fastq(size, read_length=150, seed=0):
+    """
+    generate roughly `size` bytes of synthetic FASTQ records with reads sampled
+    (with a few substitutions) from a small random reference, which compresses
+    closer to real sequencing output than uniformly random bytes.
+    """
+    rnd = random.Random(seed)
+    reference = ''.join(rnd.choice(BASES) for _ in range(1 << 16))
+    records = []
+    total = 0
+    n = 0
+    while total < size:
+        n += 1
+        start = rnd.randrange(len(reference) - read_length)
+        seq = list(reference[start:start + read_length])
+        for _ in range(rnd.randrange(3)):
+            seq[rnd.randrange(read_length)] = rnd.choice(BASES)
+        qual = ''.join('F' if rnd.random() < 0.85 else rnd.choice(':,#') for _ in range(read_length))
+        record = f'@SYNTHETIC.{n} {n}/1\n{"".join(seq)}\n+\n{qual}\n'.encode()
+        records.append(record)
+        total += len(record)
+    return b''.join(records)[:size]
@@ -1,26 +1,91 @@
 import logging
+import time
+from data.archiver import metrics
+from data.archiver.async_stream import AsyncS3FTPStreamer
 from data.archiver.aws_s3_client import AwsS3
-from data.archiver.ftp_uploader import FtpUploader
-from data.archiver.ingest_api import Ingest
+from data.archiver.budget import BudgetShare
+from data.archiver.ingest_api import Ingest, ResultReporter
+from data.archiver.jobs import JobStore, DONE, FAILED, TRANSFERRING
+from data.archiver.localcopy import LocalCopyPipeline
 from data.archiver.stream import S3FTPStreamer
-from data.archiver.utils import compress, md5
+from data.archiver.trace import RequestTrace
 from data.archiver.dataclass import DataArchiverRequest, DataArchiverResult, FileResult
 
 
 class Archiver:
 
-    def __init__(self, ingest_cli: Ingest, aws_cli: AwsS3):
+    def __init__(self, ingest_cli: Ingest, aws_cli: AwsS3, reporter: ResultReporter = None,
+                 trace: RequestTrace = None, share: BudgetShare = None, jobs: JobStore = None):
         self.ingest_cli = ingest_cli
         self.aws_cli = aws_cli
-        self.ftp = None
+        # reports each file's result as soon as it is archived
+        self.reporter = reporter
+        # timeline of the request, written by the caller once the results are reported
+        self.trace = trace or RequestTrace()
+        # transfer slots shared with the other requests being processed, unlimited if None
+        self.share = share
+        # state of each file of the request, to resume it if redelivered
+        self.jobs = jobs
+        self.req = None
+        # uuids of the files archived or failed so far
+        self.finished = set()
         
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
     def start(self, req: DataArchiverRequest):
+        start = time.perf_counter()
+        result = self._start(req)
+        if self.jobs:
+            # failed if archiving raised, so a redelivered request starts over rather than resuming
+            self.jobs.finish(req, result)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start)
+        metrics.REQUESTS.labels('success' if result.success else 'failed').inc()
+        return result
+
+    def _start(self, req: DataArchiverRequest):
         self.logger.info(req)
+        self.trace.sub_uuid = req.sub_uuid
+        self.req = req
+        res, remaining = self.resume(req) if self.jobs else (None, None)
+        if not res:
+            res = self.submission_files(req)
+            if not res.files:
+                return res
+            if self.jobs:
+                self.jobs.start(req, res)
+            remaining = res
+
+        try:
+            # TODO logic here to decide between local copy or stream archive/upload to ena
+            if remaining.files and req.stream:
+                self.archive_files_via_streaming(remaining, req.engine)
+            elif remaining.files:
+                self.archive_files_via_localcopy(remaining)
+            res.update_status()
+            self.logger.info(res)
+            return res
+
+        except Exception as ex:
+            self.logger.error(str(ex))
+            metrics.error(ex)
+            # the files archived before the error keep their results, the others failed with it
+            for file in remaining.files:
+                if file.success and file.uuid not in self.finished:
+                    file.success = False
+                    file.error = f'Archiving failed: {ex}'
+            res.success = False
+            res.error = f'Archiving failed: {ex}'
+            return res
+
+    def submission_files(self, req: DataArchiverRequest) -> DataArchiverResult:
+        """
+        the files of the request from Ingest, a failed result without files if there are none.
+        """
         self.logger.info(f'Getting sequence files for submission {req.sub_uuid} from Ingest.')
-        sequence_files = self.ingest_cli.get_sequence_files(req.sub_uuid)
+        with self.trace.span('ingest_files') as span:
+            sequence_files = self.ingest_cli.get_sequence_files(req.sub_uuid, req.files)
+            span.attrs['files'] = len(sequence_files)
         self.logger.info(sequence_files)
 
         if not sequence_files:
@@ -35,84 +100,71 @@ class Archiver:
             def file_result(uuid):
                 for f in sequence_files:
                     if f["uuid"] == uuid:
-                        return FileResult(f["uuid"], f["file_name"], f["cloud_url"])
+                        return FileResult.from_file(f)
                 return FileResult.not_found_error(uuid)
 
             res_files = list(map(file_result, req.files))
         
         res = DataArchiverResult(req.sub_uuid, files=res_files)
         self.logger.info(res)
+        return res
 
+    def resume(self, req: DataArchiverRequest):
+        """
+        the result of the request's running job with its files not done yet, (None, None)
+        if there is none.
+        """
+        files = self.jobs.resume(req)
+        if not files:
+            return None, None
+        res = DataArchiverResult(req.sub_uuid, files=[file.result() for file in files])
+        remaining = DataArchiverResult(req.sub_uuid, files=[result for file, result in zip(files, res.files)
+                                                            if file.state != DONE])
+        self.logger.info(f'Resuming archiving of submission {req.sub_uuid}, {len(files) - len(remaining.files)} '
+                         f'of {len(files)} files done.')
+        metrics.FILES.labels('resume', 'archived_before').inc(len(files) - len(remaining.files))
+        return res, remaining
+
+    def on_start(self, file: FileResult):
+        self.update_job(file, TRANSFERRING)
+
+    def on_done(self, file: FileResult):
+        self.finished.add(file.uuid)
+        self.update_job(file, DONE if file.success else FAILED)
+        if self.reporter:
+            self.reporter.report(file)
+
+    def update_job(self, file: FileResult, state):
+        if not self.jobs:
+            return
         try:
-            # TODO logic here to decide between local copy or stream archive/upload to ena
-            if req.stream:
-                result = self.archive_files_via_streaming(res)
-            else:
-                result = self.archive_files_via_localcopy(res)
-            self.logger.info(result)
-            return result
-
+            self.jobs.update(self.req, file, state)
         except Exception as ex:
-            self.logger.error(str(ex))
+            # the file is archived regardless, only resuming the request would redo it
+            self.logger.error(f'Could not record {file.uuid} as {state}: {str(ex)}')
 
     def archive_files_via_localcopy(self, res: DataArchiverResult):
 
-        self.logger.info(f'# step 1 download sequence files from S3')
-        self.aws_cli.get_files(res)
-
-        self.logger.info(f'# step 2 compress files using gz')
-        def try_compress(file):
-            if (file.file_name.endswith('.gz')):
-                self.logger.info(f'Skipping {file.file_name}')
-            else:
-                self.logger.info(f'Compressing {file.file_name}')
-                try:
-                    compress(file)
-                    file.file_name = f'{file.file_name}.gz'
-                    file.compressed = True
-                except:
-                    file.success = False
-                    file.error = 'Compression failed'
-
-        for file in res.files:
-            if file.success:
-                try_compress(file)
-
-        
-        self.logger.info(f'# step 3 calculate checksums of compressed files (and create .md5 files)')
-        checksum_files = []
-        def calc_checksum(file):
-            self.logger.info(f'Generating checksum {file.file_name}')
-            md5_file = f'{res.sub_uuid}/{file.file_name}.md5'
-            with open(md5_file,'a') as f1:
-                md5_str = md5(f'{res.sub_uuid}/{file.file_name}')
-                f1.write(md5_str)
-                file.md5 = md5_str
-            checksum_files.append(md5_file) 
-
-        for file in res.files:
-            if file.success:
-                calc_checksum(file)
-
-        self.logger.info(f'# step 4 upload files to ENA upload area')
-        
-        self.ftp = FtpUploader(res)
-        self.ftp.upload()
+        self.logger.info(f'# download, compress, checksum and upload each file through local disk')
 
+        LocalCopyPipeline(self.aws_cli, on_start=self.on_start, on_done=self.on_done, trace=self.trace,
+                          share=self.share).start(res)
         res.update_status()
 
         return res
 
-    def archive_files_via_streaming(self, res: DataArchiverResult):
+    def archive_files_via_streaming(self, res: DataArchiverResult, engine='threads'):
 
         self.logger.info(f'# stream sequence files from S3 to FTP, gzipping and calculating checksums on-the-fly')
         
-        S3FTPStreamer().start(res)
+        if engine == 'asyncio':
+            AsyncS3FTPStreamer(on_start=self.on_start, on_done=self.on_done, trace=self.trace,
+                               share=self.share).start(res)
+        else:
+            S3FTPStreamer(on_start=self.on_start, on_done=self.on_done, trace=self.trace, share=self.share).start(res)
         res.update_status()
 
         return res
 
     def close(self):
         self.ingest_cli.close()
-        if self.ftp:
-            self.ftp.close()
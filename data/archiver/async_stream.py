@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import aioftp
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+from tqdm import tqdm
+
+from data.archiver import metrics
+from data.archiver.aws_s3_client import S3Url, NOT_FOUND_CODES
+from data.archiver.budget import BudgetShare
+from data.archiver.buffers import BatchedProgress
+from data.archiver.checksum import MD5, MultiHash, s3_checksums
+from data.archiver.compression import new_compressor
+from data.archiver.config import AWS_S3_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_S3_ENDPOINT, ENA_FTP_HOST, \
+    ENA_FTP_PORT, ENA_WEBIN_USER, ENA_WEBIN_PWD, STREAM_READ_SIZE, COMPRESSION_LEVEL, COMPRESSION_WORKERS, \
+    ASYNC_S3_CONCURRENCY, ASYNC_FTP_CONCURRENCY, CHECKSUMS, CHECKSUM_ETAG_MD5, SMALL_FILE_SIZE
+from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.trace import RequestTrace
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class AsyncS3FTPStreamer:
+    """
+    asyncio alternative to S3FTPStreamer for submissions with many small files. All
+    transfers run as tasks on one event loop instead of holding a thread each, S3 requests
+    and FTP connections are bounded by explicit semaphores, and logged in FTP connections
+    are reused between files. Compression and hashing run in the loop's default executor
+    so they don't block the other transfers.
+
+    With a share, every transfer also takes a slot of the budget shared with the other
+    requests being processed, as the threaded engines do.
+    """
+
+    def __init__(self, s3_concurrency=ASYNC_S3_CONCURRENCY, ftp_concurrency=ASYNC_FTP_CONCURRENCY,
+                 on_done=None, trace: RequestTrace = None, on_start=None, share: BudgetShare = None):
+        # called with each file once archived, and as its transfer starts
+        self.on_done = on_done
+        self.on_start = on_start
+        self.trace = trace or RequestTrace()
+        # transfer slots shared with the other requests being processed
+        self.share = share
+        # taking a slot blocks, so it is waited for on threads of its own rather than the loop's
+        # default executor, which compresses and hashes for the transfers holding slots
+        self.slot_executor = ThreadPoolExecutor(ftp_concurrency, thread_name_prefix='budget') if share else None
+        self.s3_concurrency = s3_concurrency
+        self.ftp_concurrency = ftp_concurrency
+        self.s3 = None
+        self.s3_semaphore = None
+        self.ftp_semaphore = None
+        self.ftp_clients = []
+        # checksums S3 has of each object by cloud url, from head()
+        self.known_checksums = {}
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    def start(self, res: DataArchiverResult):
+        try:
+            asyncio.run(self._start(res))
+        finally:
+            if self.slot_executor:
+                self.slot_executor.shutdown()
+
+    async def _start(self, res: DataArchiverResult):
+        # semaphores are bound to the running loop
+        self.s3_semaphore = asyncio.Semaphore(self.s3_concurrency)
+        self.ftp_semaphore = asyncio.Semaphore(self.ftp_concurrency)
+        session = get_session()
+        async with session.create_client('s3', region_name=AWS_S3_REGION, endpoint_url=AWS_S3_ENDPOINT,
+                                         aws_access_key_id=AWS_ACCESS_KEY,
+                                         aws_secret_access_key=AWS_SECRET_KEY) as s3:
+            self.s3 = s3
+            try:
+                with self.trace.span('s3_metadata', files=len(res.files)):
+                    await asyncio.gather(*(self.head(file) for file in res.files if file.success))
+
+                total_files = len(res.files)
+                num_files = sum(map(lambda f: f.success, res.files))
+                if total_files != num_files:
+                    self.logger.info(f'{total_files - num_files} files not found.')
+
+                # Create each environment/uuid directory once for all files
+                dirs = {self.upload_dir(file) for file in res.files if file.success}
+                with self.trace.span('ftp_dirs'):
+                    async with self.ftp_client() as ftp:
+                        for path in sorted(dirs):
+                            await ftp.make_directory(path)
+
+                self.logger.info('Streaming asyncio...')
+                total_size = sum(file.size for file in res.files if file.success)
+                with tqdm(total=total_size, unit='B', unit_scale=True, desc=f'{num_files} files',
+                          mininterval=2) as pbar, self.trace.span('transfer', files=num_files) as span:
+                    span.bytes = total_size
+                    await asyncio.gather(*(self.copy_file(file, pbar) for file in res.files if file.success))
+            finally:
+                await self.close_ftp_clients()
+
+    @staticmethod
+    def upload_dir(file: FileResult):
+        s3url = S3Url(file.cloud_url)
+        env = s3url.bucket.split('-')[-1]
+        return f'{env}/{s3url.uuid}'
+
+    async def head(self, file: FileResult):
+        s3url = S3Url(file.cloud_url)
+        async with self.s3_semaphore:
+            try:
+                response = await self.s3.head_object(Bucket=s3url.bucket, Key=s3url.key, ChecksumMode='ENABLED')
+                file.size = response['ContentLength']
+                self.known_checksums[file.cloud_url] = s3_checksums(response, CHECKSUM_ETAG_MD5)
+            except ClientError as ex:
+                # throttling and server errors are retried by the client, others fail the file as they are
+                if ex.response.get('Error', {}).get('Code') in NOT_FOUND_CODES:
+                    file.error = 'File not found in S3.'
+                else:
+                    self.logger.error(f'Could not get {file.cloud_url} from S3: {str(ex)}')
+                    file.error = f'S3 error: {str(ex)}'
+                    metrics.error(ex)
+                file.success = False
+
+    @asynccontextmanager
+    async def ftp_client(self):
+        """
+        borrow a logged in FTP client, bounded by the FTP semaphore. the client is
+        discarded if the borrower raised.
+        """
+        async with self.ftp_semaphore:
+            if self.ftp_clients:
+                client = self.ftp_clients.pop()
+            else:
+                client = aioftp.Client()
+                await client.connect(ENA_FTP_HOST, ENA_FTP_PORT)
+                await client.login(ENA_WEBIN_USER, ENA_WEBIN_PWD)
+            try:
+                yield client
+            except BaseException:
+                client.close()
+                raise
+            self.ftp_clients.append(client)
+
+    @asynccontextmanager
+    async def transfer_slot(self, file: FileResult):
+        """
+        a slot of the shared budget for the transfer of file, only large files count towards
+        its bytes in flight.
+        """
+        if not self.share:
+            yield
+            return
+        nbytes = file.size if file.size >= SMALL_FILE_SIZE else 0
+        acquired = asyncio.get_running_loop().run_in_executor(self.slot_executor, self.share.budget.acquire,
+                                                              self.share, nbytes)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # the slot is still taken once the thread gets it
+            acquired.add_done_callback(lambda _: self.share.budget.release(self.share, nbytes))
+            raise
+        try:
+            yield
+        finally:
+            self.share.budget.release(self.share, nbytes)
+
+    async def close_ftp_clients(self):
+        clients, self.ftp_clients = self.ftp_clients, []
+        for client in clients:
+            try:
+                await client.quit()
+            except (aioftp.StatusCodeError, OSError):
+                client.close()
+
+    async def copy_file(self, file: FileResult, pbar: tqdm):
+        start = time.perf_counter()
+        with self.trace.span('file', file=file.file_name) as span:
+            span.bytes = file.size
+            try:
+                with metrics.ACTIVE_TRANSFERS.track_inprogress():
+                    await self.s3_ftp_stream(file, pbar)
+                if file.success:
+                    metrics.FILES.labels('stream', 'archived').inc()
+                    metrics.FILE_SECONDS.labels('stream').observe(time.perf_counter() - start)
+            except Exception as ex:
+                logging.error(f'Failed to copy file via stream: {file} error: {ex}')
+                file.error = str(ex)
+                file.success = False
+                metrics.FILES.labels('stream', 'failed').inc()
+                metrics.error(ex)
+            span.attrs.update(output=file.ena_upload_path, success=file.success, error=file.error)
+        if self.on_done:
+            # reporting may block, keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.on_done, file)
+
+    async def s3_ftp_stream(self, file: FileResult, pbar: tqdm):
+        s3url = S3Url(file.cloud_url)
+        path = self.upload_dir(file)
+        file.ena_upload_path = f'{path}/'
+        compressed = await self.is_compressed(file)
+        fout = file.file_name if compressed else f'{file.file_name}.gz'
+
+        # logged in once it has a slot, rather than holding a connection while it waits
+        async with self.transfer_slot(file), self.ftp_client() as ftp:
+            # once it can transfer rather than as it is queued
+            if self.on_start:
+                await asyncio.get_running_loop().run_in_executor(None, self.on_start, file)
+            if await self.remote_size(ftp, f'{path}/{file.file_name}') == file.size:
+                self.logger.info(f'Skipping {file.file_name} ({file.size} bytes). File exists in ENA FTP.')
+                file.error = 'File already exists in ENA upload area.'
+                file.success = False
+                return
+
+            compressor = None if compressed else new_compressor(COMPRESSION_LEVEL, COMPRESSION_WORKERS)
+            # the checksums S3 has only apply to the object uploaded as it is
+            hasher = MultiHash(CHECKSUMS, self.known_checksums.get(file.cloud_url) if compressed else None)
+
+            def transform(buf):
+                if compressor:
+                    buf = compressor.compress(buf)
+                return hasher.update(buf)
+
+            def finish():
+                return hasher.update(compressor.flush())
+
+            def read_progress(nbytes):
+                pbar.update(nbytes)
+                metrics.BYTES_READ.labels('stream').inc(nbytes)
+
+            # progress of the blocks added up rather than reported one by one
+            progress = BatchedProgress(read_progress)
+            loop = asyncio.get_running_loop()
+            sent = 0
+            try:
+                async with self.s3_semaphore:
+                    response = await self.s3.get_object(Bucket=s3url.bucket, Key=s3url.key)
+                    async with response['Body'] as body, ftp.upload_stream(f'{path}/{fout}') as stream:
+                        while 1:
+                            buf = await body.read(STREAM_READ_SIZE)
+                            if not buf:
+                                break
+                            out = await loop.run_in_executor(None, transform, buf) \
+                                if compressor or hasher.needed else buf
+                            if out:
+                                await stream.write(out)
+                                sent += len(out)
+                            progress(len(buf))
+                        if compressor:
+                            out = await loop.run_in_executor(None, finish)
+                            await stream.write(out)
+                            sent += len(out)
+                            if sent:
+                                metrics.COMPRESSION_RATIO.observe(file.size / sent)
+                        metrics.BYTES_SENT.labels('stream').inc(sent)
+            finally:
+                progress.flush()
+                if compressor:
+                    compressor.close()
+
+            file.checksums = hasher.hexdigests()
+            file.md5 = file.checksums[MD5]
+            file.compressed = not compressed
+            file.ena_upload_path += fout
+            async with ftp.upload_stream(f'{path}/{fout}.md5') as stream:
+                await stream.write(bytes(file.md5, 'utf-8'))
+        self.logger.info(f'Finish streaming {file.file_name}.')
+
+    async def is_compressed(self, file: FileResult):
+        if not file.cloud_url.endswith('.gz'):
+            return False
+        s3url = S3Url(file.cloud_url)
+        async with self.s3_semaphore:
+            response = await self.s3.get_object(Bucket=s3url.bucket, Key=s3url.key, Range='bytes=0-1')
+            async with response['Body'] as body:
+                return await body.read() == GZIP_MAGIC
+
+    @staticmethod
+    async def remote_size(ftp, path):
+        try:
+            info = await ftp.stat(path)
+        except aioftp.StatusCodeError:
+            return None
+        if info.get('type') != 'file' or not str(info.get('size', '')).isdigit():
+            return None
+        return int(info['size'])
@@ -2,14 +2,22 @@ import os
 import boto3
 from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from botocore.exceptions import ClientError
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
 from urllib.parse import urlparse
 from tqdm import tqdm
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
 
-from data.archiver.dataclass import DataArchiverResult
-from data.archiver.config import AWS_S3_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY
+from data.archiver import metrics
+from data.archiver.checksum import s3_checksums
+from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.config import AWS_S3_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_S3_ENDPOINT, \
+    S3_METADATA_CONCURRENCY, S3_LIST_MIN_KEYS, CHECKSUM_ETAG_MD5
 
 
 class S3Url:
@@ -30,6 +38,128 @@ class S3Url:
         return self.key[:36]
 
 
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+@dataclass
+class S3ObjectInfo:
+    size: int
+    etag: str
+    last_modified: datetime
+    # hex digests of the object S3 already has, by algorithm. None if listed, listings
+    # don't give the encryption an ETag depends on nor the additional checksums
+    checksums: Optional[Dict[str, str]] = field(default=None)
+
+
+def _object_info(obj: dict, listed=False) -> S3ObjectInfo:
+    # listings and HEAD responses name the same fields differently
+    return S3ObjectInfo(obj.get('Size', obj.get('ContentLength')), obj['ETag'].strip('"'),
+                        obj['LastModified'], None if listed else s3_checksums(obj, CHECKSUM_ETAG_MD5))
+
+
+def _uuid_prefix(key):
+    """
+    the submission uuid directory of the key, None for keys not laid out as uuid/...
+    """
+    return key[:37] if len(key) > 37 and key[36] == '/' else None
+
+
+class S3MetadataResolver:
+    """
+    Resolves size, ETag and last modified of many S3 objects in one pass before any
+    transfer starts. Keys are grouped by bucket and submission uuid prefix, each prefix with
+    at least list_min_keys keys is listed once (paginated) instead of a request per key.
+    Remaining keys are checked with concurrent HEADs.
+    """
+
+    def __init__(self, s3_cli, concurrency=S3_METADATA_CONCURRENCY, list_min_keys=S3_LIST_MIN_KEYS):
+        self.s3_cli = s3_cli
+        self.concurrency = concurrency
+        self.list_min_keys = list_min_keys
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    def resolve(self, urls: Iterable[str]) -> Dict[str, Optional[S3ObjectInfo]]:
+        """
+        info by s3:// url, None for objects that don't exist.
+        """
+        prefixes: Dict[tuple, Dict[str, str]] = {}
+        scattered: List[tuple] = []
+        for url in set(urls):
+            s3url = S3Url(url)
+            prefix = _uuid_prefix(s3url.key)
+            if prefix:
+                prefixes.setdefault((s3url.bucket, prefix), {})[s3url.key] = url
+            else:
+                scattered.append((s3url.bucket, s3url.key, url))
+
+        listed = {}
+        for (bucket, prefix), keys in prefixes.items():
+            if len(keys) >= self.list_min_keys:
+                listed[(bucket, prefix)] = keys
+            else:
+                scattered.extend((bucket, key, url) for key, url in keys.items())
+
+        results: Dict[str, Optional[S3ObjectInfo]] = {}
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            listings = {group: executor.submit(self._list, *group) for group in listed}
+            heads = {url: executor.submit(self._head, bucket, key) for bucket, key, url in scattered}
+            for group, future in listings.items():
+                found = future.result()
+                for key, url in listed[group].items():
+                    results[url] = found.get(key)
+            for url, future in heads.items():
+                results[url] = future.result()
+        self.logger.info(f'Resolved {len(results)} S3 objects with {len(listed)} prefix listings '
+                         f'and {len(scattered)} HEADs')
+        return results
+
+    def resolve_files(self, files: List[FileResult]) -> Dict[str, Optional[S3ObjectInfo]]:
+        """
+        sets the size of each file, or fails it if it isn't in S3.
+        """
+        infos = self.resolve(file.cloud_url for file in files if file.success)
+        for file in files:
+            if not file.success:
+                continue
+            info = infos.get(file.cloud_url)
+            if info:
+                file.size = info.size
+            else:
+                file.error = 'File not found in S3.'
+                file.success = False
+        return infos
+
+    def checksums(self, url, info: Optional[S3ObjectInfo]) -> Dict[str, str]:
+        """
+        the checksums S3 has of a resolved object, from a HEAD request if it was only listed.
+        none if it wasn't resolved.
+        """
+        if not info:
+            return {}
+        if info.checksums is not None:
+            return info.checksums
+        s3url = S3Url(url)
+        info = self._head(s3url.bucket, s3url.key)
+        return info.checksums if info else {}
+
+    def _list(self, bucket, prefix) -> Dict[str, S3ObjectInfo]:
+        found = {}
+        paginator = self.s3_cli.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                found[obj['Key']] = _object_info(obj, listed=True)
+        return found
+
+    def _head(self, bucket, key) -> Optional[S3ObjectInfo]:
+        try:
+            return _object_info(self.s3_cli.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED'))
+        except ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') in NOT_FOUND_CODES:
+                return None
+            raise
+
+
 class S3FileDownload:
 
     def __init__(self, cloud_url, success=False, error=None):
@@ -43,9 +173,13 @@ class AwsS3:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
+        # transfer acceleration is only available on AWS itself
+        config = Config(s3={'use_accelerate_endpoint': not AWS_S3_ENDPOINT},
+                        max_pool_connections=S3_METADATA_CONCURRENCY)
         self.s3_cli = boto3.Session(region_name=AWS_S3_REGION,
                              aws_access_key_id=AWS_ACCESS_KEY,
-                             aws_secret_access_key=AWS_SECRET_KEY).resource('s3', config=Config(s3={'use_accelerate_endpoint': True})).meta.client
+                             aws_secret_access_key=AWS_SECRET_KEY).resource('s3', endpoint_url=AWS_S3_ENDPOINT, config=config).meta.client
+        self.metadata = S3MetadataResolver(self.s3_cli)
 
     def file_exists(self, s3url):
         response = self.s3_cli.list_objects_v2(Bucket=s3url.bucket, Prefix=s3url.key)
@@ -57,18 +191,8 @@ class AwsS3:
 
     def get_files(self, res: DataArchiverResult):
 
-        total_size = 0
-        for file in res.files:
-            if not file.success:
-                continue
-
-            exists, size = self.file_exists(S3Url(file.cloud_url))
-            if exists:
-                total_size += size
-                file.size = size
-            else:
-                file.error = 'File not found in S3.'
-                file.success = False
+        self.metadata.resolve_files(res.files)
+        total_size = sum(file.size for file in res.files if file.success)
         
         def download(file):
             if not file.success:
@@ -80,13 +204,20 @@ class AwsS3:
 
                 os.makedirs(os.path.dirname(key), exist_ok=True)
 
-                self.s3_cli.download_file(bucket, key, key, Callback=pbar.update, Config=get_transfer_config(file.size))
+                with metrics.ACTIVE_TRANSFERS.track_inprogress(), metrics.timed('local_download'):
+                    self.s3_cli.download_file(bucket, key, key, Callback=progress,
+                                              Config=get_transfer_config(file.size))
 
             except Exception as ex:
                 file.error = str(ex)
                 file.success = False
+                metrics.error(ex)
                 pass
 
+        def progress(nbytes):
+            pbar.update(nbytes)
+            metrics.BYTES_READ.labels('local').inc(nbytes)
+
         self.logger.info('Downloading...')
 
         pbar = tqdm(total=total_size, unit='B', unit_scale=True, desc=num_files(res.files))
@@ -0,0 +1,135 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from data.archiver import metrics
+from data.archiver.config import GLOBAL_TRANSFER_SLOTS, GLOBAL_MAX_BYTES_IN_FLIGHT
+
+
+class BudgetShare:
+    """
+    The part of a ResourceBudget used by one archiving request. Transfers take a slot()
+    for their duration.
+    """
+
+    def __init__(self, budget: 'ResourceBudget', name):
+        self.budget = budget
+        self.name = name
+        self.active = 0
+        self.bytes = 0
+        self.waiting = 0
+
+    @contextmanager
+    def slot(self, nbytes=0):
+        self.budget.acquire(self, nbytes)
+        try:
+            yield
+        finally:
+            self.budget.release(self, nbytes)
+
+
+class ResourceBudget:
+    """
+    Limits shared by all requests processed at the same time by this process: transfers
+    running at once and their total bytes. FTP connections are limited by the shared
+    connection pool, one per transfer.
+
+    Slots are shared fairly between the registered requests: a request gets a slot while it
+    is below its fair share (slots / requests). Above it, it may only use slots no other
+    request below its share is waiting for, and one slot is kept free for each other request
+    with nothing running, so a request arriving while a large one fills every slot starts
+    as soon as it asks.
+
+    As with the transfer scheduler, a transfer larger than max_bytes runs when no other
+    transfer is in flight. The bytes in flight don't hold back a request with nothing of its
+    own running, so one request filling max_bytes doesn't starve the others.
+    """
+
+    def __init__(self, slots=GLOBAL_TRANSFER_SLOTS, max_bytes=GLOBAL_MAX_BYTES_IN_FLIGHT):
+        self.slots = max(slots, 1)
+        self.max_bytes = max_bytes
+        self.active = 0
+        self.bytes = 0
+        self.shares = set()
+        self._cond = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    @contextmanager
+    def share(self, name=None):
+        share = BudgetShare(self, name)
+        with self._cond:
+            self.shares.add(share)
+            metrics.ACTIVE_REQUESTS.set(len(self.shares))
+            self._cond.notify_all()
+        try:
+            yield share
+        finally:
+            with self._cond:
+                self.shares.discard(share)
+                metrics.ACTIVE_REQUESTS.set(len(self.shares))
+                self._cond.notify_all()
+
+    def fair_share(self):
+        return max(self.slots // max(len(self.shares), 1), 1)
+
+    def acquire(self, share: BudgetShare, nbytes=0):
+        with self._cond:
+            share.waiting += 1
+            try:
+                while not self._can_start(share, nbytes):
+                    self._cond.wait()
+            finally:
+                share.waiting -= 1
+            share.active += 1
+            share.bytes += nbytes
+            self.active += 1
+            self.bytes += nbytes
+
+    def release(self, share: BudgetShare, nbytes=0):
+        with self._cond:
+            share.active -= 1
+            share.bytes -= nbytes
+            self.active -= 1
+            self.bytes -= nbytes
+            self._cond.notify_all()
+
+    def _can_start(self, share: BudgetShare, nbytes):
+        if share.active and self.bytes + nbytes > self.max_bytes:
+            return False
+        if share.active < self.fair_share():
+            return self.active < self.slots
+        others = [other for other in self.shares if other is not share]
+        if any(other.waiting and other.active < self.fair_share() for other in others):
+            return False
+        idle = sum(1 for other in others if not other.active)
+        return self.active + idle < self.slots
+
+
+class ByteBudget:
+    """
+    Bytes of a resource, e.g. scratch disk space, used at once by all requests. A take()
+    waits until its bytes fit, one larger than max_bytes waits until nothing else is taken.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def take(self, nbytes):
+        with self._cond:
+            while self.used and self.used + nbytes > self.max_bytes:
+                self._cond.wait()
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+
+# shared by all requests of the process
+resource_budget = ResourceBudget()
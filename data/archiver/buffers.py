@@ -0,0 +1,133 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from data.archiver.config import STREAM_READ_SIZE, STREAM_BUFFERS
+
+# seconds between progress updates of a stream
+PROGRESS_INTERVAL = 1.0
+
+
+class BufferPool:
+    """
+    Reusable bytearrays of buffer_size, allocated as needed up to count, for streams to
+    read into and hand down their pipeline as memoryviews without a new bytes object per
+    block. Memory used by the buffers of all streams is capped at count * buffer_size,
+    get() waits for a buffer to be given back when they are all in use.
+
+    Streams take their buffers through a lease(), all given back once the stream ends
+    even if it failed with buffers still queued between its stages.
+    """
+
+    def __init__(self, buffer_size=STREAM_READ_SIZE, count=STREAM_BUFFERS):
+        self.buffer_size = buffer_size
+        self.count = max(count, 1)
+        self.allocated = 0
+        self._free = []
+        self._cond = threading.Condition()
+
+    def get(self) -> bytearray:
+        with self._cond:
+            while not self._free and self.allocated >= self.count:
+                self._cond.wait()
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.buffer_size)
+
+    def put(self, buf: bytearray):
+        with self._cond:
+            # last in first out, the most recently used buffers are likely still cached
+            self._free.append(buf)
+            self._cond.notify()
+
+    @property
+    def in_use(self):
+        with self._cond:
+            return self.allocated - len(self._free)
+
+    @contextmanager
+    def lease(self):
+        lease = BufferLease(self)
+        try:
+            yield lease
+        finally:
+            lease.close()
+
+
+class BufferLease:
+    """
+    The buffers of a pool taken by one stream.
+    """
+
+    def __init__(self, pool: BufferPool):
+        self.pool = pool
+        self._taken = {}
+        self._lock = threading.Lock()
+
+    def get(self) -> bytearray:
+        buf = self.pool.get()
+        with self._lock:
+            self._taken[id(buf)] = buf
+        return buf
+
+    def put(self, buf):
+        """
+        give back a buffer, or a memoryview of one. Other buffers, e.g. compressed output,
+        are ignored so any buffer a pipeline is done with can be passed.
+        """
+        if isinstance(buf, memoryview):
+            buf = buf.obj
+        with self._lock:
+            buf = self._taken.pop(id(buf), None)
+        if buf is not None:
+            self.pool.put(buf)
+
+    def close(self):
+        with self._lock:
+            taken, self._taken = list(self._taken.values()), {}
+        for buf in taken:
+            self.pool.put(buf)
+
+
+def readinto_full(fp, buf) -> int:
+    """
+    fill buf from fp, short only at the end of the file. returns the number of bytes read.
+    """
+    view = memoryview(buf)
+    n = 0
+    while n < len(view):
+        read = fp.readinto(view[n:])
+        if not read:
+            break
+        n += read
+    return n
+
+
+class BatchedProgress:
+    """
+    Adds up the bytes of each block and passes them on to callback at most every interval
+    seconds, and on flush().
+    """
+
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.pending = 0
+        self._last = time.monotonic()
+
+    def __call__(self, nbytes):
+        self.pending += nbytes
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            nbytes, self.pending = self.pending, 0
+            self.callback(nbytes)
+
+
+# shared by all streams of the process
+stream_buffers = BufferPool()
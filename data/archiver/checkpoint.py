@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+
+@dataclass
+class TransferCheckpoint:
+    """
+    What a partial upload was produced from. A transfer is only resumed from the remote
+    partial size if the source object and the compressor are unchanged, so the output
+    regenerated on retry is byte for byte the same as what was already sent.
+    """
+    cloud_url: str
+    output: str
+    size: int
+    etag: str = field(default=None)
+    # compressor settings, None for files sent as is
+    compressor: str = field(default=None)
+
+
+class CheckpointStore:
+    """
+    Transfer checkpoints persisted as json files, one per source/output pair.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, cloud_url, output):
+        name = hashlib.md5(f'{cloud_url} {output}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{name}.json')
+
+    def load(self, cloud_url, output) -> Optional[TransferCheckpoint]:
+        try:
+            with open(self._file(cloud_url, output)) as f:
+                return TransferCheckpoint(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, checkpoint: TransferCheckpoint):
+        os.makedirs(self.path, exist_ok=True)
+        file = self._file(checkpoint.cloud_url, checkpoint.output)
+        with open(f'{file}.tmp', 'w') as f:
+            json.dump(asdict(checkpoint), f)
+        os.replace(f'{file}.tmp', file)
+
+    def remove(self, cloud_url, output):
+        try:
+            os.remove(self._file(cloud_url, output))
+        except FileNotFoundError:
+            pass
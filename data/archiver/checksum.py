@@ -0,0 +1,194 @@
+import base64
+import hashlib
+import queue
+import re
+import threading
+import zlib
+from typing import Dict, Iterable, Tuple
+
+from data.archiver.buffers import BufferPool, readinto_full
+from data.archiver.config import CHECKSUMS, LOCAL_READ_SIZE
+from data.archiver.trace import profiled
+
+MD5 = 'md5'
+# a single part upload's ETag is the md5 of the object, unless encrypted with KMS or a customer key
+ETAG_MD5 = re.compile(r'^[0-9a-f]{32}$')
+# S3 additional checksums, base64 of the digest, as named in HEAD responses
+S3_CHECKSUMS = {
+    'ChecksumSHA256': 'sha256',
+    'ChecksumSHA1': 'sha1',
+    'ChecksumCRC32': 'crc32',
+    'ChecksumCRC32C': 'crc32c',
+}
+# buffers queued for a hash worker
+MAX_PENDING = 4
+
+
+class Crc32:
+    """
+    zlib crc32 with the interface of hashlib, the digest is big endian as in S3.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, buf):
+        self.value = zlib.crc32(buf, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+class Crc32c(Crc32):
+    """
+    crc32c (Castagnoli) of the optional crc32c package.
+    """
+
+    def __init__(self):
+        super().__init__()
+        import crc32c
+        self._crc32c = crc32c.crc32c
+
+    def update(self, buf):
+        self.value = self._crc32c(buf, self.value)
+
+
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'crc32': Crc32,
+    'crc32c': Crc32c,
+}
+
+
+def algorithm_names(names: Iterable[str] = CHECKSUMS) -> Tuple[str, ...]:
+    """
+    the algorithms to compute, md5 first as the ENA upload area needs it.
+    """
+    names = [name.strip().lower() for name in names if name.strip()]
+    unknown = [name for name in names if name not in ALGORITHMS]
+    if unknown:
+        raise ValueError(f'Unknown checksum algorithm {", ".join(unknown)}, one of {", ".join(ALGORITHMS)}')
+    if 'crc32c' in names:
+        try:
+            import crc32c  # noqa: F401
+        except ImportError:
+            raise ValueError('crc32c checksums need the crc32c package')
+    return tuple(dict.fromkeys([MD5, *names]))
+
+
+class MultiHash:
+    """
+    All the requested digests of the same data, updated in one pass.
+    """
+
+    def __init__(self, names: Iterable[str] = (MD5,), known: Dict[str, str] = None):
+        # digests already known, e.g. from S3, are not computed again
+        self.known = dict(known or {})
+        self._hashes = {name: ALGORITHMS[name]() for name in algorithm_names(names) if name not in self.known}
+
+    @property
+    def needed(self):
+        """
+        true if any digest has to be computed from the data.
+        """
+        return bool(self._hashes)
+
+    def update(self, buf):
+        for hash in self._hashes.values():
+            hash.update(buf)
+        return buf
+
+    def hexdigests(self) -> Dict[str, str]:
+        return dict(self.known, **{name: hash.hexdigest() for name, hash in self._hashes.items()})
+
+
+class HashWorker(MultiHash):
+    """
+    A MultiHash updated on a thread of its own, so hashing a buffer overlaps reading or
+    producing the next. hashlib and zlib release the GIL on large buffers.
+
+    A buffer passed to update() must not change until release is called with it, bytes
+    can be passed without release.
+    """
+
+    def __init__(self, names: Iterable[str] = (MD5,), known: Dict[str, str] = None, max_pending=MAX_PENDING):
+        super().__init__(names, known)
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=profiled(self._run), name='hash', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                return
+            buf, release = item
+            try:
+                if not self._error:
+                    MultiHash.update(self, buf)
+            except Exception as ex:
+                self._error = ex
+            finally:
+                if release:
+                    release(buf)
+
+    def update(self, buf, release=None):
+        self._queue.put((buf, release))
+        return buf
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def hexdigests(self) -> Dict[str, str]:
+        self.close()
+        if self._error:
+            raise self._error
+        return super().hexdigests()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_checksums(fname, names: Iterable[str] = (MD5,), read_size=LOCAL_READ_SIZE, known: Dict[str, str] = None) \
+        -> Tuple[Dict[str, str], int]:
+    """
+    digests and size of a file, read into two alternating buffers while the other is hashed.
+    """
+    buffers = BufferPool(read_size, 2)
+    size = 0
+    with open(fname, 'rb', buffering=0) as f, HashWorker(names, known) as hasher:
+        while 1:
+            buf = buffers.get()
+            n = readinto_full(f, buf)
+            if not n:
+                buffers.put(buf)
+                break
+            size += n
+            hasher.update(memoryview(buf)[:n], lambda view: buffers.put(view.obj))
+        return hasher.hexdigests(), size
+
+
+def s3_checksums(obj: dict, etag_md5=True) -> Dict[str, str]:
+    """
+    hex digests of the whole object given by S3 in a listing or HEAD response: the md5 from
+    a single part ETag, and any full object additional checksum. Composite checksums of
+    multipart uploads, ending in -<parts>, are not digests of the object and are left out.
+    """
+    checksums = {}
+    etag = obj.get('ETag', '').strip('"')
+    encrypted = obj.get('ServerSideEncryption') == 'aws:kms' or obj.get('SSECustomerAlgorithm')
+    if etag_md5 and ETAG_MD5.match(etag) and not encrypted:
+        checksums[MD5] = etag
+    for field, name in S3_CHECKSUMS.items():
+        value = obj.get(field)
+        if value and '-' not in value:
+            checksums[name] = base64.b64decode(value).hex()
+    return checksums
@@ -0,0 +1,143 @@
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# wbits for zlib to emit a gzip header and trailer around the deflate stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 255)
+DEFAULT_COMPRESSION_LEVEL = 6
+# input size deflated by each parallel worker and the history shared with the next chunk
+PARALLEL_CHUNK_SIZE = 1024 * 1024  # 1M
+DICT_SIZE = 32 * 1024  # deflate window
+
+
+class GzipCompressor:
+    """
+    Incremental gzip compressor keeping a single zlib compress object per file,
+    so the whole stream is written as one gzip member sharing one dictionary.
+    """
+
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL):
+        self.level = level
+        self._zobj = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def compress(self, buf) -> bytes:
+        """
+        compress the next block of input, may return b'' while zlib buffers data.
+        """
+        return self._zobj.compress(buf)
+
+    def flush(self) -> bytes:
+        """
+        finish the stream, returning the remaining compressed data and the gzip trailer.
+        """
+        return self._zobj.flush(zlib.Z_FINISH)
+
+    def close(self):
+        pass
+
+
+def _deflate_chunk(data, zdict, level, last):
+    if zdict:
+        zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # a sync flush ends the chunk on a byte boundary without marking the final block,
+    # so the raw deflate output of consecutive chunks can be concatenated
+    return zobj.compress(data) + zobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipCompressor:
+    """
+    pigz style gzip compressor. Input is split into chunks deflated independently in a
+    thread pool (zlib releases the GIL), each primed with the last 32K of the previous
+    chunk as dictionary. The chunks are reassembled in order into a single standard gzip
+    member, the CRC32 of the input is computed as it is fed in.
+    """
+
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL, workers=None, chunk_size=PARALLEL_CHUNK_SIZE):
+        self.level = level
+        self.chunk_size = chunk_size
+        # ThreadPoolExecutor's default when not given
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._max_pending = self.workers * 2
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._crc = 0
+        self._size = 0
+        self._header = GZIP_HEADER
+
+    def compress(self, buf) -> bytes:
+        self._crc = zlib.crc32(buf, self._crc)
+        self._size += len(buf)
+        self._buffer += buf
+        while len(self._buffer) >= self.chunk_size:
+            self._submit(bytes(self._buffer[:self.chunk_size]), last=False)
+            del self._buffer[:self.chunk_size]
+        return self._collect(wait=False)
+
+    def flush(self) -> bytes:
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        out = self._collect(wait=True)
+        self.close()
+        return out + struct.pack('<II', self._crc, self._size & 0xffffffff)
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, chunk, last):
+        self._pending.append(self._executor.submit(_deflate_chunk, chunk, self._zdict, self.level, last))
+        self._zdict = chunk[-DICT_SIZE:]
+
+    def _collect(self, wait):
+        out = [self._header]
+        self._header = b''
+        # block on the oldest chunk when too many are in flight to bound memory
+        while self._pending and (wait or self._pending[0].done() or len(self._pending) > self._max_pending):
+            out.append(self._pending.popleft().result())
+        return b''.join(out)
+
+
+def new_compressor(level=DEFAULT_COMPRESSION_LEVEL, workers=1):
+    """
+    single threaded compressor by default, parallel chunked compressor when more than one worker.
+    """
+    if workers and workers > 1:
+        return ParallelGzipCompressor(level, workers)
+    return GzipCompressor(level)
+
+
+def compressor_id(level=DEFAULT_COMPRESSION_LEVEL, workers=1):
+    """
+    identifies the settings that determine the compressed output bytes, for the same input
+    the same id always produces the same output.
+    """
+    if workers and workers > 1:
+        return f'pigz:{level}:{PARALLEL_CHUNK_SIZE}'
+    return f'gzip:{level}'
+
+
+def gzip_stream(fp, level=DEFAULT_COMPRESSION_LEVEL, read_size=1024 * 1024, workers=1):
+    """
+    generator of gzip compressed chunks read from a binary file-like object.
+    """
+    compressor = new_compressor(level, workers)
+    try:
+        while 1:
+            buf = fp.read(read_size)
+            if not buf:
+                break
+            cbuf = compressor.compress(buf)
+            if cbuf:
+                yield cbuf
+        yield compressor.flush()
+    finally:
+        compressor.close()
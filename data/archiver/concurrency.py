@@ -0,0 +1,132 @@
+import ftplib
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from data.archiver import metrics
+from data.archiver.config import TRANSFER_WORKERS, CONCURRENCY_FLOOR, CONCURRENCY_CEILING, CONCURRENCY_INTERVAL
+
+
+def is_congestion(ex: BaseException):
+    """
+    errors that mean the server is overloaded rather than something wrong with the file,
+    e.g. 421 too many connections, timeouts and dropped connections.
+    """
+    return isinstance(ex, (ftplib.error_temp, socket.timeout, TimeoutError, ConnectionError, EOFError))
+
+
+@dataclass
+class ConcurrencyStats:
+    limit: int
+    active: int = field(default=0)
+    # aggregate bytes/s over the last window
+    rate: float = field(default=0.0)
+    errors: int = field(default=0)
+    increases: int = field(default=0)
+    decreases: int = field(default=0)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on the number of concurrent transfers. Every interval seconds the aggregate
+    throughput of the window is compared with the previous one:
+
+    - congestion errors in the window cut the limit by the decrease factor
+    - otherwise the limit grows by one while throughput keeps improving by more than
+      tolerance and all slots are in use
+    - otherwise it is held
+
+    The limit stays between floor and ceiling. Transfers take a slot() for their duration,
+    report bytes with record() and failures with record_error().
+
+    ftp_concurrency is the one of the process, the limit learnt by a request is kept for
+    the next and requests running at once share it.
+    """
+
+    def __init__(self, initial=TRANSFER_WORKERS, floor=CONCURRENCY_FLOOR, ceiling=CONCURRENCY_CEILING,
+                 interval=CONCURRENCY_INTERVAL, decrease=0.5, tolerance=0.05):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.interval = interval
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.stats = ConcurrencyStats(min(max(initial, self.floor), self.ceiling))
+        metrics.CONCURRENCY_LIMIT.set(self.stats.limit)
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._cond = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    @property
+    def limit(self):
+        return self.stats.limit
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while self.stats.active >= self.stats.limit:
+                self._cond.wait()
+            self.stats.active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.stats.active -= 1
+                self._cond.notify_all()
+
+    def record(self, nbytes):
+        with self._cond:
+            self._window_bytes += nbytes
+            self._adjust()
+
+    def record_error(self, ex: BaseException):
+        if not is_congestion(ex):
+            return
+        with self._cond:
+            self.stats.errors += 1
+            self._window_errors += 1
+            self._adjust()
+
+    def snapshot(self) -> ConcurrencyStats:
+        with self._cond:
+            return ConcurrencyStats(**vars(self.stats))
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        rate = self._window_bytes / elapsed
+        limit = self.stats.limit
+        if self._window_errors:
+            limit = max(self.floor, int(limit * self.decrease))
+            reason = f'{self._window_errors} errors'
+        elif rate > self.stats.rate * (1 + self.tolerance) and self.stats.active >= limit:
+            limit = min(self.ceiling, limit + 1)
+            reason = f'throughput up to {rate:.0f} bytes/s'
+        else:
+            reason = None
+        if limit != self.stats.limit:
+            if limit > self.stats.limit:
+                self.stats.increases += 1
+                metrics.CONCURRENCY_CHANGES.labels('increase').inc()
+            else:
+                self.stats.decreases += 1
+                metrics.CONCURRENCY_CHANGES.labels('decrease').inc()
+            metrics.CONCURRENCY_LIMIT.set(limit)
+            self.logger.info(f'Concurrent transfers {self.stats.limit} -> {limit}, {reason}')
+            self.stats.limit = limit
+            self._cond.notify_all()
+        self.stats.rate = rate
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_errors = 0
+
+
+# shared by all requests of the process, they stream to the same FTP server
+ftp_concurrency = AdaptiveConcurrency()
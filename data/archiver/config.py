@@ -5,15 +5,40 @@ from dataclasses import dataclass
 AWS_S3_REGION = os.getenv('INGEST_S3_REGION')
 AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_KEY = os.getenv('AWS_ACCESS_KEY_SECRET')
+# S3 compatible endpoint other than AWS, e.g. a local stand-in for benchmarks
+AWS_S3_ENDPOINT = os.getenv('AWS_S3_ENDPOINT')
 
 ENA_FTP_HOST = os.getenv('ENA_FTP_HOST')
+ENA_FTP_PORT = int(os.getenv('ENA_FTP_PORT', 21))
 ENA_FTP_DIR = os.getenv('ENA_FTP_DIR')
 ENA_WEBIN_USER = os.getenv('ENA_WEBIN_USERNAME')
 ENA_WEBIN_PWD = os.getenv('ENA_WEBIN_PASSWORD')
 
+# ftp connection pool shared by all uploads, limits are per host
+FTP_POOL_SIZE = int(os.getenv('FTP_POOL_SIZE', 32))
+FTP_POOL_MAX_IDLE = int(os.getenv('FTP_POOL_MAX_IDLE', 5 * 60))  # seconds
+FTP_POOL_MAX_AGE = int(os.getenv('FTP_POOL_MAX_AGE', 60 * 60))  # seconds
+FTP_POOL_CHECK_AFTER = int(os.getenv('FTP_POOL_CHECK_AFTER', 10))  # seconds idle before NOOP check
+# uploads of local files
+FTP_BLOCK_SIZE = int(os.getenv('FTP_BLOCK_SIZE', 1024 * 1024))  # 1M
+# send local files with sendfile(2), without copying them through user space. not with FTPS
+FTP_SENDFILE = os.getenv('FTP_SENDFILE', 'true').lower() in ('true', '1', 'yes')
+# how long a cached remote directory listing is trusted
+FTP_INDEX_TTL = int(os.getenv('FTP_INDEX_TTL', 5 * 60))  # seconds
+
+ARCHIVER_DATA_DIR = os.getenv('ARCHIVER_DATA_DIR', '.')
+
+# only needed to archive, not e.g. to inspect the job store
 INGEST_API = os.getenv('INGEST_API')
-if not INGEST_API.endswith("/"):
+if INGEST_API and not INGEST_API.endswith("/"):
     INGEST_API += '/'
+INGEST_PAGE_SIZE = int(os.getenv('INGEST_PAGE_SIZE', 500))
+# pages fetched at once when the total number of pages is known
+INGEST_CONCURRENCY = int(os.getenv('INGEST_CONCURRENCY', 8))
+# file archive results patched back to ingest at once, failed patches are retried
+INGEST_PATCH_CONCURRENCY = int(os.getenv('INGEST_PATCH_CONCURRENCY', 8))
+INGEST_PATCH_RETRIES = int(os.getenv('INGEST_PATCH_RETRIES', 3))
+INGEST_PATCH_BACKOFF = float(os.getenv('INGEST_PATCH_BACKOFF', 1))  # seconds, doubled per retry
 
 # messaging
 RABBIT_HOST = os.getenv('RABBIT_HOST')
@@ -21,6 +46,77 @@ RABBIT_PORT = os.getenv('RABBIT_PORT')
 
 SINGLE_THREADED = os.getenv('SINGLE_THREADED')
 
+# prometheus /metrics served on this port if set
+METRICS_PORT = os.getenv('METRICS_PORT')
+# a json timeline of each request is written here
+TRACE_DIR = os.getenv('TRACE_DIR', os.path.join(ARCHIVER_DATA_DIR, 'traces'))
+# profile every request, not only those asking for it
+TRACE_PROFILE = os.getenv('TRACE_PROFILE')
+
+# streaming
+STREAM_READ_SIZE = int(os.getenv('STREAM_READ_SIZE', 1024 * 1024))  # 1M
+# buffers of STREAM_READ_SIZE reused by all streams, their memory is capped at both multiplied
+STREAM_BUFFERS = int(os.getenv('STREAM_BUFFERS', 64))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+# more than 1 worker compresses each file in parallel chunks
+COMPRESSION_WORKERS = int(os.getenv('COMPRESSION_WORKERS', 1))
+# buffers queued between each pipeline stage of a file stream
+IN_FLIGHT_BUFFERS = int(os.getenv('IN_FLIGHT_BUFFERS', 4))
+# objects larger than one part are read with concurrent ranged GETs
+S3_PART_SIZE = int(os.getenv('S3_PART_SIZE', 8 * 1024 * 1024))  # 8M
+S3_READ_CONCURRENCY = int(os.getenv('S3_READ_CONCURRENCY', 4))
+# pre-flight size/ETag lookups, submission prefixes with this many files are listed
+# once instead of a HEAD per file
+S3_METADATA_CONCURRENCY = int(os.getenv('S3_METADATA_CONCURRENCY', 32))
+S3_LIST_MIN_KEYS = int(os.getenv('S3_LIST_MIN_KEYS', 4))
+# failed transfers are resumed from the partial remote file this many times
+STREAM_RETRIES = int(os.getenv('STREAM_RETRIES', 2))
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', os.path.join(ARCHIVER_DATA_DIR, 'checkpoints'))
+# files archived before are skipped if their S3 ETag is unchanged
+LEDGER_PATH = os.getenv('LEDGER_PATH', os.path.join(ARCHIVER_DATA_DIR, 'ledger.sqlite'))
+# check the remote size of files found in the ledger before skipping them
+LEDGER_VERIFY = os.getenv('LEDGER_VERIFY')
+# state of each job and its files, a redelivered request only archives the files not done.
+# backend 'sqlite', empty to disable
+JOB_STORE = os.getenv('JOB_STORE', 'sqlite')
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH', os.path.join(ARCHIVER_DATA_DIR, 'jobs.sqlite'))
+
+# checksums of each archived file, in one pass: md5 (always), sha1, sha256, crc32, crc32c
+CHECKSUMS = os.getenv('CHECKSUMS', 'md5').split(',')
+# reuse a single part ETag as the md5 of a file uploaded as is rather than hashing it
+CHECKSUM_ETAG_MD5 = os.getenv('CHECKSUM_ETAG_MD5', 'true').lower() in ('true', '1', 'yes')
+
+# local copy, files are downloaded, compressed and uploaded here and removed once uploaded
+LOCALCOPY_DIR = os.getenv('LOCALCOPY_DIR', ARCHIVER_DATA_DIR)
+LOCALCOPY_WORKERS = int(os.getenv('LOCALCOPY_WORKERS', 4))
+# read size of local files being compressed or checksummed
+LOCAL_READ_SIZE = int(os.getenv('LOCAL_READ_SIZE', 8 * 1024 * 1024))  # 8M
+# scratch space used at once by all requests, a file needing more is still archived, on its own
+LOCALCOPY_DISK_BUDGET = int(os.getenv('LOCALCOPY_DISK_BUDGET', 50 * 1024 ** 3))  # 50G
+
+# transfer scheduling, files are started largest first
+TRANSFER_WORKERS = int(os.getenv('TRANSFER_WORKERS', os.cpu_count() or 4))
+# files smaller than this get their own lane so they aren't queued behind large ones
+SMALL_FILE_SIZE = int(os.getenv('SMALL_FILE_SIZE', 64 * 1024 * 1024))  # 64M
+SMALL_FILE_WORKERS = int(os.getenv('SMALL_FILE_WORKERS', 4))
+# total size of large files being transferred at once, a larger file still runs alone
+MAX_BYTES_IN_FLIGHT = int(os.getenv('MAX_BYTES_IN_FLIGHT', 200 * 1024 ** 3))  # 200G
+# requests processed at once by the listener
+LISTENER_PREFETCH = int(os.getenv('LISTENER_PREFETCH', 4))
+# limits shared fairly by all requests being processed, one FTP connection per transfer
+GLOBAL_TRANSFER_SLOTS = int(os.getenv('GLOBAL_TRANSFER_SLOTS', FTP_POOL_SIZE))
+GLOBAL_MAX_BYTES_IN_FLIGHT = int(os.getenv('GLOBAL_MAX_BYTES_IN_FLIGHT', MAX_BYTES_IN_FLIGHT))
+# concurrent large transfers of the process adapt to throughput and errors within these bounds
+CONCURRENCY_FLOOR = int(os.getenv('CONCURRENCY_FLOOR', 1))
+CONCURRENCY_CEILING = int(os.getenv('CONCURRENCY_CEILING', FTP_POOL_SIZE))
+CONCURRENCY_INTERVAL = int(os.getenv('CONCURRENCY_INTERVAL', 10))  # seconds
+# per stream throughput used to predict when a request will finish
+STREAM_RATE_ESTIMATE = int(os.getenv('STREAM_RATE_ESTIMATE', 20 * 1024 * 1024))  # bytes/s
+
+# asyncio streaming engine
+ASYNC_S3_CONCURRENCY = int(os.getenv('ASYNC_S3_CONCURRENCY', 128))
+ASYNC_FTP_CONCURRENCY = int(os.getenv('ASYNC_FTP_CONCURRENCY', 32))
+
 EXCHANGE = 'ingest.data.archiver.exchange'
 EXCHANGE_TYPE = 'topic'
 
@@ -29,6 +125,19 @@ SUBSCRIBE_ROUTING_KEY = 'ingest.data.archiver.request'
 
 PUBLISH_ROUTING_KEY = 'ingest.data.archiver.complete'
 
+# batches of fanned out requests
+WORK_QUEUE = 'ingest.data.archiver.work.queue'
+WORK_ROUTING_KEY = 'ingest.data.archiver.work'
+# followed by the job id
+WORK_DONE_ROUTING_KEY = 'ingest.data.archiver.work.done'
+# fan out every request, not only those asking for it
+FANOUT = os.getenv('FANOUT')
+# a request is split into enough batches for each to hold at most this many bytes and files
+FANOUT_BATCH_BYTES = int(os.getenv('FANOUT_BATCH_BYTES', 500 * 1024 ** 3))  # 500G
+FANOUT_BATCH_FILES = int(os.getenv('FANOUT_BATCH_FILES', 1000))
+# files of batches without a result by then are failed
+FANOUT_TIMEOUT = int(os.getenv('FANOUT_TIMEOUT', 7 * 24 * 60 * 60))  # seconds
+
 RETRY_POLICY = {
     'interval_start': 0,
     'interval_step': 2,
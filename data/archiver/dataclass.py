@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import Dict, List
 
 
 class DataArchiverRequestParseException(Exception):
@@ -11,6 +11,27 @@ class DataArchiverRequest:
     sub_uuid: str
     files: List[str] = field(default_factory=list)
     stream: bool = field(default=True)
+    # streaming engine, 'threads' or 'asyncio'
+    engine: str = field(default='threads')
+    # profile the request, written next to its trace
+    profile: bool = field(default=False)
+    # split the files into batches archived by any listening archiver
+    fan_out: bool = field(default=False)
+
+
+@dataclass
+class WorkItem:
+    """
+    A batch of the files of a fanned out request, its result is published with reply_to
+    as routing key.
+    """
+    job_id: str
+    sub_uuid: str
+    batch: int
+    files: List[str]
+    reply_to: str
+    stream: bool = field(default=True)
+    engine: str = field(default='threads')
 
 
 @dataclass
@@ -28,10 +49,14 @@ class FileResult:
     ena_upload_path: str = field(default=None)
     success: bool = field(default=True)
     error: str = field(default=None)
+    # ingest file self link, the archive result is patched to it
+    ingest_url: str = field(default=None)
+    # hex digests of the archived file by algorithm, md5 included
+    checksums: Dict[str, str] = field(default_factory=dict)
 
     @classmethod
     def from_file(cls, file):
-        return cls(file["uuid"], file["file_name"], file["cloud_url"])
+        return cls(file["uuid"], file["file_name"], file["cloud_url"], ingest_url=file.get("ingest_url"))
 
     @classmethod
     def not_found_error(cls, uuid):
@@ -46,6 +71,10 @@ class DataArchiverResult:
     error: str = field(default=None)
     files: List[FileResult] = field(default_factory=list)
 
+    @classmethod
+    def from_dict(cls, res: dict):
+        return cls(**dict(res, files=[FileResult(**file) for file in res.get('files', [])]))
+
     def update_status(self):
         not_success = 0
         for file in self.files:
@@ -0,0 +1,185 @@
+import heapq
+import logging
+import math
+import socket
+import time
+from dataclasses import asdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from kombu import Connection, Exchange, Queue
+
+from data.archiver.archiver import Archiver
+from data.archiver.aws_s3_client import AwsS3
+from data.archiver.config import FANOUT_BATCH_BYTES, FANOUT_BATCH_FILES, FANOUT_TIMEOUT, WORK_DONE_ROUTING_KEY
+from data.archiver.dataclass import DataArchiverRequest, DataArchiverResult, FileResult, QueueConfig, WorkItem
+from data.archiver.ingest_api import Ingest
+from data.archiver.jobs import JobStore, DONE, FAILED, job_id
+
+
+def split_batches(files: List[FileResult], batch_bytes=FANOUT_BATCH_BYTES, batch_files=FANOUT_BATCH_FILES) \
+        -> List[List[FileResult]]:
+    """
+    split files into enough batches for each to hold about batch_bytes and batch_files,
+    balanced by size: largest first to the batch with the fewest bytes.
+    """
+    if not files:
+        return []
+    total = sum(file.size for file in files)
+    count = max(math.ceil(total / batch_bytes) if batch_bytes else 1,
+                math.ceil(len(files) / batch_files) if batch_files else 1, 1)
+    count = min(count, len(files))
+    batches = [[] for _ in range(count)]
+    loads = [(0, n) for n in range(count)]
+    for file in sorted(files, key=lambda f: f.size, reverse=True):
+        load, n = heapq.heappop(loads)
+        batches[n].append(file)
+        heapq.heappush(loads, (load + file.size, n))
+    return batches
+
+
+class FanOut:
+    """
+    Archives a request by splitting its files into size balanced batches published as work
+    items on the work queue, so any archiver listening on it takes a share, and merging
+    the result of each batch back into one result for the request.
+
+    Results come back on a durable queue of the job bound to WORK_DONE_ROUTING_KEY.<job id>,
+    deleted once the job is finished. Files of batches without a result after timeout
+    seconds are failed.
+
+    With a job store, the batches and the result of each are recorded, so a request
+    redelivered after a restart waits for the results of the batches still outstanding,
+    kept on the queue meanwhile, rather than archiving the submission again.
+    """
+
+    def __init__(self, connection: Connection, work_queue_config: QueueConfig, ingest_cli: Ingest,
+                 aws_cli: AwsS3, batch_bytes=FANOUT_BATCH_BYTES, batch_files=FANOUT_BATCH_FILES,
+                 timeout=FANOUT_TIMEOUT, jobs: JobStore = None):
+        self.connection = connection
+        self.work_queue_config = work_queue_config
+        self.exchange = Exchange(work_queue_config.exchange, work_queue_config.exchange_type)
+        self.ingest_cli = ingest_cli
+        self.aws_cli = aws_cli
+        self.batch_bytes = batch_bytes
+        self.batch_files = batch_files
+        self.timeout = timeout
+        self.jobs = jobs
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    def files(self, req: DataArchiverRequest) -> DataArchiverResult:
+        """
+        the files of the request with their S3 sizes.
+        """
+        res = Archiver(self.ingest_cli, self.aws_cli).submission_files(req)
+        if res.files:
+            self.aws_cli.metadata.resolve_files(res.files)
+        return res
+
+    def run(self, req: DataArchiverRequest) -> DataArchiverResult:
+        res, batches, outstanding = self.resume(req)
+        resumed = res is not None
+        if not resumed:
+            res = self.files(req)
+            batches = split_batches([file for file in res.files if file.success], self.batch_bytes,
+                                    self.batch_files)
+            outstanding = set(range(len(batches)))
+            if not batches:
+                res.update_status()
+                return res
+
+        job = job_id(req)
+        reply_to = f'{WORK_DONE_ROUTING_KEY}.{job}'
+        results: Dict[int, DataArchiverResult] = {}
+
+        def on_result(body, msg):
+            n = body['batch']
+            if n in outstanding:
+                results[n] = DataArchiverResult.from_dict(body['result'])
+                self.record(req, batches[n], results[n])
+                self.logger.info(f'Batch {n} of job {job} done, {len(results)}/{len(outstanding)}')
+            msg.ack()
+
+        with self.connection.clone() as conn:
+            results_queue = Queue(f'{reply_to}.queue', self.exchange, reply_to, durable=True, auto_delete=False)
+            with conn.Consumer(results_queue, callbacks=[on_result], accept=['json']):
+                if not resumed:
+                    # recorded first, so a restart finds the job of every batch published
+                    if self.jobs:
+                        self.jobs.start(req, res, [[file.uuid for file in batch] for batch in batches])
+                    self.publish(conn, req, job, batches, reply_to)
+                else:
+                    self.logger.info(f'Resuming job {job}, waiting for {len(outstanding)} of {len(batches)} '
+                                     f'batches')
+                deadline = time.monotonic() + self.timeout
+                while len(results) < len(outstanding) and time.monotonic() < deadline:
+                    try:
+                        conn.drain_events(timeout=1)
+                    except socket.timeout:
+                        pass
+            res = self.merge(res, batches, results, outstanding)
+            if self.jobs:
+                self.jobs.finish(req, res)
+            results_queue.bind(conn).delete()
+        return res
+
+    def publish(self, conn: Connection, req: DataArchiverRequest, job, batches: List[List[FileResult]], reply_to):
+        self.logger.info(f'Fanning out {sum(map(len, batches))} files of submission {req.sub_uuid} '
+                         f'in {len(batches)} batches, job {job}')
+        producer = conn.Producer()
+        for n, batch in enumerate(batches):
+            item = WorkItem(job, req.sub_uuid, n, [file.uuid for file in batch], reply_to, req.stream, req.engine)
+            producer.publish(asdict(item), exchange=self.exchange, routing_key=self.work_queue_config.routing_key,
+                             serializer='json', declare=[self.exchange], retry=True)
+
+    def resume(self, req: DataArchiverRequest) -> Tuple[Optional[DataArchiverResult], List[List[FileResult]], Set[int]]:
+        """
+        the result, batches and outstanding batches of the request's job if it is still
+        running, (None, [], set()) if there is none.
+        """
+        files = self.jobs.resume(req) if self.jobs else None
+        job = self.jobs.get_job(job_id(req)) if files else None
+        if not job or not job.batches:
+            return None, [], set()
+        res = DataArchiverResult(req.sub_uuid, files=[file.result() for file in files])
+        for file, result in zip(files, res.files):
+            if file.state == FAILED:
+                # not archived again, only waited for
+                result.success = False
+                result.error = file.error
+        by_uuid = {file.uuid: file for file in res.files}
+        states = {file.uuid: file.state for file in files}
+        batches = [[by_uuid[uuid] for uuid in batch] for batch in job.batches]
+        outstanding = {n for n, batch in enumerate(job.batches)
+                       if any(states[uuid] not in (DONE, FAILED) for uuid in batch)}
+        return res, batches, outstanding
+
+    def record(self, req: DataArchiverRequest, batch: List[FileResult], result: DataArchiverResult):
+        """
+        record the files of a batch once its result is in, before it is acknowledged.
+        """
+        self.merge_batch(batch, result)
+        if self.jobs:
+            for file in batch:
+                self.jobs.update(req, file, DONE if file.success else FAILED)
+
+    def merge(self, res: DataArchiverResult, batches: List[List[FileResult]],
+              results: Dict[int, DataArchiverResult], outstanding: Set[int]) -> DataArchiverResult:
+        """
+        res with the files of the outstanding batches without a result failed, the others
+        are merged as their results come in.
+        """
+        for n in outstanding - set(results):
+            self.merge_batch(batches[n], None)
+        res.update_status()
+        return res
+
+    @staticmethod
+    def merge_batch(batch: List[FileResult], result: Optional[DataArchiverResult]):
+        archived = {file.uuid: file for file in result.files} if result else {}
+        for file in batch:
+            if file.uuid in archived:
+                vars(file).update(vars(archived[file.uuid]))
+            else:
+                file.success = False
+                file.error = (result.error if result else None) or 'No result from the archiver of its batch.'
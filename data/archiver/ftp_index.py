@@ -0,0 +1,132 @@
+import ftplib
+import posixpath
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from data.archiver.config import FTP_INDEX_TTL
+
+
+@dataclass
+class RemoteEntry:
+    name: str
+    is_dir: bool
+    # None if unknown, e.g. a directory or a listing without sizes
+    size: Optional[int] = field(default=None)
+
+
+@dataclass
+class _Listing:
+    entries: Dict[str, RemoteEntry]
+    expires: float
+
+
+class RemoteIndex:
+    """
+    In-memory index of the remote FTP tree. Each directory is listed once (MLSD, falling
+    back to LIST on servers without it) and kept for ttl seconds, so existence and size
+    checks are dict lookups instead of a LIST per check. The index is updated by our own
+    MKD and STOR so it stays current without listing again.
+
+    Directories are keyed by host, port and absolute path. The working directory of each
+    connection is tracked here so relative names can be resolved without a PWD per lookup,
+    connections must change directory through chdir()/set_cwd() for this to hold.
+    """
+
+    def __init__(self, ttl=FTP_INDEX_TTL):
+        self.ttl = ttl
+        self._listings: Dict[tuple, _Listing] = {}
+        self._cwd = weakref.WeakKeyDictionary()
+        self._no_mlsd = set()
+        self._lock = threading.Lock()
+
+    def cwd(self, ftp) -> str:
+        with self._lock:
+            path = self._cwd.get(ftp)
+        if path is None:
+            path = ftp.pwd()
+            self.set_cwd(ftp, path)
+        return path
+
+    def set_cwd(self, ftp, path):
+        with self._lock:
+            self._cwd[ftp] = path
+
+    def chdir(self, ftp, dir):
+        path = posixpath.normpath(posixpath.join(self.cwd(ftp), dir))
+        ftp.cwd(dir)
+        self.set_cwd(ftp, path)
+
+    def lookup(self, ftp, name) -> Optional[RemoteEntry]:
+        return self.entries(ftp).get(name)
+
+    def entries(self, ftp) -> Dict[str, RemoteEntry]:
+        key = (ftp.host, ftp.port, self.cwd(ftp))
+        with self._lock:
+            listing = self._listings.get(key)
+        if listing and listing.expires > time.monotonic():
+            return listing.entries
+        entries = self._list(ftp)
+        with self._lock:
+            self._listings[key] = _Listing(entries, time.monotonic() + self.ttl)
+        return entries
+
+    def add(self, ftp, name, is_dir=False, size=None):
+        """
+        record a directory or file we created in the current directory.
+        """
+        key = (ftp.host, ftp.port, self.cwd(ftp))
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing:
+                listing.entries[name] = RemoteEntry(name, is_dir, size)
+
+    def invalidate(self, ftp):
+        key = (ftp.host, ftp.port, self.cwd(ftp))
+        with self._lock:
+            self._listings.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._listings = {}
+
+    def _list(self, ftp) -> Dict[str, RemoteEntry]:
+        if (ftp.host, ftp.port) not in self._no_mlsd:
+            try:
+                return self._mlsd(ftp)
+            except ftplib.error_perm:
+                # 500/502 command not implemented
+                self._no_mlsd.add((ftp.host, ftp.port))
+        return self._list_unix(ftp)
+
+    @staticmethod
+    def _mlsd(ftp) -> Dict[str, RemoteEntry]:
+        entries = {}
+        for name, facts in ftp.mlsd(facts=['type', 'size']):
+            kind = facts.get('type', '').lower()
+            if kind in ('cdir', 'pdir'):
+                continue
+            size = facts.get('size')
+            entries[name] = RemoteEntry(name, kind == 'dir', int(size) if size and size.isdigit() else None)
+        return entries
+
+    @staticmethod
+    def _list_unix(ftp) -> Dict[str, RemoteEntry]:
+        lines = []
+        ftp.retrlines('LIST', lines.append)
+        entries = {}
+        for line in lines:
+            parts = line.split(None, 8)
+            if len(parts) < 9:
+                continue
+            name = parts[8]
+            is_dir = line.upper().startswith('D')
+            size = int(parts[4]) if parts[4].isdigit() and not is_dir else None
+            entries[name] = RemoteEntry(name, is_dir, size)
+        return entries
+
+
+# shared by all connections in the process
+remote_index = RemoteIndex()
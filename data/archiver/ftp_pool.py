@@ -0,0 +1,168 @@
+import ftplib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from ftplib import FTP, FTP_TLS
+
+from data.archiver.config import ENA_FTP_HOST, ENA_FTP_PORT, ENA_WEBIN_USER, ENA_WEBIN_PWD, FTP_POOL_SIZE, \
+    FTP_POOL_MAX_IDLE, FTP_POOL_MAX_AGE, FTP_POOL_CHECK_AFTER
+from data.archiver.ftp_index import remote_index
+
+FTP_TIMEOUT = 60 * 60 * 2  # 2h
+
+
+@dataclass
+class _PooledConnection:
+    ftp: FTP
+    # login directory, borrowers may cwd anywhere so it is restored on return
+    home: str
+    created: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class _HostPool:
+
+    def __init__(self, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+class FtpConnectionPool:
+    """
+    Bounded, thread-safe pool of logged in FTP control connections, shared by all uploads
+    so a connection stays logged in across files and across requests.
+
+    - at most max_per_host connections per host/user are borrowed at any time,
+      further borrowers block until one is returned.
+    - connections idle for more than check_after seconds are checked with NOOP before reuse.
+    - connections idle for more than max_idle seconds are closed.
+    - connections older than max_age seconds are closed instead of being returned or
+      borrowed.
+    - a connection is discarded rather than returned if the borrower raised, as the
+      control connection may be left mid transfer.
+    """
+
+    def __init__(self, max_per_host=FTP_POOL_SIZE, max_idle=FTP_POOL_MAX_IDLE, max_age=FTP_POOL_MAX_AGE,
+                 check_after=FTP_POOL_CHECK_AFTER, timeout=FTP_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.check_after = check_after
+        self.timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    @contextmanager
+    def connection(self, host=None, port=None, user=None, pwd=None, secure=False):
+        key = (host or ENA_FTP_HOST, port or ENA_FTP_PORT, user or ENA_WEBIN_USER, pwd or ENA_WEBIN_PWD, secure)
+        pool = self._host_pool(key)
+        pool.slots.acquire()
+        conn = None
+        try:
+            conn = self._borrow(key, pool)
+            yield conn.ftp
+        except BaseException:
+            if conn:
+                self._close(conn, graceful=False)
+            raise
+        else:
+            self._return(pool, conn)
+        finally:
+            pool.slots.release()
+
+    def evict_idle(self):
+        """
+        close pooled connections idle or open for too long, run before each borrow.
+        """
+        now = time.monotonic()
+        with self._lock:
+            pools = list(self._hosts.values())
+        for pool in pools:
+            with pool.lock:
+                expired = [c for c in pool.idle if now - c.last_used > self.max_idle or self._expired(c, now)]
+                pool.idle = [c for c in pool.idle if c not in expired]
+            for conn in expired:
+                self._close(conn)
+
+    def close(self):
+        with self._lock:
+            pools = list(self._hosts.values())
+            self._hosts = {}
+        for pool in pools:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn in idle:
+                self._close(conn)
+
+    def _host_pool(self, key) -> _HostPool:
+        with self._lock:
+            if key not in self._hosts:
+                self._hosts[key] = _HostPool(self.max_per_host)
+            return self._hosts[key]
+
+    def _borrow(self, key, pool: _HostPool) -> _PooledConnection:
+        self.evict_idle()
+        while 1:
+            with pool.lock:
+                conn = pool.idle.pop() if pool.idle else None
+            if not conn:
+                return self._connect(*key)
+            if time.monotonic() - conn.last_used < self.check_after or self._healthy(conn):
+                return conn
+            self._close(conn, graceful=False)
+
+    def _return(self, pool: _HostPool, conn: _PooledConnection):
+        now = time.monotonic()
+        if self._expired(conn, now):
+            self._close(conn)
+            return
+        try:
+            conn.ftp.cwd(conn.home)
+            remote_index.set_cwd(conn.ftp, conn.home)
+        except ftplib.all_errors:
+            self._close(conn, graceful=False)
+            return
+        conn.last_used = now
+        with pool.lock:
+            pool.idle.append(conn)
+
+    def _connect(self, host, port, user, pwd, secure) -> _PooledConnection:
+        self.logger.info(f'Opening FTP connection to {host}:{port}')
+        ftp = FTP_TLS(timeout=self.timeout) if secure else FTP(timeout=self.timeout)
+        ftp.connect(host, port)
+        ftp.login(user, pwd)
+        if secure:
+            ftp.prot_p()
+        home = ftp.pwd()
+        remote_index.set_cwd(ftp, home)
+        return _PooledConnection(ftp, home)
+
+    def _expired(self, conn: _PooledConnection, now):
+        return now - conn.created > self.max_age
+
+    @staticmethod
+    def _healthy(conn: _PooledConnection):
+        try:
+            conn.ftp.voidcmd('NOOP')
+            return True
+        except ftplib.all_errors:
+            return False
+
+    @staticmethod
+    def _close(conn: _PooledConnection, graceful=True):
+        try:
+            if graceful:
+                conn.ftp.quit()
+        except ftplib.all_errors:
+            pass
+        finally:
+            conn.ftp.close()
+
+
+# shared by all uploaders in the process
+ftp_pool = FtpConnectionPool()
@@ -1,72 +1,81 @@
 import os
-import logging
-from ftplib import FTP, FTP_TLS
-from data.archiver.config import ENA_FTP_HOST, ENA_WEBIN_USER, ENA_WEBIN_PWD, ENA_FTP_DIR
-from data.archiver.dataclass import DataArchiverResult
+import ftplib
+from data.archiver import metrics
+from data.archiver.config import FTP_BLOCK_SIZE
+from data.archiver.ftp_index import remote_index
 
 
 class FtpUploader:
-    def __init__(self, res:DataArchiverResult, secure=False):
-        self.res = res
-        self.secure = secure
-        if secure:
-            self.ftp = FTP_TLS(ENA_FTP_HOST, ENA_WEBIN_USER, ENA_WEBIN_PWD)
-            self.ftp.prot_p()
-        else:
-            self.ftp = FTP(ENA_FTP_HOST, ENA_WEBIN_USER, ENA_WEBIN_PWD)
-        FtpUploader.chdir(self.ftp, ENA_FTP_DIR)
-        FtpUploader.chdir(self.ftp, res.sub_uuid)
-        
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.INFO)
+    """
+    FTP helpers for the ENA upload area, on a connection borrowed from ftp_pool.
+    """
 
-    def ftp_stor(self, file):
-        with open(file, "rb") as f:
-            self.ftp.storbinary(f'STOR {os.path.basename(file)}', f, 1024)
-
-    def upload(self):
-        for f in self.res.files:
-            if f.success:
-                try:
-                    self.logger.info(f'Uploading {f.file_name}')
-                    self.ftp_stor(f'{self.res.sub_uuid}/{f.file_name}')
-                    self.logger.info(f'Uploading {f.file_name}.md5')
-                    self.ftp_stor(f'{self.res.sub_uuid}/{f.file_name}.md5')
-                except:
-                    f.success = False
-                    f.error = 'FTP upload error'
-
-    def close(self):
-        self.ftp.close()
+    @staticmethod
+    def stor(ftp, file, blocksize=FTP_BLOCK_SIZE, use_sendfile=False):
+        with open(file, "rb") as f, metrics.timed('local_ftp_send'):
+            if use_sendfile and not isinstance(ftp, ftplib.FTP_TLS):
+                FtpUploader.sendfile(ftp, f'STOR {os.path.basename(file)}', f)
+            else:
+                ftp.storbinary(f'STOR {os.path.basename(file)}', f, blocksize)
+        remote_index.add(ftp, os.path.basename(file), size=os.path.getsize(file))
+        metrics.BYTES_SENT.labels('local').inc(os.path.getsize(file))
 
+    @staticmethod
+    def sendfile(ftp, cmd, f):
+        """
+        storbinary with the data sent by socket.sendfile, which uses sendfile(2) where
+        available and falls back to send() elsewhere.
+        """
+        ftp.voidcmd('TYPE I')
+        with ftp.transfercmd(cmd) as conn:
+            conn.sendfile(f)
+        return ftp.voidresp()
 
     @staticmethod
     def chdir(ftp, dir): 
         FtpUploader.mk_dir(ftp, dir)
-        ftp.cwd(dir)
+        try:
+            remote_index.chdir(ftp, dir)
+        except ftplib.error_perm:
+            # removed since the directory was listed
+            remote_index.invalidate(ftp)
+            FtpUploader.mk_dir(ftp, dir)
+            remote_index.chdir(ftp, dir)
 
     @staticmethod
     def mk_dir(ftp, dir):
         if not FtpUploader.dir_exists(ftp, dir):
-            ftp.mkd(dir)
+            try:
+                ftp.mkd(dir)
+            except ftplib.error_perm:
+                # created by another connection since the directory was listed
+                remote_index.invalidate(ftp)
+                if not FtpUploader.dir_exists(ftp, dir):
+                    raise
+            remote_index.add(ftp, dir, is_dir=True)
 
     @staticmethod
     def dir_exists(ftp, dir):
-        fs = []
-        ftp.retrlines('LIST', fs.append)
-        for f in fs:
-            if f.split()[-1] == dir and f.upper().startswith('D'):
-                return True
-        return False
+        entry = remote_index.lookup(ftp, dir)
+        return entry is not None and entry.is_dir
 
     @staticmethod
     def file_exists(ftp, file):
-        fs = []
-        ftp.retrlines('LIST', fs.append)
-        for f in fs:
-            if not f.upper().startswith('D') and f.split()[-1] == file:
-                return True
-        return False
+        entry = remote_index.lookup(ftp, file)
+        return entry is not None and not entry.is_dir
+
+    @staticmethod
+    def indexed_file_size(ftp, file):
+        """
+        size from the cached directory index, None if the file is not there.
+        falls back to SIZE if the listing did not include sizes.
+        """
+        entry = remote_index.lookup(ftp, file)
+        if entry is None or entry.is_dir:
+            return None
+        if entry.size is None:
+            return FtpUploader.file_size(ftp, file)
+        return entry.size
 
     @staticmethod
     def file_size(ftp, file):
@@ -74,4 +83,4 @@ class FtpUploader:
             return ftp.size(file)
         except Exception as ex:
             #self.logger.error(f'Exception in ftp.file_size: {ex}')
-            return None
\ No newline at end of file
+            return None
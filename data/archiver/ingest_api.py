@@ -6,9 +6,20 @@ from urllib.error import HTTPError
 import requests
 import functools
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from data.archiver.config import INGEST_API
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from requests.adapters import HTTPAdapter
+from data.archiver.config import INGEST_API, INGEST_PAGE_SIZE, INGEST_CONCURRENCY, INGEST_PATCH_CONCURRENCY, \
+    INGEST_PATCH_RETRIES, INGEST_PATCH_BACKOFF
 from data.archiver.dataclass import FileResult
+from data.archiver.trace import RequestTrace
+
+RETRY_STATUS = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.BAD_GATEWAY,
+                HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT)
 
 def handle_exception(f):
     @functools.wraps(f)
@@ -20,10 +31,23 @@ def handle_exception(f):
             return []
     return func
 
+def with_params(url, **params):
+    parts = urlparse(url)
+    query = dict(parse_qsl(parts.query))
+    query.update({k: str(v) for k, v in params.items()})
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
 class Ingest:
 
-    def __init__(self):
+    def __init__(self, page_size=INGEST_PAGE_SIZE, concurrency=INGEST_CONCURRENCY):
+        self.page_size = page_size
+        self.concurrency = concurrency
         self.session = requests.Session()
+        # pages are fetched concurrently over the same pooled connections
+        adapter = HTTPAdapter(pool_maxsize=max(concurrency, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -44,57 +68,106 @@ class Ingest:
             self.get_submission(uuid)
         files_url = self.submission['_links']['files']['href']
         self.logger.info(f'Files url {files_url}')
-        self.files = self.get_all(files_url, "files", [])
+        self.files = self.get_all(files_url, "files")
         return self.files
 
     @handle_exception
-    def get_sequence_files(self, uuid):
-        if not self.files:
-            self.get_files(uuid)
+    def get_sequence_files(self, uuid, file_uuids=None):
+        """
+        with file_uuids, paging stops as soon as all of those files have been found.
+        """
+        wanted = set(file_uuids or [])
         self.s3_files = []
 
-        for file in self.files:
+        for file in self.iter_sequence_files(uuid):
+            self.s3_files.append(file)
+            wanted.discard(file['uuid'])
+            if file_uuids and not wanted:
+                break
+        return self.s3_files
+
+    def iter_sequence_files(self, uuid):
+        """
+        yields the sequence files of the submission page by page, as the pages arrive.
+        """
+        files = self.files
+        if files is None:
+            if not self.submission:
+                self.get_submission(uuid)
+            files = self.iter_all(self.submission['_links']['files']['href'], "files")
+
+        for file in files:
             if (file['content']['describedBy']).endswith('sequence_file'):
                 uuid = file['uuid']['uuid']
                 file_name = file['content']['file_core']['file_name']
                 cloud_url = file['cloudUrl']
-                self.s3_files.append({"uuid": uuid, "file_name": file_name, "cloud_url": cloud_url})
-    
-        return self.s3_files
+                self_url = file.get('_links', {}).get('self', {}).get('href')
+                yield {"uuid": uuid, "file_name": file_name, "cloud_url": cloud_url, "ingest_url": self_url}
 
     def get_staging_area(self):
         if self.submission and self.submission['stagingDetails']:
             return self.submission['stagingDetails']['stagingAreaLocation']['value']
         return None
 
-    def get_all(self, url, entity_type, entities=[]):
+    def get_all(self, url, entity_type, entities=None):
+        entities = [] if entities is None else entities
+        entities.extend(self.iter_all(url, entity_type))
+        return entities
+
+    def iter_all(self, url, entity_type):
+        for page in self.iter_pages(url, entity_type):
+            yield from page
+
+    def iter_pages(self, url, entity_type):
+        """
+        yields the entities of each page in order. if the first page has the total number
+        of pages, the rest are fetched concurrently with up to 2 * concurrency pages ahead,
+        otherwise the next links are followed one by one.
+        """
+        json_response = self._get_json(with_params(url, size=self.page_size))
+        yield json_response.get("_embedded", {}).get(entity_type, [])
+
+        page = json_response.get("page")
+        if not page or "totalPages" not in page:
+            while "next" in json_response.get("_links", {}):
+                json_response = self._get_json(json_response["_links"]["next"]["href"])
+                yield json_response.get("_embedded", {}).get(entity_type, [])
+            return
+
+        # the server may cap the page size, the page numbers are in its size
+        urls = (with_params(url, page=n, size=page.get("size", self.page_size))
+                for n in range(page.get("number", 0) + 1, page["totalPages"]))
+        pending = deque()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            try:
+                for page_url in urls:
+                    pending.append(executor.submit(self._get_json, page_url))
+                    if len(pending) >= 2 * self.concurrency:
+                        yield pending.popleft().result().get("_embedded", {}).get(entity_type, [])
+                while pending:
+                    yield pending.popleft().result().get("_embedded", {}).get(entity_type, [])
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _get_json(self, url):
         response = self.session.get(url)
         response.raise_for_status()
-        json_response = response.json()
-        if "_embedded" in json_response:
-            entities += json_response["_embedded"][entity_type]
-
-            if "next" in json_response["_links"]:
-                url = json_response["_links"]["next"]["href"]
-                self.get_all(url, entity_type, entities)
-        return entities
+        return response.json()
 
     def patch_files(self, files: [FileResult]):
-        for file in files:
-            if not file.success:
-                continue
-            params = {'uuid': file.uuid}
-            response = self.session.get(f'{INGEST_API}files/search/findByUuid', params=params)
-            if response.status_code == HTTPStatus.OK:
-                file_url = response.json()["_links"]["self"]["href"]
-                archive_result = Ingest.archive_result_from_filemeta(file)
-                patch_response = self.session.patch(file_url, json.dumps(archive_result), headers={ 'Content-type':'application/json' })
-                if patch_response.status_code == HTTPStatus.ACCEPTED:
-                    self.logger.info(f"Patched {file_url} {archive_result}")
-                else:
-                    self.logger.info(f"Could not patch {file_url}: {patch_response.status_code} ")
-            else:
-                self.logger.info(f"Could not get {file_url}: {response.status_code} ")
+        reporter = ResultReporter(self)
+        reporter.report_all(files)
+        reporter.close()
+
+    def file_url(self, uuid):
+        response = self.session.get(f'{INGEST_API}files/search/findByUuid', params={'uuid': uuid})
+        response.raise_for_status()
+        return response.json()["_links"]["self"]["href"]
+
+    def patch_file(self, file_url, file: FileResult):
+        archive_result = Ingest.archive_result_from_filemeta(file)
+        return self.session.patch(file_url, json.dumps(archive_result), headers={ 'Content-type':'application/json' })
 
     @staticmethod
     def archive_result_from_filemeta(file):
@@ -109,4 +182,85 @@ class Ingest:
         }
 
     def close(self):
-        self.session.close()
\ No newline at end of file
+        self.session.close()
+
+
+class ResultReporter:
+    """
+    Patches the archive result of each file back to Ingest as soon as it is reported,
+    with up to `workers` PATCHes in flight. Files keep the self link from the listing so
+    no lookup is needed, files without one are looked up by uuid. Failed PATCHes are
+    retried on connection errors and 429/5xx responses with exponential backoff.
+
+    Each file is patched once, only successful files are patched.
+    """
+
+    def __init__(self, ingest_cli: Ingest, workers=INGEST_PATCH_CONCURRENCY, retries=INGEST_PATCH_RETRIES,
+                 backoff=INGEST_PATCH_BACKOFF, trace: RequestTrace = None):
+        self.ingest_cli = ingest_cli
+        self.trace = trace or RequestTrace()
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(workers)
+        self.futures = []
+        self.reported = set()
+        self.patched = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    def report(self, file: FileResult):
+        if not file.success:
+            return
+        with self.lock:
+            if file.uuid in self.reported:
+                return
+            self.reported.add(file.uuid)
+            self.futures.append(self.executor.submit(self.patch, file))
+
+    def report_all(self, files: [FileResult]):
+        for file in files:
+            self.report(file)
+
+    def close(self):
+        """
+        wait for all reported files to be patched.
+        """
+        wait(self.futures)
+        self.executor.shutdown()
+        self.logger.info(f'Patched {self.patched} files, {self.failed} failed.')
+
+    def patch(self, file: FileResult):
+        with self.trace.span('patch', file=file.file_name) as span:
+            span.attrs['retries'], span.attrs['success'] = self._patch(file)
+
+    def _patch(self, file: FileResult):
+        """
+        returns the number of retries and whether the patch succeeded.
+        """
+        attempt = 0
+        while 1:
+            try:
+                file_url = file.ingest_url or self.ingest_cli.file_url(file.uuid)
+                response = self.ingest_cli.patch_file(file_url, file)
+                if response.status_code not in RETRY_STATUS:
+                    break
+                error = response.status_code
+            except requests.RequestException as ex:
+                response = None
+                error = ex
+            attempt += 1
+            if attempt > self.retries:
+                break
+            self.logger.info(f'Retrying patch of {file.uuid} ({attempt}/{self.retries}): {error}')
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        with self.lock:
+            if response is not None and response.ok:
+                self.patched += 1
+                self.logger.info(f"Patched {file_url} {file.uuid}")
+            else:
+                self.failed += 1
+                self.logger.info(f"Could not patch {file.uuid}: {response.status_code if response is not None else error}")
+        return min(attempt, self.retries), response is not None and response.ok
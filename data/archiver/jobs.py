@@ -0,0 +1,389 @@
+import abc
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+from dataclasses import dataclass, field, fields, astuple
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from data.archiver.config import JOB_STORE, JOB_STORE_PATH
+from data.archiver.dataclass import DataArchiverRequest, DataArchiverResult, FileResult
+
+# job states
+RUNNING = 'running'
+# file states, done and failed are job states as well
+PENDING = 'pending'
+TRANSFERRING = 'transferring'
+DONE = 'done'
+FAILED = 'failed'
+FILE_STATES = (PENDING, TRANSFERRING, DONE, FAILED)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    sub_uuid TEXT NOT NULL,
+    files TEXT NOT NULL,
+    state TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    batches TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_sub_uuid ON jobs (sub_uuid);
+CREATE TABLE IF NOT EXISTS files (
+    job_id TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    state TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    cloud_url TEXT NOT NULL,
+    ingest_url TEXT,
+    size INTEGER NOT NULL,
+    output TEXT,
+    md5 TEXT,
+    ena_upload_path TEXT,
+    compressed INTEGER NOT NULL,
+    error TEXT,
+    updated_at TEXT NOT NULL,
+    checksums TEXT,
+    PRIMARY KEY (job_id, uuid)
+);
+'''
+
+
+def _utcnow():
+    return datetime.utcnow().isoformat(timespec='seconds')
+
+
+def job_id(req: DataArchiverRequest):
+    """
+    the submission uuid, with a digest of the requested files if only some are archived, so
+    batches of the same submission are separate jobs.
+    """
+    if not req.files:
+        return req.sub_uuid
+    digest = hashlib.sha1(' '.join(sorted(req.files)).encode('utf-8')).hexdigest()[:12]
+    return f'{req.sub_uuid}:{digest}'
+
+
+@dataclass
+class Job:
+    job_id: str
+    sub_uuid: str
+    # requested file uuids, empty for all files of the submission
+    files: List[str]
+    # running, done or failed
+    state: str = field(default=RUNNING)
+    started_at: str = field(default_factory=_utcnow)
+    updated_at: str = field(default_factory=_utcnow)
+    # file uuids of each batch if fanned out
+    batches: List[List[str]] = field(default_factory=list)
+
+
+@dataclass
+class FileState:
+    job_id: str
+    uuid: str
+    state: str
+    # as listed in Ingest
+    file_name: str
+    cloud_url: str
+    ingest_url: str = field(default=None)
+    size: int = field(default=0)
+    # archived file name, i.e. the .gz if compressed while archiving
+    output: str = field(default=None)
+    md5: str = field(default=None)
+    ena_upload_path: str = field(default=None)
+    compressed: bool = field(default=False)
+    error: str = field(default=None)
+    updated_at: str = field(default_factory=_utcnow)
+    # hex digests of the archived file by algorithm
+    checksums: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def listed(cls, job_id, file: FileResult):
+        return cls(job_id, file.uuid, PENDING if file.success else FAILED, file.file_name, file.cloud_url,
+                   file.ingest_url, error=file.error)
+
+    def update(self, file: FileResult, state):
+        self.state = state
+        self.size = file.size
+        self.output = file.file_name
+        self.md5 = file.md5
+        self.ena_upload_path = file.ena_upload_path
+        self.compressed = file.compressed
+        self.error = file.error
+        self.checksums = dict(file.checksums)
+        self.updated_at = _utcnow()
+
+    def result(self) -> FileResult:
+        """
+        the archived file if done, the file as listed in Ingest to be archived again otherwise.
+        """
+        if self.state == DONE:
+            return FileResult(self.uuid, self.output, self.cloud_url, self.size, self.compressed, self.md5,
+                              self.ena_upload_path, ingest_url=self.ingest_url, checksums=dict(self.checksums))
+        if not self.cloud_url:
+            # not found in Ingest
+            return FileResult(self.uuid, self.file_name, self.cloud_url, success=False, error=self.error)
+        return FileResult(self.uuid, self.file_name, self.cloud_url, ingest_url=self.ingest_url)
+
+
+class JobStore(abc.ABC):
+    """
+    Persistent state of archiving jobs and of each of their files: pending, transferring,
+    done or failed, with the output, md5 and size of the files archived. A request
+    redelivered while its job is still running resumes from the files not done, without
+    listing them in Ingest again.
+
+    Backends store jobs and file states, see SqliteJobStore.
+    """
+
+    @abc.abstractmethod
+    def get_job(self, job_id) -> Optional[Job]:
+        pass
+
+    @abc.abstractmethod
+    def get_jobs(self, sub_uuid=None, state=None) -> List[Job]:
+        pass
+
+    @abc.abstractmethod
+    def get_files(self, job_id) -> List[FileState]:
+        pass
+
+    @abc.abstractmethod
+    def save(self, job: Job, files: List[FileState] = None):
+        """
+        save the job, replacing all its files if given.
+        """
+
+    @abc.abstractmethod
+    def save_file(self, file: FileState):
+        pass
+
+    def close(self):
+        pass
+
+    def resume(self, req: DataArchiverRequest) -> Optional[List[FileState]]:
+        """
+        the files of the request's job if it is still running.
+        """
+        job = self.get_job(job_id(req))
+        if not job or job.state != RUNNING:
+            return None
+        return self.get_files(job.job_id)
+
+    def start(self, req: DataArchiverRequest, res: DataArchiverResult, batches: List[List[str]] = None):
+        job = Job(job_id(req), req.sub_uuid, list(req.files), batches=batches or [])
+        self.save(job, [FileState.listed(job.job_id, file) for file in res.files])
+
+    def update(self, req: DataArchiverRequest, file: FileResult, state):
+        files = {f.uuid: f for f in self.get_files(job_id(req))}
+        entry = files.get(file.uuid) or FileState.listed(job_id(req), file)
+        entry.update(file, state)
+        self.save_file(entry)
+
+    def finish(self, req: DataArchiverRequest, res: DataArchiverResult):
+        job = self.get_job(job_id(req))
+        if job:
+            job.state = DONE if res.success else FAILED
+            job.updated_at = _utcnow()
+            self.save(job)
+
+    def progress(self, job_id) -> Dict[str, List[int]]:
+        """
+        [files, bytes] by file state.
+        """
+        progress = {state: [0, 0] for state in FILE_STATES}
+        for file in self.get_files(job_id):
+            progress[file.state][0] += 1
+            progress[file.state][1] += file.size
+        return progress
+
+
+class SqliteJobStore(JobStore):
+
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if not self._conn:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # a commit per file state, without waiting for each to be synced
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            # job stores created before these were kept
+            for table, column in (('files', 'checksums'), ('jobs', 'batches')):
+                if column not in [row[1] for row in self._conn.execute(f'PRAGMA table_info({table})')]:
+                    self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+        return self._conn
+
+    @staticmethod
+    def _job(row):
+        job = Job(*row)
+        job.files = json.loads(job.files)
+        job.batches = json.loads(job.batches) if job.batches else []
+        return job
+
+    @staticmethod
+    def _job_row(job: Job):
+        return astuple(job)[:2] + (json.dumps(job.files),) + astuple(job)[3:-1] + (json.dumps(job.batches),)
+
+    @staticmethod
+    def _file(row):
+        file = FileState(*row)
+        file.compressed = bool(file.compressed)
+        file.checksums = json.loads(file.checksums) if file.checksums else {}
+        return file
+
+    @staticmethod
+    def _file_row(file: FileState):
+        return astuple(file)[:-1] + (json.dumps(file.checksums),)
+
+    def get_job(self, job_id) -> Optional[Job]:
+        with self._lock:
+            row = self._connection().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def get_jobs(self, sub_uuid=None, state=None) -> List[Job]:
+        query, params = 'SELECT * FROM jobs WHERE 1 = 1', []
+        if sub_uuid:
+            query += ' AND sub_uuid = ?'
+            params.append(sub_uuid)
+        if state:
+            query += ' AND state = ?'
+            params.append(state)
+        with self._lock:
+            rows = self._connection().execute(f'{query} ORDER BY started_at', params).fetchall()
+        return list(map(self._job, rows))
+
+    def get_files(self, job_id) -> List[FileState]:
+        with self._lock:
+            rows = self._connection().execute('SELECT * FROM files WHERE job_id = ? ORDER BY rowid',
+                                              (job_id,)).fetchall()
+        return list(map(self._file, rows))
+
+    def save(self, job: Job, files: List[FileState] = None):
+        with self._lock, self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)', self._job_row(job))
+            if files is not None:
+                conn.execute('DELETE FROM files WHERE job_id = ?', (job.job_id,))
+                conn.executemany(self._insert_file(), map(self._file_row, files))
+
+    def save_file(self, file: FileState):
+        names = [f.name for f in fields(FileState)]
+        with self._lock, self._connection() as conn:
+            # updated in place to keep the files in the order listed
+            updated = conn.execute(f'UPDATE files SET {", ".join(f"{name} = ?" for name in names)} '
+                                   f'WHERE job_id = ? AND uuid = ?', self._file_row(file) + (file.job_id, file.uuid))
+            if not updated.rowcount:
+                conn.execute(self._insert_file(), self._file_row(file))
+            conn.execute('UPDATE jobs SET updated_at = ? WHERE job_id = ?', (file.updated_at, file.job_id))
+
+    def update(self, req: DataArchiverRequest, file: FileResult, state):
+        # a single row, rather than reading all the files of the job
+        with self._lock:
+            row = self._connection().execute('SELECT * FROM files WHERE job_id = ? AND uuid = ?',
+                                             (job_id(req), file.uuid)).fetchone()
+        entry = self._file(row) if row else FileState.listed(job_id(req), file)
+        entry.update(file, state)
+        self.save_file(entry)
+
+    @staticmethod
+    def _insert_file():
+        names = [f.name for f in fields(FileState)]
+        return f'INSERT INTO files ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})'
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+
+BACKENDS = {
+    'sqlite': SqliteJobStore
+}
+
+
+def open_job_store(backend=JOB_STORE, path=JOB_STORE_PATH) -> Optional[JobStore]:
+    """
+    the job store of the configured backend, None if disabled.
+    """
+    if not backend:
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown job store backend {backend}, one of {", ".join(BACKENDS)}')
+    return BACKENDS[backend](path)
+
+
+def _size(nbytes):
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if nbytes < 1024 or unit == 'T':
+            return f'{nbytes:.0f}{unit}' if unit == 'B' else f'{nbytes:.1f}{unit}'
+        nbytes /= 1024
+
+
+def list_jobs(store: JobStore, sub_uuid=None, state=None, out=None):
+    out = out or sys.stdout
+    print(f'{"JOB":<50} {"STATE":<8} {"FILES DONE":>12} {"BYTES DONE":>17} {"FAILED":>6}  UPDATED', file=out)
+    for job in store.get_jobs(sub_uuid, state):
+        progress = store.progress(job.job_id)
+        files = sum(count for count, _ in progress.values())
+        size = sum(nbytes for _, nbytes in progress.values())
+        done_files, done_bytes = progress[DONE]
+        print(f'{job.job_id:<50} {job.state:<8} {f"{done_files}/{files}":>12} '
+              f'{f"{_size(done_bytes)}/{_size(size)}":>17} {progress[FAILED][0]:>6}  {job.updated_at}', file=out)
+
+
+def show_job(store: JobStore, job_id, state=None, out=None):
+    out = out or sys.stdout
+    job = store.get_job(job_id)
+    if not job:
+        print(f'No job {job_id}', file=out)
+        return False
+    print(f'Job {job.job_id} of submission {job.sub_uuid}: {job.state}, '
+          f'started {job.started_at}, updated {job.updated_at}', file=out)
+    for name, (count, nbytes) in store.progress(job.job_id).items():
+        print(f'  {name:<12} {count:>6} files {_size(nbytes):>8}', file=out)
+    for file in store.get_files(job.job_id):
+        if state and file.state != state:
+            continue
+        print(f'{file.uuid}  {file.state:<12} {_size(file.size):>8}  {file.ena_upload_path or file.file_name}'
+              f'{"  " + file.md5 if file.md5 else ""}{"  " + file.error if file.error else ""}', file=out)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m data.archiver.jobs',
+                                     description='Inspect the progress of archiving jobs.')
+    parser.add_argument('--backend', default=JOB_STORE or 'sqlite', choices=list(BACKENDS))
+    parser.add_argument('--path', default=JOB_STORE_PATH, help='job store, default %(default)s')
+    commands = parser.add_subparsers(dest='command', required=True)
+    jobs = commands.add_parser('list', help='jobs with their progress')
+    jobs.add_argument('--sub-uuid', help='jobs of this submission')
+    jobs.add_argument('--state', choices=[RUNNING, DONE, FAILED])
+    show = commands.add_parser('show', help='the files of a job')
+    show.add_argument('job_id', help='submission uuid, or job id of requests for some of its files')
+    show.add_argument('--state', choices=FILE_STATES, help='only files in this state')
+    args = parser.parse_args(argv)
+
+    store = open_job_store(args.backend, args.path)
+    try:
+        if args.command == 'list':
+            list_jobs(store, args.sub_uuid, args.state)
+            return 0
+        return 0 if show_job(store, args.job_id, args.state) else 1
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
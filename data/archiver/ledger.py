@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, astuple, field, fields
+from datetime import datetime
+from typing import Optional
+
+from data.archiver.config import LEDGER_PATH
+from data.archiver.dataclass import FileResult
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archived (
+    destination TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    output TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    ena_upload_path TEXT NOT NULL,
+    compressed INTEGER NOT NULL,
+    archived_at TEXT NOT NULL,
+    PRIMARY KEY (destination, bucket, key, etag)
+)
+'''
+
+
+def _utcnow():
+    return datetime.utcnow().isoformat(timespec='seconds')
+
+
+@dataclass
+class LedgerEntry:
+    # ftp user@host the file was uploaded to
+    destination: str
+    bucket: str
+    key: str
+    etag: str
+    # uploaded file name and size, i.e. the .gz if compressed while archiving
+    output: str
+    size: int
+    md5: str
+    ena_upload_path: str
+    compressed: bool
+    archived_at: str = field(default_factory=_utcnow)
+
+    def restore(self, file: FileResult):
+        """
+        fill in the result of the earlier upload.
+        """
+        file.md5 = self.md5
+        # only the md5 is recorded
+        file.checksums = {'md5': self.md5}
+        file.compressed = self.compressed
+        file.ena_upload_path = self.ena_upload_path
+
+
+class ArchiveLedger:
+    """
+    Persistent record of every file archived, keyed by the destination and the S3 object's
+    bucket, key and ETag. A file requested again with an unchanged ETag is already in the
+    ENA upload area and doesn't have to be read from S3 or uploaded again.
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if not self._conn:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(SCHEMA)
+        return self._conn
+
+    def lookup(self, destination, bucket, key, etag) -> Optional[LedgerEntry]:
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT * FROM archived WHERE destination = ? AND bucket = ? AND key = ? AND etag = ?',
+                (destination, bucket, key, etag)).fetchone()
+        if not row:
+            return None
+        entry = LedgerEntry(*row)
+        entry.compressed = bool(entry.compressed)
+        return entry
+
+    def record(self, entry: LedgerEntry):
+        names = [f.name for f in fields(LedgerEntry)]
+        with self._lock, self._connection() as conn:
+            conn.execute(f'INSERT OR REPLACE INTO archived ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+                         astuple(entry))
+
+    def remove(self, entry: LedgerEntry):
+        with self._lock, self._connection() as conn:
+            conn.execute('DELETE FROM archived WHERE destination = ? AND bucket = ? AND key = ? AND etag = ?',
+                         (entry.destination, entry.bucket, entry.key, entry.etag))
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
@@ -1,5 +1,7 @@
 import logging
 import json
+import queue
+from dataclasses import asdict
 from kombu.mixins import ConsumerProducerMixin
 from kombu import Connection, Consumer, Message, Queue, Exchange
 from typing import Type, List
@@ -7,21 +9,48 @@ from concurrent.futures import ThreadPoolExecutor
 
 from data.archiver.archiver import Archiver
 from data.archiver.aws_s3_client import AwsS3
-from data.archiver.dataclass import AmqpConnConfig, DataArchiverResult, FileResult, QueueConfig, DataArchiverRequest
-from data.archiver.ingest_api import Ingest
+from data.archiver.budget import ResourceBudget, resource_budget
+from data.archiver.config import TRACE_PROFILE, LISTENER_PREFETCH, FANOUT
+from data.archiver.dataclass import AmqpConnConfig, DataArchiverResult, FileResult, QueueConfig, DataArchiverRequest, \
+    WorkItem
+from data.archiver.fanout import FanOut
+from data.archiver.ingest_api import Ingest, ResultReporter
+from data.archiver.jobs import JobStore, open_job_store
+from data.archiver.trace import RequestTrace
 
 
 class _Listener(ConsumerProducerMixin):
+    """
+    Processes up to `prefetch` requests at once, each on its own executor thread. The
+    requests being processed share the transfer slots and bytes of the resource budget.
+    Messages are acked from the consuming thread once their request is done, as the
+    channel is not thread safe.
+
+    With a work queue, up to `prefetch` batches of fanned out requests are archived at once
+    as well. The result of each request is published with the publish routing key.
+    """
 
     def __init__(self,
                  connection: Connection,
                  sub_queue_config: QueueConfig,
                  pub_queue_config: QueueConfig,
-                 executor: ThreadPoolExecutor):
+                 executor: ThreadPoolExecutor,
+                 prefetch=1,
+                 budget: ResourceBudget = resource_budget,
+                 work_queue_config: QueueConfig = None,
+                 jobs: JobStore = None):
         self.connection = connection
         self.sub_queue_config = sub_queue_config
         self.pub_queue_config = pub_queue_config
+        self.work_queue_config = work_queue_config
         self.executor = executor
+        self.work_executor = ThreadPoolExecutor(prefetch)
+        self.prefetch = prefetch
+        self.budget = budget
+        # state of the requests being processed, to resume them if redelivered
+        self.jobs = jobs
+        # messages of finished requests, acked by the consuming thread
+        self.done = queue.Queue()
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -29,14 +58,33 @@ class _Listener(ConsumerProducerMixin):
     def get_consumers(self, _consumer: Type[Consumer], channel) -> List[Consumer]:
         consumer = _consumer([_Listener.queue_from_config(self.sub_queue_config)],
                                         callbacks=[self.data_archiver_message_handler],
-                                        prefetch_count=1)
-        return [consumer]
-    
+                                        prefetch_count=self.prefetch)
+        if not self.work_queue_config:
+            return [consumer]
+        work_consumer = _consumer([_Listener.queue_from_config(self.work_queue_config)],
+                                  callbacks=[self.work_item_handler],
+                                  prefetch_count=self.prefetch)
+        return [consumer, work_consumer]
+
+    def on_iteration(self):
+        self.ack_done()
+
+    def ack_done(self):
+        while 1:
+            try:
+                msg = self.done.get_nowait()
+            except queue.Empty:
+                return
+            msg.ack()
+
     def data_archiver_message_handler(self, body, msg: Message):
         return self.executor.submit(lambda: self._data_archiver_message_handler(body, msg))
 
+    def work_item_handler(self, body, msg: Message):
+        # separate executor, a fanned out request waits for its batches
+        return self.work_executor.submit(lambda: self._work_item_handler(body, msg))
+
     def _data_archiver_message_handler(self, body, msg: Message):
-        ingest_cli = Ingest()
         sub_uuid = None
         try:
             if isinstance(body, str):
@@ -45,8 +93,11 @@ class _Listener(ConsumerProducerMixin):
             req = DataArchiverRequest(**body)
             sub_uuid = req.sub_uuid
             self.logger.info(f'Received data archiving request for submission uuid {sub_uuid}')
-
-            result = Archiver(ingest_cli, AwsS3()).start(req)            
+            if (req.fan_out or FANOUT) and self.work_queue_config:
+                result = FanOut(self.connection, self.work_queue_config, Ingest(), AwsS3(),
+                                jobs=self.jobs).run(req)
+            else:
+                result = self.archive(req)
             self.logger.info(f'Archived data for submission uuid {sub_uuid}')
 
         except (ValueError, TypeError) as e:
@@ -59,10 +110,57 @@ class _Listener(ConsumerProducerMixin):
             self.logger.error(error_msg)
             result = DataArchiverResult(sub_uuid, success=False, error=error_msg)
 
-        ingest_cli.patch_files(result.files)
+        self.publish(asdict(result), self.pub_queue_config.routing_key)
+        self.done.put(msg)
+
+    def _work_item_handler(self, body, msg: Message):
+        try:
+            if isinstance(body, str):
+                body = json.loads(body)
+            item = WorkItem(**body)
+        except (ValueError, TypeError) as e:
+            self.logger.error(f'Invalid work item {body}: {str(e)}')
+            self.done.put(msg)
+            return
+
+        self.logger.info(f'Received batch {item.batch} of job {item.job_id}, {len(item.files)} files '
+                         f'of submission uuid {item.sub_uuid}')
+        try:
+            result = self.archive(DataArchiverRequest(item.sub_uuid, item.files, item.stream, item.engine))
+        except Exception as e:
+            error_msg = f'Batch {item.batch} of job {item.job_id} failed: {str(e)}'
+            self.logger.error(error_msg)
+            result = DataArchiverResult(item.sub_uuid, success=False, error=error_msg)
 
-        msg.ack()
+        self.publish({'job_id': item.job_id, 'batch': item.batch, 'result': asdict(result)}, item.reply_to)
+        self.done.put(msg)
 
+    def archive(self, req: DataArchiverRequest) -> DataArchiverResult:
+        ingest_cli = Ingest()
+        trace = RequestTrace(req.sub_uuid)
+        reporter = ResultReporter(ingest_cli, trace=trace)
+        if req.profile or TRACE_PROFILE:
+            trace.start_profile()
+        try:
+            with self.budget.share(req.sub_uuid) as share:
+                result = Archiver(ingest_cli, AwsS3(), reporter, trace, share, self.jobs).start(req)
+            # files not already reported while archiving
+            reporter.report_all(result.files)
+            return result
+        finally:
+            reporter.close()
+            try:
+                trace.write()
+            except OSError as e:
+                self.logger.error(f'Could not write request trace: {str(e)}')
+
+    def publish(self, body, routing_key):
+        # from executor threads, on a connection of their own
+        exchange = Exchange(self.pub_queue_config.exchange, self.pub_queue_config.exchange_type)
+        with self.connection.clone() as conn:
+            conn.Producer().publish(body, exchange=exchange, routing_key=routing_key, serializer='json',
+                                    declare=[exchange], retry=self.pub_queue_config.retry,
+                                    retry_policy=self.pub_queue_config.retry_policy or {})
 
     @staticmethod
     def queue_from_config(queue_config: QueueConfig) -> Queue:
@@ -75,12 +173,23 @@ class Listener:
     def __init__(self,
                  amqp_conn_config: AmqpConnConfig,
                  sub_queue_config: QueueConfig,
-                 pub_queue_config: QueueConfig):
+                 pub_queue_config: QueueConfig,
+                 work_queue_config: QueueConfig = None,
+                 prefetch=LISTENER_PREFETCH):
         self.amqp_conn_config = amqp_conn_config
         self.sub_queue_config = sub_queue_config
         self.pub_queue_config = pub_queue_config
+        self.work_queue_config = work_queue_config
+        self.prefetch = max(prefetch, 1)
 
     def run(self):
-        with Connection(self.amqp_conn_config.broker_url()) as conn:
-            _listener = _Listener(conn, self.sub_queue_config, self.pub_queue_config, ThreadPoolExecutor())
-            _listener.run()
+        jobs = open_job_store()
+        try:
+            with Connection(self.amqp_conn_config.broker_url()) as conn:
+                _listener = _Listener(conn, self.sub_queue_config, self.pub_queue_config,
+                                      ThreadPoolExecutor(self.prefetch), self.prefetch,
+                                      work_queue_config=self.work_queue_config, jobs=jobs)
+                _listener.run()
+        finally:
+            if jobs:
+                jobs.close()
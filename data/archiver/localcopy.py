@@ -0,0 +1,162 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from tqdm import tqdm
+
+from data.archiver import metrics
+from data.archiver.aws_s3_client import AwsS3, S3Url, get_transfer_config
+from data.archiver.budget import BudgetShare, ByteBudget
+from data.archiver.config import ENA_FTP_DIR, COMPRESSION_LEVEL, COMPRESSION_WORKERS, FTP_BLOCK_SIZE, FTP_SENDFILE, \
+    LOCALCOPY_DIR, LOCALCOPY_WORKERS, LOCALCOPY_DISK_BUDGET
+from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.ftp_pool import ftp_pool
+from data.archiver.ftp_uploader import FtpUploader
+from data.archiver.scheduler import TransferScheduler
+from data.archiver.trace import RequestTrace
+from data.archiver.utils import checksum, compress_md5
+
+# scratch space used by all local copies of the process
+scratch_space = ByteBudget(LOCALCOPY_DISK_BUDGET)
+
+
+class LocalCopyPipeline:
+    """
+    Archives each file through local disk on its own: download, compress (the checksums are
+    taken from the compressed output and its .md5 written in the same pass), upload with its
+    .md5 and delete, with up to `workers` files in flight. A gzipped file is uploaded as it
+    is, with the checksums S3 has of it rather than read again to compute them.
+
+    Files are started largest first while the scratch space they need stays within
+    disk_budget: the file and its compressed copy, or just the file if it is already
+    gzipped. A file needing more than the budget is archived on its own. The space is also
+    taken from scratch, shared with the other requests, e.g. batches of the same submission,
+    each archived in a directory of its own.
+    """
+
+    def __init__(self, aws_cli: AwsS3, workers=LOCALCOPY_WORKERS, disk_budget=LOCALCOPY_DISK_BUDGET,
+                 scratch_dir=LOCALCOPY_DIR, on_done=None, trace: RequestTrace = None, share: BudgetShare = None,
+                 on_start=None, scratch: ByteBudget = scratch_space):
+        self.aws_cli = aws_cli
+        self.workers = workers
+        self.disk_budget = disk_budget
+        self.scratch_dir = scratch_dir
+        self.scratch = scratch
+        # called with each file once archived, and as its transfer starts
+        self.on_done = on_done
+        self.on_start = on_start
+        self.trace = trace or RequestTrace()
+        # transfer slots shared with the other requests being processed
+        self.share = share
+        self.pbar = None
+        # S3ObjectInfo by cloud url, resolved for all files in start()
+        self.objects = {}
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    @staticmethod
+    def disk_usage(file: FileResult):
+        return file.size if file.file_name.endswith('.gz') else 2 * file.size
+
+    def start(self, res: DataArchiverResult):
+        with self.trace.span('s3_metadata', files=len(res.files)):
+            self.objects = self.aws_cli.metadata.resolve_files(res.files)
+        files = [file for file in res.files if file.success]
+        if not files:
+            return
+
+        with self.trace.span('ftp_dirs'):
+            with ftp_pool.connection() as ftp:
+                FtpUploader.chdir(ftp, ENA_FTP_DIR)
+                FtpUploader.mk_dir(ftp, res.sub_uuid)
+
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix=f'{res.sub_uuid}-', dir=self.scratch_dir)
+        total_size = sum(file.size for file in files)
+        self.pbar = tqdm(total=total_size, unit='B', unit_scale=True, desc=f'{len(files)} files', mininterval=2)
+
+        def archive(file):
+            with self.scratch.take(self.disk_usage(file)):
+                self.archive_file(res.sub_uuid, work_dir, file)
+
+        scheduler = TransferScheduler(workers=self.workers, small_workers=0, small_size=0,
+                                      max_bytes=self.disk_budget, share=self.share)
+        try:
+            with self.trace.span('transfer', files=len(files)) as span:
+                span.bytes = total_size
+                scheduler.run(files, archive, size=self.disk_usage)
+        finally:
+            self.pbar.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def archive_file(self, sub_uuid, work_dir, file: FileResult):
+        if self.on_start:
+            self.on_start(file)
+        start = time.perf_counter()
+        local = os.path.join(work_dir, file.file_name)
+        outputs = [local]
+        with self.trace.span('file', file=file.file_name) as span, metrics.ACTIVE_TRANSFERS.track_inprogress():
+            span.bytes = file.size
+            try:
+                step = None
+                self.download(file, local)
+
+                step = 'Compression failed'
+                if file.file_name.endswith('.gz'):
+                    output = local
+                    known = self.aws_cli.metadata.checksums(file.cloud_url, self.objects.get(file.cloud_url))
+                    with metrics.timed('local_md5'):
+                        checksums = checksum(local, known=known)
+                else:
+                    output = f'{local}.gz'
+                    outputs.append(output)
+                    with metrics.timed('local_compress'):
+                        checksums = compress_md5(local, output, COMPRESSION_LEVEL, COMPRESSION_WORKERS)
+                    # free the space as soon as possible
+                    os.remove(local)
+                    if checksums.size:
+                        metrics.COMPRESSION_RATIO.observe(file.size / checksums.size)
+                    file.file_name = os.path.basename(output)
+                    file.compressed = True
+                file.md5 = checksums.md5
+                file.checksums = checksums.digests
+                outputs.append(f'{output}.md5')
+
+                step = 'FTP upload error'
+                with ftp_pool.connection() as ftp:
+                    FtpUploader.chdir(ftp, ENA_FTP_DIR)
+                    FtpUploader.chdir(ftp, sub_uuid)
+                    FtpUploader.stor(ftp, output, FTP_BLOCK_SIZE, FTP_SENDFILE)
+                    FtpUploader.stor(ftp, f'{output}.md5', FTP_BLOCK_SIZE, FTP_SENDFILE)
+                file.ena_upload_path = f'{ENA_FTP_DIR}/{sub_uuid}/{file.file_name}'
+                metrics.FILES.labels('local', 'archived').inc()
+                metrics.FILE_SECONDS.labels('local').observe(time.perf_counter() - start)
+            except Exception as ex:
+                self.logger.error(f'Failed to archive file via local copy: {file} error: {ex}')
+                file.success = False
+                file.error = step or str(ex)
+                metrics.FILES.labels('local', 'failed').inc()
+                metrics.error(ex)
+            finally:
+                for path in outputs:
+                    if os.path.exists(path):
+                        os.remove(path)
+            span.attrs.update(output=file.ena_upload_path, success=file.success, error=file.error)
+        self.done(file)
+
+    def download(self, file: FileResult, local):
+        s3url = S3Url(file.cloud_url)
+
+        def progress(nbytes):
+            self.pbar.update(nbytes)
+            metrics.BYTES_READ.labels('local').inc(nbytes)
+
+        with metrics.timed('local_download'):
+            self.aws_cli.s3_cli.download_file(s3url.bucket, s3url.key, local, Callback=progress,
+                                              Config=get_transfer_config(file.size))
+
+    def done(self, file: FileResult):
+        if self.on_done:
+            self.on_done(file)
@@ -0,0 +1,53 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# files take from under a second to hours
+FILE_SECONDS_BUCKETS = (0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, float('inf'))
+RATIO_BUCKETS = (1, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, 8, 10, float('inf'))
+
+# path is 'stream' for S3 to FTP streaming, 'local' for download/compress/upload
+BYTES_READ = Counter('archiver_s3_read_bytes', 'Bytes read from S3', ['path'])
+BYTES_SENT = Counter('archiver_ftp_sent_bytes', 'Bytes sent to the ENA FTP server', ['path'])
+COMPRESSION_RATIO = Histogram('archiver_compression_ratio', 'Input bytes per compressed byte of each file',
+                              buckets=RATIO_BUCKETS)
+# stages of the stream pipeline (s3_read, compress, checksum, ftp_send) and of the local path
+STAGE_SECONDS = Counter('archiver_stage_busy_seconds', 'Seconds spent working in each stage', ['stage'])
+STAGE_WAIT_SECONDS = Counter('archiver_stage_wait_seconds', 'Seconds each stage spent blocked on its neighbours',
+                             ['stage'])
+FILE_SECONDS = Histogram('archiver_file_seconds', 'Time to archive one file', ['path'],
+                         buckets=FILE_SECONDS_BUCKETS)
+FILES = Counter('archiver_files', 'Files by outcome', ['path', 'result'])
+ERRORS = Counter('archiver_errors', 'Errors by exception type', ['type'])
+RETRIES = Counter('archiver_stream_retries', 'Streams resumed after a failure')
+ACTIVE_TRANSFERS = Gauge('archiver_active_transfers', 'Files being transferred')
+QUEUED_FILES = Gauge('archiver_queued_files', 'Files waiting for a transfer slot')
+CONCURRENCY_LIMIT = Gauge('archiver_concurrency_limit', 'Current limit of concurrent transfers')
+CONCURRENCY_CHANGES = Counter('archiver_concurrency_changes', 'Changes of the concurrency limit', ['direction'])
+ACTIVE_REQUESTS = Gauge('archiver_active_requests', 'Requests being processed')
+REQUESTS = Counter('archiver_requests', 'Archiving requests by outcome', ['result'])
+REQUEST_SECONDS = Histogram('archiver_request_seconds', 'Time to process an archiving request',
+                            buckets=FILE_SECONDS_BUCKETS)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).inc(time.perf_counter() - start)
+
+
+def error(ex: BaseException):
+    ERRORS.labels(type(ex).__name__).inc()
+
+
+def start_metrics_server(port, addr='0.0.0.0'):
+    """
+    serve /metrics on the port from a daemon thread.
+    """
+    start_http_server(port, addr)
+    logging.getLogger(__name__).info(f'Serving metrics on {addr}:{port}/metrics')
@@ -0,0 +1,189 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from queue import Queue, Empty, Full
+from typing import Callable, Dict, List, Optional
+
+from data.archiver.trace import profiled
+
+# how often blocked stages check whether another stage has failed
+POLL_INTERVAL = 0.5
+_END = None
+
+
+@dataclass
+class StageStats:
+    # seconds spent doing work in the stage function
+    busy: float = field(default=0.0)
+    # seconds spent blocked waiting on the upstream or downstream queue
+    wait: float = field(default=0.0)
+    bytes: int = field(default=0)
+    calls: int = field(default=0)
+
+    def add(self, other: 'StageStats'):
+        self.busy += other.busy
+        self.wait += other.wait
+        self.bytes += other.bytes
+        self.calls += other.calls
+
+    def throughput(self):
+        return self.bytes / self.busy if self.busy else 0.0
+
+
+@dataclass
+class _Stage:
+    name: str
+    fn: Callable
+    # called once at the end of input, may return a final buffer
+    finish: Optional[Callable] = field(default=None)
+    stats: StageStats = field(default_factory=StageStats)
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipeline:
+    """
+    Runs a source, transform stages and a sink each in its own thread, joined by bounded
+    queues of byte buffers. Memory is capped by max_buffers in flight per queue, and the
+    throughput of the whole pipeline approaches the slowest stage instead of the sum of all.
+
+        Pipeline(4).source('s3_read', read).stage('md5', hash).sink('ftp_send', conn.sendall).run()
+
+    A source returns b'' at the end of input. A stage returns its output buffer, or b'' if
+    it has nothing to pass on yet. The first exception in any stage stops the pipeline and
+    is raised from run().
+
+    Buffers may be memoryviews of reusable buffers: release is called with each buffer no
+    stage needs any more, once sent by the sink or replaced by a stage with another output.
+    """
+
+    def __init__(self, max_buffers=4, release=None):
+        self.max_buffers = max_buffers
+        self.release = release
+        self._source: Optional[_Stage] = None
+        self._stages: List[_Stage] = []
+        self._sink: Optional[_Stage] = None
+        self._error: Optional[BaseException] = None
+        self._abort = threading.Event()
+
+    def source(self, name, fn):
+        self._source = _Stage(name, fn)
+        return self
+
+    def stage(self, name, fn, finish=None):
+        self._stages.append(_Stage(name, fn, finish))
+        return self
+
+    def sink(self, name, fn):
+        self._sink = _Stage(name, fn)
+        return self
+
+    @property
+    def stats(self) -> Dict[str, StageStats]:
+        return {s.name: s.stats for s in [self._source, *self._stages, self._sink] if s}
+
+    def run(self) -> Dict[str, StageStats]:
+        queues = [Queue(self.max_buffers) for _ in range(len(self._stages) + 1)]
+        threads = [threading.Thread(target=profiled(self._guard),
+                                    args=(self._run_source, self._source, queues[0]),
+                                    name=self._source.name, daemon=True)]
+        for i, stage in enumerate(self._stages):
+            threads.append(threading.Thread(target=profiled(self._guard),
+                                            args=(self._run_stage, stage, queues[i], queues[i + 1]),
+                                            name=stage.name, daemon=True))
+        threads.append(threading.Thread(target=profiled(self._guard),
+                                        args=(self._run_sink, self._sink, queues[-1]),
+                                        name=self._sink.name, daemon=True))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self._error:
+            raise self._error
+        return self.stats
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as ex:
+            if not self._abort.is_set():
+                self._error = ex
+                self._abort.set()
+
+    def _put(self, q: Queue, item, stats: StageStats):
+        start = time.perf_counter()
+        while 1:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                break
+            except Full:
+                continue
+        stats.wait += time.perf_counter() - start
+
+    def _get(self, q: Queue, stats: StageStats):
+        start = time.perf_counter()
+        while 1:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                item = q.get(timeout=POLL_INTERVAL)
+                break
+            except Empty:
+                continue
+        stats.wait += time.perf_counter() - start
+        return item
+
+    @staticmethod
+    def _call(stage: _Stage, fn, *args):
+        start = time.perf_counter()
+        out = fn(*args)
+        stage.stats.busy += time.perf_counter() - start
+        stage.stats.calls += 1
+        return out
+
+    def _run_source(self, stage: _Stage, q_out: Queue):
+        while 1:
+            buf = self._call(stage, stage.fn)
+            if not buf:
+                break
+            stage.stats.bytes += len(buf)
+            self._put(q_out, buf, stage.stats)
+        self._put(q_out, _END, stage.stats)
+
+    def _run_stage(self, stage: _Stage, q_in: Queue, q_out: Queue):
+        while 1:
+            buf = self._get(q_in, stage.stats)
+            if buf is _END:
+                break
+            stage.stats.bytes += len(buf)
+            out = self._call(stage, stage.fn, buf)
+            if self.release and out is not buf:
+                self.release(buf)
+            if out:
+                self._put(q_out, out, stage.stats)
+        if stage.finish:
+            out = self._call(stage, stage.finish)
+            if out:
+                self._put(q_out, out, stage.stats)
+        self._put(q_out, _END, stage.stats)
+
+    def _run_sink(self, stage: _Stage, q_in: Queue):
+        while 1:
+            buf = self._get(q_in, stage.stats)
+            if buf is _END:
+                break
+            stage.stats.bytes += len(buf)
+            self._call(stage, stage.fn, buf)
+            if self.release:
+                self.release(buf)
+
+
+def format_stats(stats: Dict[str, StageStats]):
+    return ', '.join(f'{name} busy {s.busy:.2f}s wait {s.wait:.2f}s {s.bytes} bytes'
+                     for name, s in stats.items())
@@ -0,0 +1,99 @@
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+KB = 1024
+MB = KB * KB
+DEFAULT_PART_SIZE = 8 * MB
+DEFAULT_CONCURRENCY = 4
+
+
+class RangedS3Reader(io.RawIOBase):
+    """
+    Read-only file-like object over an S3 object that fetches it with concurrent ranged
+    GETs and hands the parts back in order. At most `concurrency` parts are in flight or
+    buffered at any time, so memory is capped at about concurrency * part_size.
+
+    `s3` is an s3fs.S3FileSystem, parts are fetched with cat_file(url, start, end).
+    """
+
+    def __init__(self, s3, url, size, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY, offset=0):
+        super().__init__()
+        self.s3 = s3
+        self.url = url
+        self.size = size
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(concurrency)
+        self._parts = deque()
+        self._next_start = offset
+        self._pos = offset
+        self._buf = b''
+        self._view = memoryview(self._buf)
+        self._buf_pos = 0
+        self._fill()
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        del buf[n:]
+        return bytes(buf)
+
+    def readall(self):
+        out = []
+        while 1:
+            chunk = self.read(self.part_size)
+            if not chunk:
+                break
+            out.append(chunk)
+        return b''.join(out)
+
+    def readinto(self, b):
+        """
+        copies straight from the fetched parts into b.
+        """
+        out = memoryview(b).cast('B')
+        n = 0
+        while n < len(out):
+            if self._buf_pos >= len(self._buf) and not self._next_part():
+                break
+            chunk = min(len(out) - n, len(self._buf) - self._buf_pos)
+            out[n:n + chunk] = self._view[self._buf_pos:self._buf_pos + chunk]
+            self._buf_pos += chunk
+            n += chunk
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._parts:
+                future.cancel()
+            self._parts.clear()
+            self._executor.shutdown(wait=False)
+        super().close()
+
+    def _fetch(self, start, end):
+        return self.s3.cat_file(self.url, start=start, end=end)
+
+    def _fill(self):
+        while len(self._parts) < self.concurrency and self._next_start < self.size:
+            end = min(self._next_start + self.part_size, self.size)
+            self._parts.append(self._executor.submit(self._fetch, self._next_start, end))
+            self._next_start = end
+
+    def _next_part(self):
+        if not self._parts:
+            return False
+        self._buf = self._parts.popleft().result()
+        self._view = memoryview(self._buf)
+        self._buf_pos = 0
+        self._fill()
+        return True
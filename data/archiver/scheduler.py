@@ -0,0 +1,143 @@
+import heapq
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from data.archiver import metrics
+from data.archiver.budget import BudgetShare
+from data.archiver.concurrency import AdaptiveConcurrency
+from data.archiver.config import TRANSFER_WORKERS, SMALL_FILE_WORKERS, SMALL_FILE_SIZE, MAX_BYTES_IN_FLIGHT, \
+    STREAM_RATE_ESTIMATE
+from data.archiver.trace import profiled
+
+
+def lpt_makespan(sizes, workers) -> int:
+    """
+    bytes on the busiest worker when sizes are given largest first to the least loaded worker.
+    """
+    loads = [0] * max(workers, 1)
+    for size in sorted(sizes, reverse=True):
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+class TransferScheduler:
+    """
+    Runs fn(item) for each item on worker threads, ordered to minimise the time until the
+    last transfer finishes rather than in the order the items were given.
+
+    - large items are started largest first (LPT), so a very large file isn't picked up
+      last and left running on its own at the end.
+    - items smaller than small_size have small_workers of their own so they keep moving
+      while all large workers are busy. idle workers of either lane help the other lane.
+    - large items are only started while the bytes in flight stay within max_bytes, the
+      largest item that fits is taken first. an item larger than max_bytes runs alone.
+    - with a controller, the number of large items transferring at once follows its
+      limit instead of being fixed at workers, small workers helping included.
+    - with a share, every transfer also takes a slot of the budget shared with the other
+      requests being processed. only large items count towards its bytes in flight.
+    """
+
+    def __init__(self, workers=TRANSFER_WORKERS, small_workers=SMALL_FILE_WORKERS, small_size=SMALL_FILE_SIZE,
+                 max_bytes=MAX_BYTES_IN_FLIGHT, rate=STREAM_RATE_ESTIMATE,
+                 controller: Optional[AdaptiveConcurrency] = None, share: Optional[BudgetShare] = None):
+        self.workers = max(controller.limit if controller else workers, 1)
+        self.small_workers = small_workers
+        self.small_size = small_size
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.controller = controller
+        self.share = share
+        self.in_flight = 0
+        self._large: List[tuple] = []
+        self._small: List[tuple] = []
+        self._cond = threading.Condition()
+        self._error: Optional[BaseException] = None
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    def run(self, items, fn: Callable, size: Callable = lambda item: item.size):
+        entries = sorted(((size(item) or 0, n, item) for n, item in enumerate(items)), reverse=True,
+                         key=lambda entry: entry[0])
+        self._large = [e for e in entries if e[0] >= self.small_size]
+        self._small = [e for e in entries if e[0] < self.small_size]
+        metrics.QUEUED_FILES.inc(len(entries))
+        self._error = None
+        total = sum(e[0] for e in entries)
+        predicted = self.predict([e[0] for e in self._large], [e[0] for e in self._small])
+        self.logger.info(f'Scheduled {len(self._large)} large and {len(self._small)} small files ({total} bytes), '
+                         f'predicted finish in {predicted:.0f}s at '
+                         f'{datetime.now() + timedelta(seconds=predicted):%H:%M:%S}')
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=profiled(self._work), args=(fn, False), name=f'transfer-{n}',
+                                    daemon=True)
+                   for n in range(min(self.controller.ceiling if self.controller else self.workers,
+                                      len(entries)))]
+        threads += [threading.Thread(target=profiled(self._work), args=(fn, True), name=f'transfer-small-{n}',
+                                     daemon=True)
+                    for n in range(min(self.small_workers, len(self._small)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        self.logger.info(f'Finished {len(entries)} files in {elapsed:.0f}s, predicted {predicted:.0f}s '
+                         f'({total / elapsed if elapsed else 0:.0f} bytes/s)')
+        if self._error:
+            raise self._error
+
+    def predict(self, large_sizes, small_sizes) -> float:
+        """
+        seconds until the last transfer finishes if every stream runs at rate.
+        """
+        makespan = max(lpt_makespan(large_sizes, self.workers),
+                       lpt_makespan(small_sizes, self.small_workers) if small_sizes else 0)
+        return makespan / self.rate if self.rate else 0.0
+
+    def _work(self, fn, small_lane):
+        while 1:
+            entry = self._take(small_lane)
+            if entry is None:
+                return
+            (size, _, item), charged = entry
+            try:
+                # a large item takes a controller slot whichever lane picked it up
+                with self.controller.slot() if self.controller and size >= self.small_size else nullcontext(), \
+                        self.share.slot(charged) if self.share else nullcontext():
+                    fn(item)
+            except BaseException as ex:
+                self.logger.error(f'Transfer failed: {item} error: {ex}')
+                if not self._error:
+                    self._error = ex
+            finally:
+                with self._cond:
+                    self.in_flight -= charged
+                    self._cond.notify_all()
+
+    def _take(self, small_lane):
+        with self._cond:
+            while self._large or self._small:
+                if small_lane:
+                    entry = self._take_small() or self._take_large()
+                else:
+                    entry = self._take_large() or self._take_small()
+                if entry:
+                    metrics.QUEUED_FILES.dec()
+                    return entry
+                # only large items are left and none fit until a transfer finishes
+                self._cond.wait()
+        return None
+
+    def _take_small(self):
+        return (self._small.pop(0), 0) if self._small else None
+
+    def _take_large(self):
+        for n, entry in enumerate(self._large):
+            if not self.in_flight or self.in_flight + entry[0] <= self.max_bytes:
+                self.in_flight += entry[0]
+                return self._large.pop(n), entry[0]
+        return None
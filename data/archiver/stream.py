@@ -3,43 +3,102 @@ import hashlib
 import logging
 import shutil
 import tempfile
-from ftplib import FTP
+import threading
+import ftplib
+import posixpath
+import time
 from io import BytesIO
-from multiprocessing.pool import ThreadPool
 
 import s3fs
 from tqdm import tqdm
 
-from data.archiver.aws_s3_client import S3Url
-from data.archiver.config import AWS_ACCESS_KEY, AWS_SECRET_KEY, ENA_FTP_HOST, ENA_WEBIN_USER, \
-    ENA_WEBIN_PWD, SINGLE_THREADED
+from data.archiver.aws_s3_client import AwsS3, S3Url
+from data.archiver.checkpoint import CheckpointStore, TransferCheckpoint
+from data.archiver.budget import BudgetShare
+from data.archiver.buffers import BufferPool, BufferLease, BatchedProgress, readinto_full, stream_buffers
+from data.archiver.checksum import MD5, MultiHash
+from data.archiver.concurrency import AdaptiveConcurrency, ftp_concurrency
+from data.archiver.compression import new_compressor, compressor_id
+from data.archiver.config import AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_S3_ENDPOINT, SINGLE_THREADED, \
+    COMPRESSION_LEVEL, COMPRESSION_WORKERS, IN_FLIGHT_BUFFERS, S3_PART_SIZE, S3_READ_CONCURRENCY, STREAM_RETRIES, \
+    CHECKPOINT_DIR, ENA_FTP_HOST, ENA_WEBIN_USER, LEDGER_VERIFY, CHECKSUMS, STREAM_READ_SIZE
 from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.ftp_index import remote_index
+from data.archiver.ftp_pool import ftp_pool
 from data.archiver.ftp_uploader import FtpUploader
+from data.archiver.ledger import ArchiveLedger, LedgerEntry
+from data.archiver import metrics
+from data.archiver.trace import RequestTrace
+from data.archiver.pipeline import Pipeline, StageStats, format_stats
+from data.archiver.s3_reader import RangedS3Reader
+from data.archiver.scheduler import TransferScheduler
 
 MAX_IN_MEM_FILE_COMPRESSION = 1024 * 1024 * 500  # 500M
-BLOCKSIZE = 8192
+
+
+class SkipBytes:
+    """
+    wraps send to drop the first n bytes, for output already uploaded before a resume.
+    """
+
+    def __init__(self, n, send):
+        self.remaining = n
+        self.send = send
+
+    def __call__(self, buf):
+        if self.remaining:
+            drop = min(self.remaining, len(buf))
+            self.remaining -= drop
+            buf = buf[drop:]
+        if buf:
+            self.send(buf)
+
+    def progress(self, cb):
+        """
+        cb of the bytes read once past the output already uploaded, counted when it was.
+        """
+        def fn(nbytes):
+            if not self.remaining:
+                cb(nbytes)
+        return fn
 
 
 class S3FTPStreamer:
 
-    def __init__(self):
-        self.s3 = s3fs.S3FileSystem(anon=False, key=AWS_ACCESS_KEY, secret=AWS_SECRET_KEY)
+    def __init__(self, on_done=None, trace: RequestTrace = None, share: BudgetShare = None, on_start=None,
+                 buffers: BufferPool = stream_buffers, concurrency: AdaptiveConcurrency = ftp_concurrency):
+        # called with each file once archived, and as its transfer starts
+        self.on_done = on_done
+        self.on_start = on_start
+        self.trace = trace or RequestTrace()
+        # transfer slots shared with the other requests being processed
+        self.share = share
+        # read buffers reused by all files
+        self.buffers = buffers
+        self.s3 = s3fs.S3FileSystem(anon=False, key=AWS_ACCESS_KEY, secret=AWS_SECRET_KEY,
+                                    client_kwargs={'endpoint_url': AWS_S3_ENDPOINT})
+        # stage timings accumulated over all files streamed
+        self.stage_stats = {}
+        self.stats_lock = threading.Lock()
+        self.checkpoints = CheckpointStore(CHECKPOINT_DIR)
+        # limit on concurrent transfers to the FTP server, shared with the other requests
+        self.concurrency = concurrency
+        self.metadata = AwsS3().metadata
+        # S3ObjectInfo by cloud url, resolved for all files in start()
+        self.objects = {}
+        self.ledger = ArchiveLedger()
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
-    @staticmethod
-    def new_ftpcli():
-        return FTP(ENA_FTP_HOST, ENA_WEBIN_USER, ENA_WEBIN_PWD, timeout=60 * 60 * 2)  # 2h
-
     def md5(self, file):
         """
         calculate md5 by streaming file without saving locally.
         """
-        hash_md5 = hashlib.md5()
+        hasher = MultiHash((MD5,))
         with self.s3.open(file.cloud_url, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            for chunk in iter(lambda: f.read(STREAM_READ_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigests()[MD5]
 
     def stream(self, ftp, fin, fout, cb):
         """
@@ -53,66 +112,222 @@ class S3FTPStreamer:
         s3url = S3Url(file.cloud_url)
         env = s3url.bucket.split('-')[-1]
         compressed = self.is_compressed(file.cloud_url)
+        fout = file.file_name if compressed else f'{file.file_name}.gz'
 
-        file.ena_upload_path = f"{env}/{s3url.uuid}/"
-
-        with S3FTPStreamer.new_ftpcli() as ftp:
-            FtpUploader.chdir(ftp, env)
-            FtpUploader.chdir(ftp, s3url.uuid)
-
-            if FtpUploader.file_exists(ftp, file.file_name) and FtpUploader.file_size(ftp,
-                                                                                      file.file_name) == file.size:
-                self.logger.info(
-                    f'Skipping {file.file_name} ({file.size} bytes). File exists in ENA FTP.')
-                file.error = 'File already exists in ENA upload area.'
-                file.success = False
-            else:
-
-                if compressed:
-                    self.logger.info(f'Streaming {file.file_name} ({file.size} bytes) to FTP.')
-                    self.stream_with_md5(ftp, file, lambda str: callback(len(str)))
-                else:
-                    self.logger.info(
-                        f'Compressing {file.file_name} ({file.size} bytes) / streaming {file.file_name}.gz to FTP.')
-                    self.stream_with_compression_and_md5(ftp, file, lambda str: callback(len(str)))
-                self.logger.info(f'Finish streaming {file.file_name}.')
+        attempt = 0
+        while 1:
+            file.ena_upload_path = f"{env}/{s3url.uuid}/"
+            try:
+                with ftp_pool.connection() as ftp:
+                    FtpUploader.chdir(ftp, env)
+                    FtpUploader.chdir(ftp, s3url.uuid)
+                    ftp.voidcmd('TYPE I')
+
+                    if attempt == 0 and FtpUploader.indexed_file_size(ftp, file.file_name) == file.size:
+                        self.logger.info(
+                            f'Skipping {file.file_name} ({file.size} bytes). File exists in ENA FTP.')
+                        file.error = 'File already exists in ENA upload area.'
+                        file.success = False
+                        metrics.FILES.labels('stream', 'exists').inc()
+                        return
+
+                    offset = self.resume_offset(ftp, file, fout, compressed)
+                    if compressed:
+                        self.logger.info(f'Streaming {file.file_name} ({file.size} bytes) to FTP.')
+                        size = self.stream_with_md5(ftp, file, callback, offset)
+                    else:
+                        self.logger.info(
+                            f'Compressing {file.file_name} ({file.size} bytes) / streaming {fout} to FTP.')
+                        size = self.stream_with_compression_and_md5(ftp, file, callback, offset)
+                    self.logger.info(f'Finish streaming {file.file_name}.')
+                self.checkpoints.remove(file.cloud_url, fout)
+                self.record_archived(file, fout, size)
+                return
+            except ftplib.all_errors as ex:
+                self.concurrency.record_error(ex)
+                attempt += 1
+                if attempt > STREAM_RETRIES:
+                    raise
+                metrics.error(ex)
+                metrics.RETRIES.inc()
+                self.logger.warning(f'Streaming {file.file_name} failed, resuming ({attempt}/{STREAM_RETRIES}): {ex}')
+
+    def resume_offset(self, ftp, file, fout, compressed):
+        """
+        size of the partial upload of fout to resume from, 0 to start from the beginning.
+        only resumed if the partial upload was made from the same object with the same
+        compressor, according to the checkpoint saved when it was started.
+        """
+        info = self.objects.get(file.cloud_url)
+        checkpoint = TransferCheckpoint(file.cloud_url, fout, file.size,
+                                        etag=info.etag if info else self.s3.info(file.cloud_url).get('ETag', '').strip('"'),
+                                        compressor=None if compressed else compressor_id(COMPRESSION_LEVEL,
+                                                                                          COMPRESSION_WORKERS))
+        saved = self.checkpoints.load(file.cloud_url, fout)
+        self.checkpoints.save(checkpoint)
+        if saved != checkpoint:
+            return 0
+        remote_size = FtpUploader.file_size(ftp, fout)
+        if not remote_size or (compressed and remote_size > file.size):
+            return 0
+        self.logger.info(f'Resuming {fout} from byte {remote_size}.')
+        return remote_size
+
+    def stream_with_md5(self, ftp, file, cb, offset=0):
+        """
+        the checksums S3 has of the object are not computed again, without a hashing stage
+        at all if it has them all. bytes before offset are already uploaded, then only the
+        rest is read, unless some checksum has to be computed: they are read and hashed
+        again but not sent.
+        """
+        hasher = MultiHash(CHECKSUMS, self.metadata.checksums(file.cloud_url, self.objects.get(file.cloud_url)))
+        start = 0 if hasher.needed else offset
 
-    def stream_with_md5(self, ftp, file, cb):
-        hash_md5 = hashlib.md5()
         ftp.voidcmd('TYPE I')
-        with self.s3.open(file.cloud_url, 'rb') as fp, ftp.transfercmd(f'STOR {file.file_name}',
-                                                                       None) as conn:
-            while 1:
-                buf = fp.read(BLOCKSIZE)
-                if not buf:
-                    break
-                hash_md5.update(buf)
-                conn.sendall(buf)
-                cb(buf)
+        with self.open_s3(file, start) as fp, self.buffers.lease() as buffers, \
+                ftp.transfercmd(f'STOR {file.file_name}', offset or None) as conn:
+            sink = SkipBytes(offset - start, conn.sendall)
+            pipeline = Pipeline(IN_FLIGHT_BUFFERS, release=buffers.put) \
+                .source('s3_read', self.reader(fp, buffers, sink.progress(cb)))
+            if hasher.needed:
+                pipeline.stage('checksum', hasher.update)
+            stats = self.run_pipeline(file, pipeline.sink('ftp_send', sink))
         ftp.voidresp()
-        file.md5 = hash_md5.hexdigest()
+        size = start + stats['ftp_send'].bytes
+        self.set_checksums(file, hasher)
         file.ena_upload_path += file.file_name
-        ftp.storbinary(f'STOR {file.file_name}.md5', BytesIO(bytes(file.md5, 'utf-8')))
+        self.store_md5(ftp, file.file_name, file.md5, size)
+        return size
 
-    def stream_with_compression_and_md5(self, ftp, file, cb):
+    def stream_with_compression_and_md5(self, ftp, file, cb, offset=0):
+        """
+        the compressed output is deterministic, so compressed bytes before offset are
+        regenerated and hashed but not sent. compressing and hashing are stages of their
+        own so they run in parallel.
+        """
         fout = f'{file.file_name}.gz'
-        hash_md5 = hashlib.md5()
+        hasher = MultiHash(CHECKSUMS)
+        # one compressor per file so the output is a single gzip member
+        compressor = new_compressor(COMPRESSION_LEVEL, COMPRESSION_WORKERS)
+
         ftp.voidcmd('TYPE I')
-        with self.s3.open(file.cloud_url, 'rb') as fp, ftp.transfercmd(f'STOR {fout}',
-                                                                       None) as conn:
-            while 1:
-                buf = fp.read(BLOCKSIZE)
-                if not buf:
-                    break
-                cbuf = gzip.compress(buf)
-                hash_md5.update(cbuf)
-                conn.sendall(cbuf)
-                cb(buf)
+        try:
+            with self.open_s3(file) as fp, self.buffers.lease() as buffers, \
+                    ftp.transfercmd(f'STOR {fout}', offset or None) as conn:
+                sink = SkipBytes(offset, conn.sendall)
+                stats = self.run_pipeline(file, Pipeline(IN_FLIGHT_BUFFERS, release=buffers.put)
+                                          .source('s3_read', self.reader(fp, buffers, sink.progress(cb)))
+                                          .stage('compress', compressor.compress, compressor.flush)
+                                          .stage('checksum', hasher.update)
+                                          .sink('ftp_send', sink))
+        finally:
+            compressor.close()
         ftp.voidresp()
-        file.md5 = hash_md5.hexdigest()
+        if stats['ftp_send'].bytes:
+            metrics.COMPRESSION_RATIO.observe(stats['s3_read'].bytes / stats['ftp_send'].bytes)
+        self.set_checksums(file, hasher)
         file.compressed = True
         file.ena_upload_path += fout
-        ftp.storbinary(f'STOR {fout}.md5', BytesIO(bytes(file.md5, 'utf-8')))
+        self.store_md5(ftp, fout, file.md5, stats['ftp_send'].bytes)
+        return stats['ftp_send'].bytes
+
+    @staticmethod
+    def set_checksums(file, hasher: MultiHash):
+        file.checksums = hasher.hexdigests()
+        file.md5 = file.checksums[MD5]
+
+    def ledger_entry(self, file, output=None, size=None):
+        """
+        ledger entry of the file as resolved in S3, None if its ETag isn't known.
+        """
+        info = self.objects.get(file.cloud_url)
+        if not info:
+            return None
+        s3url = S3Url(file.cloud_url)
+        return LedgerEntry(f'{ENA_WEBIN_USER}@{ENA_FTP_HOST}', s3url.bucket, s3url.key, info.etag, output, size,
+                           file.md5, file.ena_upload_path, file.compressed)
+
+    def archived_before(self, file):
+        """
+        true if the same object was archived before, with the earlier result filled in.
+        """
+        key = self.ledger_entry(file)
+        entry = key and self.ledger.lookup(key.destination, key.bucket, key.key, key.etag)
+        if not entry:
+            return False
+        if LEDGER_VERIFY and not self.verify_remote(entry):
+            self.logger.info(f'{entry.ena_upload_path} missing or changed in ENA FTP, archiving again.')
+            self.ledger.remove(entry)
+            return False
+        self.logger.info(f'Skipping {file.file_name}, archived as {entry.ena_upload_path} on {entry.archived_at}.')
+        entry.restore(file)
+        return True
+
+    @staticmethod
+    def verify_remote(entry: LedgerEntry):
+        with ftp_pool.connection() as ftp:
+            for dir in posixpath.dirname(entry.ena_upload_path).split('/'):
+                if not FtpUploader.dir_exists(ftp, dir):
+                    return False
+                remote_index.chdir(ftp, dir)
+            return FtpUploader.indexed_file_size(ftp, entry.output) == entry.size
+
+    def record_archived(self, file, output, size):
+        entry = self.ledger_entry(file, output, size)
+        if entry:
+            self.ledger.record(entry)
+
+    @staticmethod
+    def store_md5(ftp, fout, md5, size):
+        """
+        upload the .md5 of fout, and record both in the remote index.
+        """
+        remote_index.add(ftp, fout, size=size)
+        ftp.storbinary(f'STOR {fout}.md5', BytesIO(bytes(md5, 'utf-8')))
+        remote_index.add(ftp, f'{fout}.md5', size=len(md5))
+
+    def open_s3(self, file, offset=0):
+        """
+        large objects are read with concurrent ranged GETs, small ones with a single stream.
+        """
+        if file.size > S3_PART_SIZE:
+            return RangedS3Reader(self.s3, file.cloud_url, file.size, S3_PART_SIZE, S3_READ_CONCURRENCY, offset)
+        fp = self.s3.open(file.cloud_url, 'rb')
+        fp.seek(offset)
+        return fp
+
+    @staticmethod
+    def reader(fp, buffers: BufferLease, cb):
+        """
+        reads into buffers of the pool, passed down the pipeline as memoryviews so the
+        blocks are hashed, compressed and sent without a copy.
+        """
+        def read():
+            buf = buffers.get()
+            n = readinto_full(fp, buf)
+            if not n:
+                buffers.put(buf)
+                return b''
+            cb(n)
+            return memoryview(buf)[:n]
+        return read
+
+    def run_pipeline(self, file, pipeline: Pipeline):
+        with self.trace.span('pipeline', file=file.file_name) as span:
+            stats = pipeline.run()
+            span.bytes = stats['s3_read'].bytes
+            span.attrs['stages'] = {name: {'busy': s.busy, 'wait': s.wait, 'bytes': s.bytes}
+                                    for name, s in stats.items()}
+        for name, stage_stats in stats.items():
+            metrics.STAGE_SECONDS.labels(name).inc(stage_stats.busy)
+            metrics.STAGE_WAIT_SECONDS.labels(name).inc(stage_stats.wait)
+        metrics.BYTES_READ.labels('stream').inc(stats['s3_read'].bytes)
+        metrics.BYTES_SENT.labels('stream').inc(stats['ftp_send'].bytes)
+        with self.stats_lock:
+            for name, stage_stats in stats.items():
+                self.stage_stats.setdefault(name, StageStats()).add(stage_stats)
+        self.logger.info(f'{file.file_name} stages: {format_stats(stats)}')
+        return stats
 
     def stream_with_compression_and_md5_using_tmpfile(self, ftp, fin, fout, cb):
         with self.s3.open(fin, 'rb') as f:
@@ -132,77 +347,112 @@ class S3FTPStreamer:
         return s3url.endswith('.gz') and self.s3.read_block(s3url, 0, 2) == b'\x1f\x8b'
 
     def start(self, res: DataArchiverResult):
-        total_size = 0
-        prefix_paths = {}
-        for file in res.files:
-            if not file.success:
-                continue
-
-            if self.s3.exists(file.cloud_url):
-                url = S3Url(file.cloud_url)
-                environment = url.bucket.split('-')[-1]
-                prefix_paths.setdefault(environment, {})[url.uuid] = f'{environment}/{url.uuid}'
-
-                size = self.s3.size(file.cloud_url)
-                total_size += size
-                file.size = size
-            else:
-                file.error = 'File not found in S3.'
-                file.success = False
+        try:
+            self._start(res)
+        finally:
+            self.ledger.close()
+        self.logger.info(f'Stream stages for all files: {format_stats(self.stage_stats)}')
+
+    def _start(self, res: DataArchiverResult):
+        with self.trace.span('s3_metadata', files=len(res.files)):
+            self.objects = self.metadata.resolve_files(res.files)
 
         total_files = len(res.files)
         num_files = sum(map(lambda f: f.success, res.files))
         if total_files != num_files:
             self.logger.info(f'{total_files - num_files} files not found.')
 
+        files = []
+        with self.trace.span('ledger') as span:
+            for file in res.files:
+                if not file.success:
+                    continue
+                if self.archived_before(file):
+                    metrics.FILES.labels('stream', 'archived_before').inc()
+                    self.done(file)
+                else:
+                    files.append(file)
+            span.attrs['archived_before'] = num_files - len(files)
+        if num_files != len(files):
+            self.logger.info(f'{num_files - len(files)} files archived before.')
+        num_files = len(files)
+
+        total_size = 0
+        prefix_paths = {}
+        for file in files:
+            url = S3Url(file.cloud_url)
+            environment = url.bucket.split('-')[-1]
+            prefix_paths.setdefault(environment, {})[url.uuid] = f'{environment}/{url.uuid}'
+            total_size += file.size
+
         # Create each environment/uuid directory once for all files
         # rather than have all files try to create it
-        for environment, uuids in prefix_paths.items():
-            with S3FTPStreamer.new_ftpcli() as ftp:
-                FtpUploader.chdir(ftp, environment)
-                for uuid in uuids.keys():
-                    FtpUploader.mk_dir(ftp, uuid)
-
-        if SINGLE_THREADED:
-            self.single_threaded_copy(res.files, num_files, total_size)
-        else:
-            self.multi_threaded_copy(res.files, num_files, total_size)
+        with self.trace.span('ftp_dirs'):
+            for environment, uuids in prefix_paths.items():
+                with ftp_pool.connection() as ftp:
+                    FtpUploader.chdir(ftp, environment)
+                    for uuid in uuids.keys():
+                        FtpUploader.mk_dir(ftp, uuid)
+
+        with self.trace.span('transfer', files=num_files) as span:
+            span.bytes = total_size
+            if SINGLE_THREADED:
+                self.single_threaded_copy(files, num_files, total_size)
+            else:
+                self.multi_threaded_copy(files, num_files, total_size)
 
     def multi_threaded_copy(self, files, num_files, total_size):
         self.logger.info('Streaming Multi Threaded...')
         pbar = self.get_progressbar(num_files, total_size)
-        pool = ThreadPool()  # cpu_count() DEFAULT_THREAD_COUNT=25
 
-        def cp(file_to_copy: FileResult):
-            if not file_to_copy.success:
-                return
-            try:
-                self.s3_ftp_stream(file_to_copy, pbar.update)
-            except Exception as ex:
-                logging.error(f'Failed to copy file via stream: {file_to_copy} error: {ex}')
-                file_to_copy.error = str(ex)
-                file_to_copy.success = False
+        def progress(nbytes):
+            pbar.update(nbytes)
+            self.concurrency.record(nbytes)
 
-        pool.map_async(cp, files)
-        pool.close()
-        pool.join()
-        pbar.close()
+        try:
+            TransferScheduler(controller=self.concurrency, share=self.share).run([f for f in files if f.success],
+                                                               lambda f: self.copy_file(f, progress))
+        finally:
+            pbar.close()
+        self.logger.info(f'Concurrency: {self.concurrency.snapshot()}')
 
     def single_threaded_copy(self, files, num_files, total_size):
         self.logger.info('Streaming Single Threaded...')
         with self.get_progressbar(num_files, total_size) as progress_bar:
             for file in files:
-                self.copy_file(file, progress_bar)
+                self.copy_file(file, progress_bar.update)
 
-    def copy_file(self, file: FileResult, progress_bar: tqdm):
+    def copy_file(self, file: FileResult, callback):
         if not file.success:
             return
-        try:
-            self.s3_ftp_stream(file, progress_bar.update)
-        except Exception as ex:
-            logging.error(f'Failed to copy file via stream: {file} error: {ex}')
-            file.error = str(ex)
-            file.success = False
+        if self.on_start:
+            self.on_start(file)
+        start = time.perf_counter()
+        # progress of the blocks added up rather than reported one by one
+        progress = BatchedProgress(callback)
+        with self.trace.span('file', file=file.file_name) as span:
+            span.bytes = file.size
+            try:
+                with metrics.ACTIVE_TRANSFERS.track_inprogress():
+                    try:
+                        self.s3_ftp_stream(file, progress)
+                    finally:
+                        progress.flush()
+                if file.success:
+                    metrics.FILES.labels('stream', 'archived').inc()
+                    metrics.FILE_SECONDS.labels('stream').observe(time.perf_counter() - start)
+            except Exception as ex:
+                logging.error(f'Failed to copy file via stream: {file} error: {ex}')
+                file.error = str(ex)
+                file.success = False
+                metrics.FILES.labels('stream', 'failed').inc()
+                metrics.error(ex)
+            span.attrs.update(output=file.ena_upload_path, success=file.success, error=file.error)
+        self.done(file)
+
+    def done(self, file: FileResult):
+        if self.on_done:
+            self.on_done(file)
 
     @staticmethod
     def get_progressbar(num_files, total_size):
@@ -215,4 +465,5 @@ class S3FTPStreamer:
         )
 
     def close(self):
+        self.ledger.close()
         s3fs.S3FileSystem.close_session(None, self.s3)
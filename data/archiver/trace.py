@@ -0,0 +1,161 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import List, Optional
+
+from data.archiver.config import TRACE_DIR
+
+# the trace profiling the current thread, if any
+_profiling = threading.local()
+
+
+def profiled(target):
+    """
+    target wrapped to be profiled by the trace profiling the calling thread, target itself if
+    none is. Threads doing a request's work are started with it, so only they are profiled.
+    """
+    trace = getattr(_profiling, 'trace', None)
+    if not trace:
+        return target
+
+    def run(*args, **kwargs):
+        return trace.run_profiled(target, *args, **kwargs)
+    return run
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: float = field(default=None)
+    bytes: int = field(default=0)
+    attrs: dict = field(default_factory=dict)
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        span = asdict(self)
+        span['duration'] = self.duration
+        span['throughput'] = self.bytes / self.duration if self.bytes and self.duration else None
+        return span
+
+
+class RequestTrace:
+    """
+    Timeline of one archiving request: a span per phase (ingest listing, S3 metadata,
+    FTP directories, transfers, patching) and per file, written as json next to the
+    other archiver data when the request is done.
+
+    With start_profile(), the calling thread and the threads it starts through profiled()
+    (transfer workers, their pipeline stages and hash workers, and the threads those start)
+    are profiled with cProfile as well, the merged stats are written alongside the trace.
+    Threads of other requests running at the same time are not.
+    """
+
+    def __init__(self, sub_uuid=None, path=TRACE_DIR):
+        self.sub_uuid = sub_uuid
+        self.path = path
+        self.start = time.time()
+        self.end = None
+        self.spans: List[Span] = []
+        self.profile_path: Optional[str] = None
+        self._profiles: List[cProfile.Profile] = []
+        # of the thread that called start_profile()
+        self._profile: Optional[cProfile.Profile] = None
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = Span(name, time.time(), attrs=attrs)
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+            with self._lock:
+                self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            spans = [span.to_dict() for span in sorted(self.spans, key=lambda s: s.start)]
+        return {
+            'sub_uuid': self.sub_uuid,
+            'start': self.start,
+            'end': self.end,
+            'duration': (self.end or time.time()) - self.start,
+            'profile': self.profile_path,
+            'spans': spans
+        }
+
+    def write(self) -> str:
+        """
+        finish the trace and write it, returns the json file path.
+        """
+        self.end = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        # batches of the same submission may start in the same second
+        name = os.path.join(self.path, f'{self.sub_uuid}-{datetime.utcfromtimestamp(self.start):%Y%m%dT%H%M%S}'
+                                       f'-{uuid.uuid4().hex[:8]}')
+        if self._profile:
+            self.profile_path = self._stop_profile(f'{name}.prof')
+        with open(f'{name}.json', 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        self.logger.info(f'Request trace written to {name}.json')
+        return f'{name}.json'
+
+    def start_profile(self):
+        """
+        profile the calling thread until write(), which has to be called from it too.
+        """
+        self._profile = self._enable_profile()
+        if self._profile:
+            _profiling.trace = self
+        else:
+            self.logger.warning('Request not profiled, another profiler is active.')
+
+    def run_profiled(self, target, *args, **kwargs):
+        profile = self._enable_profile()
+        _profiling.trace = self
+        try:
+            return target(*args, **kwargs)
+        finally:
+            _profiling.trace = None
+            if profile:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+
+    @staticmethod
+    def _enable_profile() -> Optional[cProfile.Profile]:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in the thread
+            return None
+        return profile
+
+    def _stop_profile(self, path):
+        _profiling.trace = None
+        self._profile.disable()
+        with self._lock:
+            profiles, self._profiles = [self._profile, *self._profiles], []
+        self._profile = None
+        for profile in profiles:
+            profile.create_stats()
+        profiles = [profile for profile in profiles if profile.stats]
+        if not profiles:
+            return None
+        pstats.Stats(*profiles).dump_stats(path)
+        return path
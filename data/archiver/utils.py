@@ -1,21 +1,75 @@
-import hashlib
+import os
 import uuid
-import gzip
-import shutil
 import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional
 
-def md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+from data.archiver.checksum import MD5, HashWorker, algorithm_names, file_checksums
+from data.archiver.compression import DEFAULT_COMPRESSION_LEVEL, gzip_stream
+from data.archiver.config import CHECKSUMS, LOCAL_READ_SIZE
 
+@dataclass
+class Checksums:
+    md5: str
+    # bytes of the checksummed output
+    size: int
+    crc32: Optional[int] = None
+    # hex digests by algorithm, md5 included
+    digests: Dict[str, str] = field(default_factory=dict)
 
-def compress(fname: str):
+    @classmethod
+    def from_digests(cls, digests: Dict[str, str], size, crc=False):
+        return cls(digests[MD5], size, int(digests['crc32'], 16) if crc else None, digests)
+
+
+def md5(fname, read_size=LOCAL_READ_SIZE):
+    return file_checksums(fname, (MD5,), read_size)[0][MD5]
+
+
+def compress(fname: str, level=DEFAULT_COMPRESSION_LEVEL, workers=1):
     with open(fname, 'rb') as f_in:
-        with gzip.open(f'{fname}.gz', 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+        with open(f'{fname}.gz', 'wb') as f_out:
+            for chunk in gzip_stream(f_in, level, workers=workers):
+                f_out.write(chunk)
+
+
+def compress_md5(fname: str, out: str, level=DEFAULT_COMPRESSION_LEVEL, workers=1, read_size=LOCAL_READ_SIZE,
+                 crc=False, names: Iterable[str] = CHECKSUMS) -> Checksums:
+    """
+    compress fname to out in one pass, the checksums (and crc32 if asked) of the compressed
+    output are computed on a worker thread as it is written and the md5 saved to out.md5.
+    """
+    size = 0
+    with open(fname, 'rb') as f_in, open(out, 'wb') as f_out, \
+            HashWorker(algorithm_names([*names, 'crc32'] if crc else names)) as hasher:
+        for chunk in gzip_stream(f_in, level, read_size=read_size, workers=workers):
+            hasher.update(chunk)
+            size += len(chunk)
+            f_out.write(chunk)
+        digests = hasher.hexdigests()
+    return _write_md5(out, Checksums.from_digests(digests, size, crc))
+
+
+def checksum(fname: str, read_size=LOCAL_READ_SIZE, crc=False, names: Iterable[str] = CHECKSUMS,
+             known: Dict[str, str] = None) -> Checksums:
+    """
+    checksums (and crc32 if asked) of a file that is uploaded as it is, the md5 saved to
+    fname.md5. Digests already known, e.g. from S3, are not computed again and the file
+    isn't read at all if they are all known.
+    """
+    names = algorithm_names([*names, 'crc32'] if crc else names)
+    known = {name: digest for name, digest in (known or {}).items() if name in names}
+    if all(name in known for name in names):
+        digests, size = known, os.path.getsize(fname)
+    else:
+        digests, size = file_checksums(fname, names, read_size, known)
+    return _write_md5(fname, Checksums.from_digests(digests, size, crc))
+
+
+def _write_md5(fname, checksums: Checksums) -> Checksums:
+    with open(f'{fname}.md5', 'w') as f:
+        f.write(checksums.md5)
+    return checksums
 
 
 def valid_uuid(val):
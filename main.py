@@ -3,9 +3,11 @@ import logging
 import sys
 from threading import Thread
 
-from data.archiver.config import RABBIT_HOST, RABBIT_PORT, EXCHANGE, EXCHANGE_TYPE, SUBSCRIBE_QUEUE, SUBSCRIBE_ROUTING_KEY, PUBLISH_ROUTING_KEY, RETRY_POLICY
+from data.archiver.config import RABBIT_HOST, RABBIT_PORT, EXCHANGE, EXCHANGE_TYPE, SUBSCRIBE_QUEUE, SUBSCRIBE_ROUTING_KEY, PUBLISH_ROUTING_KEY, RETRY_POLICY, METRICS_PORT, \
+    WORK_QUEUE, WORK_ROUTING_KEY
 from data.archiver.listener import Listener
 from data.archiver.dataclass import AmqpConnConfig, QueueConfig
+from data.archiver.metrics import start_metrics_server
 
 
 def setup() -> Thread:
@@ -13,8 +15,9 @@ def setup() -> Thread:
 
     sub_queue_config = QueueConfig(SUBSCRIBE_QUEUE, SUBSCRIBE_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, False, None)
     pub_queue_config = QueueConfig(None, PUBLISH_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, True, RETRY_POLICY)
+    work_queue_config = QueueConfig(WORK_QUEUE, WORK_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, False, None)
 
-    listener = Listener(amqp_conn_config, sub_queue_config, pub_queue_config)
+    listener = Listener(amqp_conn_config, sub_queue_config, pub_queue_config, work_queue_config)
 
     listener_process = Thread(target=lambda: listener.run())
     listener_process.start()
@@ -30,5 +33,8 @@ if __name__ == '__main__':
     logging.basicConfig(stream=sys.stdout, level=logging.WARNING,
                         format=format)
 
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+
     setup()
     logging.getLogger('ingest-data-archiver').info("Ingest data archiver listening...")
@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+from contextlib import asynccontextmanager
+
+from botocore.exceptions import ClientError
+
+from data.archiver.async_stream import AsyncS3FTPStreamer
+from data.archiver.budget import ResourceBudget
+from data.archiver.dataclass import FileResult
+
+
+def file_result(n, size=100):
+    return FileResult(f'uuid-{n}', f'reads_{n}.fq', f's3://bucket-dev/sub/reads_{n}.fq', size=size)
+
+
+class TestTransferSlot(unittest.TestCase):
+
+    def test_slots_shared_with_other_requests(self):
+        budget = ResourceBudget(slots=2)
+        running = []
+        peak = []
+
+        async def transfer(streamer, file):
+            async with streamer.transfer_slot(file):
+                running.append(file.uuid)
+                peak.append(budget.active)
+                await asyncio.sleep(0.05)
+                running.remove(file.uuid)
+
+        with budget.share('other') as other, budget.share('async') as share:
+            # another request's transfer holds one of the two slots
+            with other.slot():
+                streamer = AsyncS3FTPStreamer(share=share)
+
+                async def run():
+                    await asyncio.gather(*(transfer(streamer, file_result(n)) for n in range(3)))
+
+                asyncio.run(run())
+                streamer.slot_executor.shutdown()
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(budget.active, 0)
+
+    def test_ftp_login_after_slot(self):
+        budget = ResourceBudget(slots=1)
+        events = []
+
+        @asynccontextmanager
+        async def ftp_client():
+            events.append('login')
+            raise IOError('stop')
+            yield
+
+        with budget.share('other') as other, budget.share('async') as share:
+            streamer = AsyncS3FTPStreamer(share=share)
+            streamer.ftp_client = ftp_client
+            # another request's transfer holds the only slot
+            budget.acquire(other)
+
+            async def run():
+                task = asyncio.ensure_future(streamer.s3_ftp_stream(file_result(0), None))
+                await asyncio.sleep(0.1)
+                events.append('released')
+                budget.release(other)
+                with self.assertRaises(IOError):
+                    await task
+
+            asyncio.run(run())
+            streamer.slot_executor.shutdown()
+        self.assertEqual(events, ['released', 'login'])
+        self.assertEqual(budget.active, 0)
+
+
+class FailingS3:
+
+    def __init__(self, code):
+        self.code = code
+
+    async def head_object(self, **kwargs):
+        raise ClientError({'Error': {'Code': self.code, 'Message': self.code}}, 'HeadObject')
+
+
+class TestHead(unittest.TestCase):
+
+    def head(self, code):
+        streamer = AsyncS3FTPStreamer()
+        file = file_result(0)
+
+        async def run():
+            streamer.s3 = FailingS3(code)
+            streamer.s3_semaphore = asyncio.Semaphore(1)
+            await streamer.head(file)
+
+        asyncio.run(run())
+        self.assertFalse(file.success)
+        return file.error
+
+    def test_not_found(self):
+        self.assertEqual(self.head('404'), 'File not found in S3.')
+        self.assertEqual(self.head('NoSuchKey'), 'File not found in S3.')
+
+    def test_other_errors_not_reported_as_not_found(self):
+        self.assertIn('AccessDenied', self.head('AccessDenied'))
+        self.assertIn('SlowDown', self.head('SlowDown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+
+from data.archiver.budget import ResourceBudget
+
+
+class Holder:
+    """
+    holds a slot of a share on its own thread until released.
+    """
+
+    def __init__(self, share, nbytes=0):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(share, nbytes), daemon=True)
+        self.thread.start()
+
+    def run(self, share, nbytes):
+        with share.slot(nbytes):
+            self.started.set()
+            self.release.wait()
+
+    def stop(self):
+        self.release.set()
+        self.thread.join()
+
+
+class TestResourceBudget(unittest.TestCase):
+
+    def hold(self, share, n, nbytes=0):
+        holders = [Holder(share, nbytes) for _ in range(n)]
+        time.sleep(0.1)
+        return holders
+
+    def started(self, holders):
+        return sum(holder.started.is_set() for holder in holders)
+
+    def test_slots_limited(self):
+        budget = ResourceBudget(slots=2)
+        with budget.share('a') as share:
+            holders = self.hold(share, 4)
+            self.assertEqual(self.started(holders), 2)
+            for holder in holders:
+                holder.stop()
+        self.assertEqual(budget.active, 0)
+
+    def test_slot_kept_for_idle_request(self):
+        budget = ResourceBudget(slots=4)
+        with budget.share('large') as large, budget.share('small') as small:
+            holders = self.hold(large, 4)
+            self.assertEqual(self.started(holders), 3)
+            small_holder = self.hold(small, 1)
+            self.assertEqual(self.started(small_holder), 1)
+            for holder in holders + small_holder:
+                holder.stop()
+
+    def test_freed_slot_goes_to_request_below_its_share(self):
+        budget = ResourceBudget(slots=4)
+        with budget.share('large') as large:
+            holders = self.hold(large, 4)
+            self.assertEqual(self.started(holders), 4)
+            with budget.share('small') as small:
+                small_holders = self.hold(small, 2)
+                more = self.hold(large, 1)
+                self.assertEqual(self.started(small_holders), 0)
+
+                holders[0].stop()
+                time.sleep(0.1)
+                self.assertEqual(self.started(small_holders), 1)
+                self.assertEqual(self.started(more), 0)
+
+                holders[1].stop()
+                time.sleep(0.1)
+                self.assertEqual(self.started(small_holders), 2)
+                self.assertEqual(self.started(more), 0)
+                for holder in holders[2:] + small_holders + more:
+                    holder.stop()
+
+    def test_bytes_limited(self):
+        budget = ResourceBudget(slots=4, max_bytes=100)
+        with budget.share('a') as share:
+            holders = self.hold(share, 3, nbytes=40)
+            self.assertEqual(self.started(holders), 2)
+            holders[0].stop()
+            time.sleep(0.1)
+            self.assertEqual(self.started(holders), 3)
+            for holder in holders[1:]:
+                holder.stop()
+
+            # larger than the budget, runs alone
+            large = self.hold(share, 1, nbytes=1000)
+            self.assertEqual(self.started(large), 1)
+            large[0].stop()
+
+    def test_bytes_dont_starve_other_request(self):
+        budget = ResourceBudget(slots=8, max_bytes=200)
+        with budget.share('large') as large, budget.share('small') as small:
+            holders = self.hold(large, 2, nbytes=100)
+            self.assertEqual(self.started(holders), 2)
+            more = self.hold(large, 1, nbytes=1)
+            self.assertEqual(self.started(more), 0)
+
+            # nothing of its own in flight, starts although the bytes are all in use
+            small_holders = self.hold(small, 2, nbytes=1)
+            self.assertEqual(self.started(small_holders), 1)
+            for holder in holders + more + small_holders:
+                holder.stop()
+        self.assertEqual(budget.bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
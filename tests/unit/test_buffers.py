@@ -0,0 +1,85 @@
+import io
+import threading
+import time
+import unittest
+
+from data.archiver.buffers import BufferPool, BatchedProgress, readinto_full
+
+
+class ShortReads(io.RawIOBase):
+    """
+    returns at most 3 bytes per read.
+    """
+
+    def __init__(self, data):
+        self.fp = io.BytesIO(data)
+
+    def readinto(self, b):
+        return self.fp.readinto(memoryview(b)[:3])
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_buffers_reused(self):
+        pool = BufferPool(16, 2)
+        with pool.lease() as lease:
+            buf = lease.get()
+            lease.put(memoryview(buf)[:4])
+            self.assertIs(lease.get(), buf)
+        self.assertEqual(pool.allocated, 1)
+        self.assertEqual(pool.in_use, 0)
+
+    def test_get_waits_for_buffer(self):
+        pool = BufferPool(16, 1)
+        got = threading.Event()
+        with pool.lease() as lease:
+            buf = lease.get()
+            threading.Thread(target=lambda: (pool.get(), got.set()), daemon=True).start()
+            time.sleep(0.1)
+            self.assertFalse(got.is_set())
+            lease.put(buf)
+            self.assertTrue(got.wait(1))
+        self.assertEqual(pool.allocated, 1)
+
+    def test_lease_gives_back_on_close(self):
+        pool = BufferPool(16, 4)
+        with self.assertRaises(IOError):
+            with pool.lease() as lease:
+                lease.get()
+                lease.get()
+                # output of a stage, not from the pool
+                lease.put(b'compressed')
+                raise IOError('send failed')
+        self.assertEqual(pool.in_use, 0)
+
+    def test_readinto_full(self):
+        buf = bytearray(8)
+        fp = ShortReads(b'0123456789')
+        self.assertEqual(readinto_full(fp, buf), 8)
+        self.assertEqual(buf, b'01234567')
+        self.assertEqual(readinto_full(fp, buf), 2)
+        self.assertEqual(readinto_full(fp, buf), 0)
+
+
+class TestBatchedProgress(unittest.TestCase):
+
+    def test_batched(self):
+        updates = []
+        progress = BatchedProgress(updates.append, interval=60)
+        for _ in range(100):
+            progress(10)
+        self.assertEqual(updates, [])
+        progress.flush()
+        progress.flush()
+        self.assertEqual(updates, [1000])
+
+    def test_interval(self):
+        updates = []
+        progress = BatchedProgress(updates.append, interval=0)
+        progress(10)
+        progress(5)
+        self.assertEqual(updates, [10, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import base64
+import hashlib
+import os
+import tempfile
+import unittest
+import zlib
+from unittest.mock import patch
+
+from data.archiver.checksum import HashWorker, MultiHash, algorithm_names, file_checksums, s3_checksums
+
+DATA = b''.join(b'@read%d\nACGTNACGT%d\n+\nFFFFFFFFF\n' % (i, i % 97) for i in range(20000))
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+
+def digests(data):
+    return {'md5': hashlib.md5(data).hexdigest(), 'sha256': hashlib.sha256(data).hexdigest(),
+            'crc32': f'{zlib.crc32(data):08x}'}
+
+
+class TestMultiHash(unittest.TestCase):
+
+    def test_algorithm_names(self):
+        self.assertEqual(algorithm_names(['sha256', ' CRC32 ', '']), ('md5', 'sha256', 'crc32'))
+        self.assertEqual(algorithm_names(['sha1', 'md5']), ('md5', 'sha1'))
+        with self.assertRaises(ValueError):
+            algorithm_names(['sha512'])
+
+    @unittest.skipIf(crc32c, 'crc32c installed')
+    def test_crc32c_needs_package(self):
+        with self.assertRaises(ValueError):
+            algorithm_names(['crc32c'])
+
+    @unittest.skipUnless(crc32c, 'crc32c not installed')
+    def test_crc32c(self):
+        hasher = MultiHash(['crc32c'])
+        hasher.update(DATA)
+        self.assertEqual(hasher.hexdigests()['crc32c'], f'{crc32c.crc32c(DATA):08x}')
+
+    def test_one_pass(self):
+        hasher = MultiHash(['sha256', 'crc32'])
+        for i in range(0, len(DATA), 1000):
+            hasher.update(memoryview(DATA)[i:i + 1000])
+        self.assertEqual(hasher.hexdigests(), digests(DATA))
+
+    def test_known_not_computed(self):
+        hasher = MultiHash(['sha256'], known={'md5': 'etag-md5'})
+        self.assertTrue(hasher.needed)
+        hasher.update(DATA)
+        self.assertEqual(hasher.hexdigests(), {'md5': 'etag-md5', 'sha256': digests(DATA)['sha256']})
+        self.assertFalse(MultiHash(['md5'], known={'md5': 'etag-md5'}).needed)
+
+    def test_worker(self):
+        released = []
+        with HashWorker(['sha256', 'crc32'], max_pending=1) as hasher:
+            for i in range(0, len(DATA), 1000):
+                hasher.update(DATA[i:i + 1000], released.append)
+            self.assertEqual(hasher.hexdigests(), digests(DATA))
+        self.assertEqual(len(released), -(-len(DATA) // 1000))
+
+    def test_worker_error(self):
+        hasher = HashWorker()
+        hasher.update('not bytes')
+        with self.assertRaises(TypeError):
+            hasher.hexdigests()
+
+
+class TestFileChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'reads.fq')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_file_checksums(self):
+        self.assertEqual(file_checksums(self.path, ['sha256', 'crc32'], read_size=1000), (digests(DATA), len(DATA)))
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(file_checksums(self.path), ({'md5': hashlib.md5(b'').hexdigest()}, 0))
+
+    def test_known_checksums_not_read(self):
+        with patch('data.archiver.utils.file_checksums') as computed:
+            from data.archiver.utils import checksum
+            checksums = checksum(self.path, names=['md5'], known={'md5': 'etag-md5', 'sha1': 'other'})
+        computed.assert_not_called()
+        self.assertEqual(checksums.md5, 'etag-md5')
+        self.assertEqual(checksums.digests, {'md5': 'etag-md5'})
+        self.assertEqual(checksums.size, len(DATA))
+
+
+class TestS3Checksums(unittest.TestCase):
+    md5 = hashlib.md5(DATA).hexdigest()
+    sha256 = base64.b64encode(hashlib.sha256(DATA).digest()).decode()
+
+    def test_single_part(self):
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}"', 'ChecksumSHA256': self.sha256}),
+                         {'md5': self.md5, 'sha256': digests(DATA)['sha256']})
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}"'}, etag_md5=False), {})
+
+    def test_multipart(self):
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}-3"', 'ChecksumSHA256': f'{self.sha256}-3'}), {})
+
+    def test_encrypted(self):
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}"', 'ServerSideEncryption': 'aws:kms'}), {})
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}"', 'SSECustomerAlgorithm': 'AES256'}), {})
+        self.assertEqual(s3_checksums({'ETag': f'"{self.md5}"', 'ServerSideEncryption': 'AES256'}),
+                         {'md5': self.md5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+import io
+import os
+import unittest
+import zlib
+
+from data.archiver.checksum import MultiHash
+from data.archiver.compression import GzipCompressor, ParallelGzipCompressor, gzip_stream
+
+
+class TestGzipCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b''.join(b'@read%d\nACGTACGTNNACGT\n+\nIIIIIIIIIIIIII\n' % i for i in range(20000)) + os.urandom(5000)
+
+    def test_single_gzip_member(self):
+        compressor = GzipCompressor()
+        out = b''.join(compressor.compress(self.data[i:i + 8192]) for i in range(0, len(self.data), 8192))
+        out += compressor.flush()
+
+        self.assertEqual(gzip.decompress(out), self.data)
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(d.decompress(out), self.data)
+        self.assertEqual(d.unused_data, b'')
+        self.assertTrue(d.eof)
+
+    def test_gzip_stream(self):
+        hasher = MultiHash(['md5'])
+        chunks = []
+        for chunk in gzip_stream(io.BytesIO(self.data), level=1, read_size=4096):
+            hasher.update(chunk)
+            chunks.append(chunk)
+        out = b''.join(chunks)
+        self.assertEqual(gzip.decompress(out), self.data)
+        # the md5 computed chunk by chunk as streamed is the one of the whole output
+        self.assertEqual(hasher.hexdigests()['md5'], hashlib.md5(out).hexdigest())
+        self.assertEqual(b''.join(gzip_stream(io.BytesIO(self.data), level=1, read_size=1024 * 1024)), out)
+
+
+class TestParallelGzipCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b''.join(b'@read%d\nACGTACGTNNACGT\n+\nIIIIIIIIIIIIII\n' % i for i in range(50000)) + os.urandom(70000)
+
+    def compress(self, data, block_size):
+        compressor = ParallelGzipCompressor(level=6, workers=4, chunk_size=64 * 1024)
+        out = b''.join(compressor.compress(data[i:i + block_size]) for i in range(0, len(data), block_size))
+        return out + compressor.flush()
+
+    def test_single_gzip_member(self):
+        out = self.compress(self.data, 10000)
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(d.decompress(out), self.data)
+        self.assertEqual(d.unused_data, b'')
+        self.assertTrue(d.eof)
+
+    def test_output_independent_of_read_size(self):
+        self.assertEqual(self.compress(self.data, 1000), self.compress(self.data, 300000))
+
+    def test_empty_input(self):
+        self.assertEqual(gzip.decompress(self.compress(b'', 1000)), b'')
+
+    def test_chunk_boundary(self):
+        data = self.data[:64 * 1024 * 3]
+        self.assertEqual(gzip.decompress(self.compress(data, 64 * 1024)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
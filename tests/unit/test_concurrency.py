@@ -0,0 +1,81 @@
+import ftplib
+import threading
+import time
+import unittest
+
+from data.archiver.concurrency import AdaptiveConcurrency, ftp_concurrency, is_congestion
+from data.archiver.stream import S3FTPStreamer
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def window(self, controller, nbytes=0, error=None):
+        """
+        close the current window after recording nbytes and error.
+        """
+        controller._window_start -= controller.interval
+        if error:
+            controller.record_error(error)
+        controller.record(nbytes)
+
+    def test_increase_while_throughput_improves(self):
+        controller = AdaptiveConcurrency(initial=2, floor=1, ceiling=3, interval=60)
+        controller.stats.active = 2
+        self.window(controller, 100)
+        self.assertEqual(controller.limit, 3)
+        controller.stats.active = 3
+        self.window(controller, 1000)
+        self.assertEqual(controller.limit, 3, 'limited by ceiling')
+        self.assertEqual(controller.snapshot().increases, 1)
+
+    def test_hold_on_plateau_or_unused_slots(self):
+        controller = AdaptiveConcurrency(initial=2, floor=1, ceiling=8, interval=60)
+        controller.stats.active = 1
+        self.window(controller, 100)
+        self.assertEqual(controller.limit, 2, 'slots not all in use')
+        controller.stats.active = 2
+        controller.stats.rate = 1000 ** 2
+        self.window(controller, 1)
+        self.assertEqual(controller.limit, 2)
+
+    def test_decrease_on_congestion(self):
+        controller = AdaptiveConcurrency(initial=8, floor=3, ceiling=8, interval=60)
+        self.window(controller, 100, ftplib.error_temp('421 Too many connections'))
+        self.assertEqual(controller.limit, 4)
+        self.window(controller, 100, TimeoutError())
+        self.assertEqual(controller.limit, 3, 'limited by floor')
+        self.assertEqual(controller.snapshot().errors, 2)
+
+    def test_file_errors_ignored(self):
+        self.assertFalse(is_congestion(ftplib.error_perm('550 Permission denied')))
+        controller = AdaptiveConcurrency(initial=4, floor=1, ceiling=8, interval=60)
+        self.window(controller, 0, ftplib.error_perm('550 Permission denied'))
+        self.assertEqual(controller.limit, 4)
+
+    def test_slots_bounded_by_limit(self):
+        controller = AdaptiveConcurrency(initial=2, floor=1, ceiling=8, interval=60)
+        peak = []
+        lock = threading.Lock()
+
+        def transfer():
+            with controller.slot():
+                with lock:
+                    peak.append(controller.stats.active)
+                time.sleep(0.05)
+
+        threads = [threading.Thread(target=transfer) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(controller.stats.active, 0)
+
+    def test_shared_by_requests(self):
+        # the limit cut by one request's errors still holds for the next
+        self.assertIs(S3FTPStreamer().concurrency, ftp_concurrency)
+        self.assertIs(S3FTPStreamer().concurrency, ftp_concurrency)
+
+
+if __name__ == '__main__':
+    unittest.main()
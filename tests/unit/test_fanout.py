@@ -0,0 +1,195 @@
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest.mock import patch, MagicMock
+
+from kombu import Connection, Exchange, Queue
+
+from data.archiver.config import EXCHANGE, EXCHANGE_TYPE, SUBSCRIBE_QUEUE, SUBSCRIBE_ROUTING_KEY, \
+    PUBLISH_ROUTING_KEY, WORK_QUEUE, WORK_ROUTING_KEY, WORK_DONE_ROUTING_KEY
+from data.archiver.dataclass import DataArchiverRequest, DataArchiverResult, FileResult, QueueConfig
+from data.archiver.fanout import FanOut, split_batches
+from data.archiver.jobs import SqliteJobStore, FAILED, job_id
+from data.archiver.listener import _Listener
+
+MB = 1024 * 1024
+
+
+def file_result(n, size):
+    return FileResult(f'uuid-{n}', f'reads_{n}.fq', f's3://bucket/sub/reads_{n}.fq', size=size)
+
+
+class TestSplitBatches(unittest.TestCase):
+
+    def test_balanced_by_size(self):
+        files = [file_result(n, size) for n, size in enumerate([90, 50, 40, 30, 20, 10, 10])]
+        batches = split_batches(files, batch_bytes=100, batch_files=100)
+
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(sorted(f.uuid for batch in batches for f in batch), sorted(f.uuid for f in files))
+        self.assertEqual(sorted(sum(f.size for f in batch) for batch in batches), [80, 80, 90])
+
+    def test_files_per_batch(self):
+        batches = split_batches([file_result(n, 1) for n in range(10)], batch_bytes=MB, batch_files=4)
+        self.assertEqual([len(batch) for batch in batches], [4, 3, 3])
+
+    def test_at_most_one_batch_per_file(self):
+        self.assertEqual(len(split_batches([file_result(0, 10 * MB)], batch_bytes=MB)), 1)
+        self.assertEqual(split_batches([]), [])
+
+
+class TestFanOutListener(unittest.TestCase):
+    """
+    requests fanned out and archived by listeners over the in-memory transport.
+    """
+
+    def setUp(self):
+        self.connection = Connection('memory://')
+        self.exchange = Exchange(EXCHANGE, EXCHANGE_TYPE)
+        self.sub_queue_config = QueueConfig(SUBSCRIBE_QUEUE, SUBSCRIBE_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE,
+                                            False, None)
+        self.pub_queue_config = QueueConfig(None, PUBLISH_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, False, None)
+        self.work_queue_config = QueueConfig(WORK_QUEUE, WORK_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, False, None)
+        self.results = self.connection.SimpleQueue(Queue('test.results', self.exchange, PUBLISH_ROUTING_KEY))
+        self.files = [file_result(n, (n + 1) * MB) for n in range(7)]
+        self.batches = []
+        self.lock = threading.Lock()
+        self.patches = [patch('data.archiver.listener.Ingest', MagicMock()),
+                        patch('data.archiver.listener.AwsS3', MagicMock()),
+                        patch('data.archiver.listener._Listener.archive', self.archive),
+                        patch.object(FanOut, 'files', self.submission_files),
+                        patch('data.archiver.listener.FanOut', partial(FanOut, batch_bytes=10 * MB))]
+        for p in self.patches:
+            p.start()
+        # two archivers listening on the same queues
+        self.listeners = [_Listener(self.connection.clone(), self.sub_queue_config, self.pub_queue_config,
+                                    ThreadPoolExecutor(2), prefetch=2, work_queue_config=self.work_queue_config)
+                          for _ in range(2)]
+        self.threads = [threading.Thread(target=listener.run, daemon=True) for listener in self.listeners]
+        for thread in self.threads:
+            thread.start()
+
+    def tearDown(self):
+        for listener in self.listeners:
+            listener.should_stop = True
+        for thread in self.threads:
+            thread.join(5)
+        for p in self.patches:
+            p.stop()
+        self.results.close()
+        self.connection.release()
+
+    def submission_files(self, req):
+        return DataArchiverResult(req.sub_uuid, files=[FileResult(**vars(f)) for f in self.files])
+
+    def archive(self, req):
+        with self.lock:
+            self.batches.append(list(req.files))
+        return DataArchiverResult(req.sub_uuid, files=[
+            FileResult(u, f'{u}.fq.gz', '', compressed=True, md5=f'md5-{u}', success=u != 'uuid-3',
+                       error='FTP upload error' if u == 'uuid-3' else None)
+            for u in req.files])
+
+    def request(self, **body):
+        with self.connection.clone() as conn:
+            conn.Producer().publish(dict(sub_uuid=str(uuid.uuid4()), **body), exchange=self.exchange,
+                                    routing_key=SUBSCRIBE_ROUTING_KEY, serializer='json', declare=[self.exchange])
+
+    def result(self):
+        msg = self.results.get(timeout=10)
+        msg.ack()
+        return DataArchiverResult.from_dict(msg.payload)
+
+    def test_fan_out(self):
+        self.request(fan_out=True)
+        result = self.result()
+
+        # 28M in batches of at most 10M
+        self.assertEqual(len(self.batches), 3)
+        self.assertEqual(sorted(u for batch in self.batches for u in batch), [f.uuid for f in self.files])
+        self.assertEqual(sorted(f.uuid for f in result.files), [f.uuid for f in self.files])
+        archived = {f.uuid: f for f in result.files}
+        self.assertEqual(archived['uuid-0'].md5, 'md5-uuid-0')
+        self.assertTrue(archived['uuid-0'].compressed)
+        self.assertFalse(archived['uuid-3'].success)
+        self.assertFalse(result.success)
+        self.assertEqual(result.error, '1 file(s) failed to archived.')
+
+    def test_without_fan_out(self):
+        self.request(files=['uuid-1', 'uuid-2'])
+        result = self.result()
+
+        self.assertEqual(self.batches, [['uuid-1', 'uuid-2']])
+        self.assertTrue(result.success)
+        self.assertEqual([f.file_name for f in result.files], ['uuid-1.fq.gz', 'uuid-2.fq.gz'])
+
+    def test_resumed_after_restart(self):
+        jobs_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(jobs_dir.cleanup)
+        store = SqliteJobStore(os.path.join(jobs_dir.name, 'jobs.sqlite'))
+        req = DataArchiverRequest(str(uuid.uuid4()))
+        all_published = threading.Event()
+
+        class Restarted(FanOut):
+            """
+            stops after the first batch result, once every batch has been archived.
+            """
+
+            def record(self, req, batch, result):
+                super().record(req, batch, result)
+                all_published.wait(10)
+                raise SystemExit('restart')
+
+        def archive(listener, req):
+            result = self.archive(req)
+            if len(self.batches) == 3:
+                all_published.set()
+            return result
+
+        with patch('data.archiver.listener._Listener.archive', archive):
+            with self.assertRaises(SystemExit):
+                Restarted(self.connection, self.work_queue_config, MagicMock(), MagicMock(), batch_bytes=10 * MB,
+                          jobs=store).run(req)
+            result = FanOut(self.connection, self.work_queue_config, MagicMock(), MagicMock(),
+                            batch_bytes=10 * MB, timeout=10, jobs=store).run(req)
+
+        # the batches aren't archived again, the results of the others waited for on the queue
+        self.assertEqual(len(self.batches), 3)
+        self.assertEqual(sorted(f.uuid for f in result.files), [f.uuid for f in self.files])
+        archived = {f.uuid: f for f in result.files}
+        self.assertEqual(archived['uuid-0'].md5, 'md5-uuid-0')
+        self.assertFalse(archived['uuid-3'].success)
+        self.assertEqual(store.get_job(job_id(req)).state, FAILED)
+        # deleted once the job is finished
+        with self.connection.clone() as conn:
+            with self.assertRaises(Exception):
+                conn.default_channel.queue_declare(f'{WORK_DONE_ROUTING_KEY}.{job_id(req)}.queue', passive=True)
+        store.close()
+
+    def test_job_recorded_before_publishing(self):
+        jobs_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(jobs_dir.cleanup)
+        store = SqliteJobStore(os.path.join(jobs_dir.name, 'jobs.sqlite'))
+        req = DataArchiverRequest(str(uuid.uuid4()))
+        recorded = []
+
+        def publish(fanout, conn, req, job, batches, reply_to):
+            recorded.append(store.get_job(job))
+            raise SystemExit('restart')
+
+        with patch.object(FanOut, 'publish', publish), self.assertRaises(SystemExit):
+            FanOut(self.connection, self.work_queue_config, MagicMock(), MagicMock(), batch_bytes=10 * MB,
+                   jobs=store).run(req)
+
+        job, = recorded
+        self.assertEqual(len(job.batches), 3)
+        self.assertEqual(sorted(u for batch in job.batches for u in batch), [f.uuid for f in self.files])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import ftplib
+import unittest
+
+from data.archiver.ftp_index import RemoteIndex
+
+
+class FakeFtp:
+    """
+    records the listing commands sent, serving a fixed tree.
+    """
+
+    def __init__(self, tree, mlsd=True):
+        self.host = 'ftp.test'
+        self.port = 21
+        self.tree = tree
+        self.path = '/'
+        self.supports_mlsd = mlsd
+        self.commands = []
+
+    def pwd(self):
+        self.commands.append('PWD')
+        return self.path
+
+    def cwd(self, dir):
+        self.path = f'{self.path.rstrip("/")}/{dir}'
+
+    def mlsd(self, facts=None):
+        self.commands.append('MLSD')
+        if not self.supports_mlsd:
+            raise ftplib.error_perm('500 Unknown command.')
+        yield '.', {'type': 'cdir'}
+        for name, size in self.tree.get(self.path, {}).items():
+            yield name, {'type': 'dir'} if size is None else {'type': 'file', 'size': str(size)}
+
+    def retrlines(self, cmd, callback):
+        self.commands.append(cmd)
+        for name, size in self.tree.get(self.path, {}).items():
+            if size is None:
+                callback(f'drwxr-xr-x   2 owner    group        4096 Jan 01 00:00 {name}')
+            else:
+                callback(f'-rw-r--r--   1 owner    group    {size:>8} Jan 01 00:00 {name}')
+
+
+class TestRemoteIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = {'/': {'dev': None}, '/dev': {'a.fq.gz': 10, 'a.fq.gz.md5': 32, 'sub': None}}
+
+    def test_lists_each_directory_once(self):
+        index = RemoteIndex(ttl=60)
+        ftp = FakeFtp(self.tree)
+        index.chdir(ftp, 'dev')
+        self.assertEqual(index.lookup(ftp, 'a.fq.gz').size, 10)
+        self.assertTrue(index.lookup(ftp, 'sub').is_dir)
+        self.assertIsNone(index.lookup(ftp, 'b.fq.gz'))
+        self.assertEqual(ftp.commands, ['PWD', 'MLSD'])
+
+    def test_falls_back_to_list(self):
+        index = RemoteIndex(ttl=60)
+        ftp = FakeFtp(self.tree, mlsd=False)
+        index.chdir(ftp, 'dev')
+        self.assertEqual(index.lookup(ftp, 'a.fq.gz.md5').size, 32)
+        self.assertTrue(index.lookup(ftp, 'sub').is_dir)
+        index.invalidate(ftp)
+        index.lookup(ftp, 'sub')
+        self.assertEqual(ftp.commands, ['PWD', 'MLSD', 'LIST', 'LIST'])
+
+    def test_records_own_changes(self):
+        index = RemoteIndex(ttl=60)
+        ftp = FakeFtp(self.tree)
+        index.chdir(ftp, 'dev')
+        index.lookup(ftp, 'a.fq.gz')
+        index.add(ftp, 'b.fq.gz', size=20)
+        index.add(ftp, 'new', is_dir=True)
+        self.assertEqual(index.lookup(ftp, 'b.fq.gz').size, 20)
+        self.assertTrue(index.lookup(ftp, 'new').is_dir)
+        self.assertEqual(ftp.commands.count('MLSD'), 1)
+
+    def test_expires_listing(self):
+        index = RemoteIndex(ttl=0)
+        ftp = FakeFtp(self.tree)
+        index.lookup(ftp, 'dev')
+        index.lookup(ftp, 'dev')
+        self.assertEqual(ftp.commands.count('MLSD'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import logging
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+from data.archiver.ftp_pool import FtpConnectionPool
+
+
+@unittest.skipUnless(ThreadedFTPServer, 'pyftpdlib not installed')
+class TestFtpConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        self.ftp_root = tempfile.TemporaryDirectory()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'pwd', self.ftp_root.name, perm='elradfmwMT')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        # the exit event is shared by all servers unless set per instance
+        self.server._exit = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host, self.port = self.server.address
+
+    def tearDown(self):
+        self.server.close_all()
+        self.ftp_root.cleanup()
+
+    def connection(self, pool):
+        return pool.connection(self.host, self.port, 'user', 'pwd')
+
+    def test_reuses_connection_from_home_dir(self):
+        pool = FtpConnectionPool(max_per_host=2)
+        with self.connection(pool) as ftp:
+            first = ftp
+            ftp.mkd('sub')
+            ftp.cwd('sub')
+        with self.connection(pool) as ftp:
+            self.assertIs(ftp, first)
+            self.assertEqual(ftp.pwd(), '/')
+        pool.close()
+
+    def test_discards_connection_on_error(self):
+        pool = FtpConnectionPool()
+        with self.assertRaises(ValueError):
+            with self.connection(pool) as ftp:
+                first = ftp
+                raise ValueError()
+        with self.connection(pool) as ftp:
+            self.assertIsNot(ftp, first)
+        pool.close()
+
+    def test_replaces_dead_connection(self):
+        pool = FtpConnectionPool(check_after=0)
+        with self.connection(pool) as ftp:
+            first = ftp
+        first.sock.shutdown(socket.SHUT_RDWR)
+        with self.connection(pool) as ftp:
+            self.assertIsNot(ftp, first)
+            ftp.voidcmd('NOOP')
+        pool.close()
+
+    def test_recycles_old_connection(self):
+        pool = FtpConnectionPool(max_age=0)
+        with self.connection(pool) as ftp:
+            first = ftp
+        with self.connection(pool) as ftp:
+            self.assertIsNot(ftp, first)
+        pool.close()
+
+    def test_closes_connection_aged_while_idle(self):
+        pool = FtpConnectionPool(max_age=60)
+        with self.connection(pool) as ftp:
+            first = ftp
+        # returned while young, older than max_age by the next borrow
+        pool._hosts[next(iter(pool._hosts))].idle[0].created -= 61
+        with self.connection(pool) as ftp:
+            self.assertIsNot(ftp, first)
+        self.assertIsNone(first.sock)
+        pool.close()
+
+    def test_bounded_per_host(self):
+        pool = FtpConnectionPool(max_per_host=1)
+        borrowed = threading.Event()
+        order = []
+
+        def hold():
+            with self.connection(pool):
+                borrowed.set()
+                time.sleep(0.2)
+                order.append('first')
+
+        t = threading.Thread(target=hold)
+        t.start()
+        borrowed.wait()
+        with self.connection(pool):
+            order.append('second')
+        t.join()
+        self.assertEqual(order, ['first', 'second'])
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
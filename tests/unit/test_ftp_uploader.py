@@ -0,0 +1,76 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest.mock import patch
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+from data.archiver.ftp_index import remote_index
+from data.archiver.ftp_pool import ftp_pool
+from data.archiver.ftp_uploader import FtpUploader
+
+
+@unittest.skipUnless(ThreadedFTPServer, 'pyftpdlib not installed')
+class TestFtpUploader(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        # pyftpdlib changes the process working directory while serving CWD
+        self.cwd = os.getcwd()
+        self.ftp_root = tempfile.TemporaryDirectory()
+        self.local = tempfile.TemporaryDirectory()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'pwd', self.ftp_root.name, perm='elradfmwMT')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.server._exit = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.address
+        self.patches = [patch.multiple('data.archiver.ftp_pool', ENA_FTP_HOST=host, ENA_FTP_PORT=port,
+                                       ENA_WEBIN_USER='user', ENA_WEBIN_PWD='pwd')]
+        for p in self.patches:
+            p.start()
+        self.sub_uuid = str(uuid.uuid4())
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        ftp_pool.close()
+        remote_index.clear()
+        self.server.close_all()
+        os.chdir(self.cwd)
+        self.ftp_root.cleanup()
+        self.local.cleanup()
+
+    def file(self, name, data):
+        path = os.path.join(self.local.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def uploaded(self, name):
+        with open(os.path.join(self.ftp_root.name, 'dev', self.sub_uuid, name), 'rb') as f:
+            return f.read()
+
+    def test_stor(self):
+        for use_sendfile in (False, True):
+            name = f'reads_{use_sendfile}.fq.gz'
+            data = os.urandom(100000)
+            with ftp_pool.connection() as ftp:
+                FtpUploader.chdir(ftp, 'dev')
+                FtpUploader.chdir(ftp, self.sub_uuid)
+                FtpUploader.stor(ftp, self.file(name, data), blocksize=8192, use_sendfile=use_sendfile)
+                self.assertEqual(FtpUploader.indexed_file_size(ftp, name), len(data))
+            self.assertEqual(self.uploaded(name), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
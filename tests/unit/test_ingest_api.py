@@ -0,0 +1,191 @@
+import threading
+import unittest
+from http import HTTPStatus
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from data.archiver.dataclass import FileResult
+from data.archiver.ingest_api import Ingest, ResultReporter
+
+FILES_URL = 'http://ingest/submissionEnvelopes/1/files'
+
+
+def file_entity(n):
+    return {'uuid': {'uuid': f'uuid-{n}'},
+            'content': {'describedBy': 'https://schema/type/file/sequence_file',
+                        'file_core': {'file_name': f'reads_{n}.fastq.gz'}},
+            'cloudUrl': f's3://bucket/uuid/reads_{n}.fastq.gz'}
+
+
+class Response:
+
+    def __init__(self, body=None, status_code=HTTPStatus.OK):
+        self.body = body
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """
+    serves num_files files in pages, with or without the HAL page block.
+    """
+
+    def __init__(self, num_files, page_block=True):
+        self.num_files = num_files
+        self.page_block = page_block
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        query = {k: int(v[0]) for k, v in parse_qs(urlparse(url).query).items()}
+        page, size = query.get('page', 0), query.get('size', 20)
+        total_pages = (self.num_files + size - 1) // size
+        body = {'_embedded': {'files': [file_entity(n) for n in range(page * size,
+                                                                       min((page + 1) * size, self.num_files))]},
+                '_links': {}}
+        if page + 1 < total_pages:
+            body['_links']['next'] = {'href': f'{FILES_URL}?page={page + 1}&size={size}'}
+        if self.page_block:
+            body['page'] = {'size': size, 'totalElements': self.num_files, 'totalPages': total_pages, 'number': page}
+        return Response(body)
+
+    def close(self):
+        pass
+
+
+class TestIngestPaging(unittest.TestCase):
+
+    def ingest(self, session, page_size=10, concurrency=3):
+        ingest = Ingest(page_size=page_size, concurrency=concurrency)
+        ingest.session = session
+        ingest.submission = {'_links': {'files': {'href': FILES_URL}}}
+        return ingest
+
+    def test_concurrent_pages_in_order(self):
+        session = FakeSession(1005)
+        files = self.ingest(session).get_sequence_files('sub')
+        self.assertEqual([f['uuid'] for f in files], [f'uuid-{n}' for n in range(1005)])
+        self.assertEqual(len(session.urls), 101)
+        self.assertTrue(all('size=10' in url for url in session.urls))
+
+    def test_next_links_without_page_block(self):
+        session = FakeSession(25, page_block=False)
+        files = self.ingest(session).get_all(FILES_URL, 'files')
+        self.assertEqual(len(files), 25)
+        self.assertEqual(len(session.urls), 3)
+
+    def test_no_recursion_limit(self):
+        files = self.ingest(FakeSession(3000, page_block=False), page_size=1).get_all(FILES_URL, 'files')
+        self.assertEqual(len(files), 3000)
+
+    def test_results_not_shared_between_calls(self):
+        ingest = self.ingest(FakeSession(5))
+        self.assertEqual(len(ingest.get_all(FILES_URL, 'files')), 5)
+        self.assertEqual(len(ingest.get_all(FILES_URL, 'files')), 5)
+
+    def test_stops_when_requested_files_found(self):
+        session = FakeSession(1000)
+        files = self.ingest(session, concurrency=1).get_sequence_files('sub', ['uuid-3', 'uuid-15'])
+        self.assertEqual(files[-1]['uuid'], 'uuid-15')
+        self.assertLess(len(session.urls), 10)
+
+
+class PatchSession:
+    """
+    accepts patches after failing the first `failures` attempts of each url.
+    """
+
+    def __init__(self, failures=0, error=HTTPStatus.SERVICE_UNAVAILABLE):
+        self.failures = failures
+        self.error = error
+        self.gets = []
+        self.patches = {}
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None):
+        self.gets.append(params['uuid'])
+        return Response({'_links': {'self': {'href': f'http://ingest/files/{params["uuid"]}'}}})
+
+    def patch(self, url, data, headers=None):
+        with self.lock:
+            self.attempts[url] = self.attempts.get(url, 0) + 1
+            if self.attempts[url] <= self.failures:
+                if self.error == 'connection':
+                    raise requests.ConnectionError('connection reset')
+                return Response(status_code=self.error)
+            self.patches[url] = data
+        return Response(status_code=HTTPStatus.ACCEPTED)
+
+
+class TestResultReporter(unittest.TestCase):
+
+    def reporter(self, session, retries=2):
+        ingest = Ingest()
+        ingest.session = session
+        return ResultReporter(ingest, workers=4, retries=retries, backoff=0)
+
+    def files(self, n):
+        return [FileResult(f'uuid-{i}', f'reads_{i}.fq', f's3://bucket/uuid/reads_{i}.fq',
+                           ingest_url=f'http://ingest/files/uuid-{i}', md5='abc') for i in range(n)]
+
+    def test_self_links_reused(self):
+        session = PatchSession()
+        reporter = self.reporter(session)
+        files = self.files(20)
+        files[0].ingest_url = None
+        reporter.report_all(files)
+        reporter.close()
+
+        self.assertEqual(session.gets, ['uuid-0'])
+        self.assertEqual(len(session.patches), 20)
+        self.assertEqual(reporter.patched, 20)
+
+    def test_each_file_patched_once_and_only_if_successful(self):
+        session = PatchSession()
+        reporter = self.reporter(session)
+        files = self.files(3)
+        files[2].success = False
+        reporter.report(files[0])
+        reporter.report_all(files)
+        reporter.close()
+
+        self.assertEqual(sorted(session.patches), ['http://ingest/files/uuid-0', 'http://ingest/files/uuid-1'])
+        self.assertEqual(session.attempts['http://ingest/files/uuid-0'], 1)
+
+    def test_retry(self):
+        for error in (HTTPStatus.SERVICE_UNAVAILABLE, 'connection'):
+            session = PatchSession(failures=2, error=error)
+            reporter = self.reporter(session)
+            reporter.report_all(self.files(5))
+            reporter.close()
+            self.assertEqual(reporter.patched, 5, error)
+
+    def test_gives_up_after_retries(self):
+        session = PatchSession(failures=10)
+        reporter = self.reporter(session, retries=2)
+        reporter.report_all(self.files(2))
+        reporter.close()
+
+        self.assertEqual(reporter.failed, 2)
+        self.assertEqual(session.attempts['http://ingest/files/uuid-0'], 3)
+
+    def test_client_errors_not_retried(self):
+        session = PatchSession(failures=1, error=HTTPStatus.BAD_REQUEST)
+        reporter = self.reporter(session)
+        reporter.report_all(self.files(1))
+        reporter.close()
+
+        self.assertEqual(reporter.failed, 1)
+        self.assertEqual(session.attempts['http://ingest/files/uuid-0'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from data.archiver.archiver import Archiver
+from data.archiver.budget import ResourceBudget
+from data.archiver.dataclass import DataArchiverRequest, DataArchiverResult, FileResult
+from data.archiver.jobs import JobStore, SqliteJobStore, SCHEMA, DONE, FAILED, PENDING, RUNNING, TRANSFERRING, job_id, main, \
+    open_job_store
+from data.archiver.listener import _Listener
+
+SUB_UUID = 'sub-uuid'
+
+
+def sequence_file(n):
+    return {'uuid': f'uuid-{n}', 'file_name': f'reads_{n}.fq', 'cloud_url': f's3://bucket-dev/{SUB_UUID}/reads_{n}.fq',
+            'ingest_url': f'http://ingest/files/{n}'}
+
+
+class TestSqliteJobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'data', 'jobs.sqlite')
+        self.store = SqliteJobStore(self.path)
+        self.req = DataArchiverRequest(SUB_UUID)
+        self.res = DataArchiverResult(SUB_UUID, files=[FileResult.from_file(sequence_file(n)) for n in range(3)]
+                                      + [FileResult.not_found_error('missing')])
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def archived(self, file: FileResult):
+        file.file_name = f'{file.file_name}.gz'
+        file.size = 100
+        file.md5 = 'md5sum'
+        file.checksums = {'md5': 'md5sum', 'sha256': 'sha256sum'}
+        file.compressed = True
+        file.ena_upload_path = f'dev/{SUB_UUID}/{file.file_name}'
+        return file
+
+    def test_job_id(self):
+        self.assertEqual(job_id(self.req), SUB_UUID)
+        self.assertEqual(job_id(DataArchiverRequest(SUB_UUID, ['b', 'a'])),
+                         job_id(DataArchiverRequest(SUB_UUID, ['a', 'b'])))
+        self.assertNotEqual(job_id(DataArchiverRequest(SUB_UUID, ['a'])), SUB_UUID)
+
+    def test_resume_running_job(self):
+        self.assertIsNone(self.store.resume(self.req))
+        self.store.start(self.req, self.res)
+        self.store.update(self.req, self.res.files[0], TRANSFERRING)
+        self.store.update(self.req, self.archived(self.res.files[0]), DONE)
+        self.store.update(self.req, self.res.files[1], TRANSFERRING)
+        self.store.close()
+
+        files = SqliteJobStore(self.path).resume(self.req)
+        self.assertEqual([f.state for f in files], [DONE, TRANSFERRING, PENDING, FAILED])
+
+        done = files[0].result()
+        self.assertEqual(done, FileResult('uuid-0', 'reads_0.fq.gz', f's3://bucket-dev/{SUB_UUID}/reads_0.fq', 100,
+                                          True, 'md5sum', f'dev/{SUB_UUID}/reads_0.fq.gz',
+                                          ingest_url='http://ingest/files/0',
+                                          checksums={'md5': 'md5sum', 'sha256': 'sha256sum'}))
+        # archived again from the file listed in Ingest
+        self.assertEqual(files[1].result(), FileResult.from_file(sequence_file(1)))
+        self.assertEqual(files[3].result(), FileResult.not_found_error('missing'))
+
+    def test_finished_job_not_resumed(self):
+        self.store.start(self.req, self.res)
+        self.res.update_status()
+        self.store.finish(self.req, self.res)
+        self.assertEqual(self.store.get_job(SUB_UUID).state, FAILED)
+        self.assertIsNone(self.store.resume(self.req))
+
+        # started again with all files pending
+        self.store.update(self.req, self.archived(self.res.files[0]), DONE)
+        self.store.start(self.req, self.res)
+        self.assertEqual(self.store.get_job(SUB_UUID).state, RUNNING)
+        self.assertEqual([f.state for f in self.store.resume(self.req)], [PENDING, PENDING, PENDING, FAILED])
+
+    def test_progress(self):
+        self.store.start(self.req, self.res)
+        self.store.update(self.req, self.archived(self.res.files[0]), DONE)
+        progress = self.store.progress(SUB_UUID)
+        self.assertEqual(progress[DONE], [1, 100])
+        self.assertEqual(progress[PENDING], [2, 0])
+        self.assertEqual(progress[FAILED], [1, 0])
+
+    def test_cli(self):
+        self.store.start(self.req, self.res)
+        self.store.update(self.req, self.archived(self.res.files[0]), DONE)
+        self.store.close()
+
+        with patch('sys.stdout', io.StringIO()) as out:
+            self.assertEqual(main(['--path', self.path, 'list', '--state', RUNNING]), 0)
+        self.assertIn(SUB_UUID, out.getvalue())
+        self.assertIn('1/4', out.getvalue())
+
+        with patch('sys.stdout', io.StringIO()) as out:
+            self.assertEqual(main(['--path', self.path, 'show', SUB_UUID, '--state', DONE]), 0)
+        self.assertIn(f'dev/{SUB_UUID}/reads_0.fq.gz', out.getvalue())
+        self.assertNotIn('uuid-1', out.getvalue())
+
+        with patch('sys.stdout', io.StringIO()):
+            self.assertEqual(main(['--path', self.path, 'show', 'other']), 1)
+
+    def test_store_migrated(self):
+        self.store.close()
+        os.makedirs(os.path.dirname(self.path))
+        with sqlite3.connect(self.path) as conn:
+            # tables as created before checksums and batches were kept
+            conn.executescript(SCHEMA.replace('checksums TEXT,', '').replace(',\n    batches TEXT', ''))
+        self.store = SqliteJobStore(self.path)
+        self.store.start(self.req, self.res)
+        self.store.update(self.req, self.archived(self.res.files[0]), DONE)
+        files = self.store.resume(self.req)
+        self.assertEqual(files[0].checksums['sha256'], 'sha256sum')
+        self.assertEqual(files[1].checksums, {})
+
+    def test_cli_without_ingest_settings(self):
+        self.store.start(self.req, self.res)
+        self.store.close()
+        env = {name: value for name, value in os.environ.items() if name != 'INGEST_API'}
+        out = subprocess.run([sys.executable, '-m', 'data.archiver.jobs', '--path', self.path, 'list'], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        self.assertIn(SUB_UUID, out.stdout.decode())
+
+    def test_backend_implements_store(self):
+        with self.assertRaises(TypeError):
+            JobStore()
+
+    def test_open_job_store(self):
+        self.assertIsNone(open_job_store(''))
+        self.assertIsInstance(open_job_store('sqlite', self.path), SqliteJobStore)
+        with self.assertRaises(ValueError):
+            open_job_store('redis', self.path)
+
+
+class TestArchiverResume(unittest.TestCase):
+    """
+    a request redelivered after a restart only archives the files not done.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'jobs.sqlite')
+        self.ingest_cli = MagicMock()
+        self.ingest_cli.get_sequence_files.return_value = [sequence_file(n) for n in range(4)]
+        self.archived = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def archiver(self, crash_after=None, fail_after=None):
+        archiver = Archiver(self.ingest_cli, MagicMock(), jobs=SqliteJobStore(self.path))
+
+        def stream(res, engine):
+            for file in res.files:
+                if len(self.archived) == crash_after:
+                    raise SystemExit('restart')
+                if len(self.archived) == fail_after:
+                    raise IOError('FTP upload error')
+                archiver.on_start(file)
+                self.archived.append(file.uuid)
+                file.md5 = f'md5-{file.uuid}'
+                archiver.on_done(file)
+
+        archiver.archive_files_via_streaming = stream
+        return archiver
+
+    def test_resumed(self):
+        req = DataArchiverRequest(SUB_UUID)
+        with self.assertRaises(SystemExit):
+            self.archiver(crash_after=2).start(req)
+        self.assertEqual(self.ingest_cli.get_sequence_files.call_count, 1)
+
+        result = self.archiver().start(req)
+        self.assertEqual(self.archived, ['uuid-0', 'uuid-1', 'uuid-2', 'uuid-3'])
+        # not listed in Ingest again
+        self.assertEqual(self.ingest_cli.get_sequence_files.call_count, 1)
+        self.assertTrue(result.success)
+        self.assertEqual([f.md5 for f in result.files], [f'md5-uuid-{n}' for n in range(4)])
+        self.assertEqual(SqliteJobStore(self.path).get_job(SUB_UUID).state, DONE)
+
+        # a new request for the submission archives every file again
+        self.archiver().start(req)
+        self.assertEqual(len(self.archived), 8)
+        self.assertEqual(self.ingest_cli.get_sequence_files.call_count, 2)
+
+    def test_failed_job_not_resumed(self):
+        req = DataArchiverRequest(SUB_UUID)
+        result = self.archiver(fail_after=2).start(req)
+        self.assertFalse(result.success)
+        self.assertEqual(result.error, 'Archiving failed: FTP upload error')
+        # the files archived before the error are kept, the others failed
+        self.assertEqual([f.success for f in result.files], [True, True, False, False])
+        self.assertEqual(SqliteJobStore(self.path).get_job(SUB_UUID).state, FAILED)
+
+        # a redelivered request starts over
+        self.assertTrue(self.archiver().start(req).success)
+        self.assertEqual(self.archived, ['uuid-0', 'uuid-1', 'uuid-0', 'uuid-1', 'uuid-2', 'uuid-3'])
+        self.assertEqual(self.ingest_cli.get_sequence_files.call_count, 2)
+
+    def test_failed_request_reported(self):
+        reporter = MagicMock()
+        listener = MagicMock(budget=ResourceBudget(), jobs=None)
+        with patch('data.archiver.listener.Ingest', return_value=self.ingest_cli), \
+                patch('data.archiver.listener.ResultReporter', return_value=reporter), \
+                patch('data.archiver.listener.AwsS3'), \
+                patch('data.archiver.listener.RequestTrace'), \
+                patch.object(Archiver, 'archive_files_via_streaming', side_effect=IOError('FTP upload error')):
+            result = _Listener.archive(listener, DataArchiverRequest(SUB_UUID))
+
+        self.assertFalse(result.success)
+        reporter.report_all.assert_called_once_with(result.files)
+        self.assertEqual([f.uuid for f in result.files], [f'uuid-{n}' for n in range(4)])
+        self.assertFalse(any(f.success for f in result.files))
+        reporter.close.assert_called_once()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
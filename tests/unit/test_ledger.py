@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.ledger import ArchiveLedger, LedgerEntry
+from data.archiver.stream import S3FTPStreamer
+
+
+class TestArchiveLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'data', 'ledger.sqlite')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def entry(self, etag='abc'):
+        return LedgerEntry('user@host', 'bucket-dev', 'uuid/reads.fq', etag, 'reads.fq.gz', 123, 'md5sum',
+                           'dev/uuid/reads.fq.gz', True)
+
+    def test_persisted(self):
+        ledger = ArchiveLedger(self.path)
+        ledger.record(self.entry())
+        ledger.close()
+
+        entry = ArchiveLedger(self.path).lookup('user@host', 'bucket-dev', 'uuid/reads.fq', 'abc')
+        expected = self.entry()
+        expected.archived_at = entry.archived_at
+        self.assertEqual(entry, expected)
+        self.assertIs(entry.compressed, True)
+
+    def test_changed_etag_not_found(self):
+        ledger = ArchiveLedger(self.path)
+        ledger.record(self.entry())
+        self.assertIsNone(ledger.lookup('user@host', 'bucket-dev', 'uuid/reads.fq', 'def'))
+        self.assertIsNone(ledger.lookup('other@host', 'bucket-dev', 'uuid/reads.fq', 'abc'))
+
+    def test_remove(self):
+        ledger = ArchiveLedger(self.path)
+        ledger.record(self.entry())
+        ledger.remove(self.entry())
+        self.assertIsNone(ledger.lookup('user@host', 'bucket-dev', 'uuid/reads.fq', 'abc'))
+
+    def test_restore(self):
+        file = FileResult('1', 'reads.fq', 's3://bucket-dev/uuid/reads.fq')
+        self.entry().restore(file)
+        self.assertEqual(file.md5, 'md5sum')
+        self.assertTrue(file.compressed)
+        self.assertEqual(file.ena_upload_path, 'dev/uuid/reads.fq.gz')
+
+    def test_closed_when_streaming_fails_early(self):
+        streamer = S3FTPStreamer()
+        streamer.metadata = MagicMock(**{'resolve_files.return_value': {}})
+        streamer.ledger = ArchiveLedger(self.path)
+
+        def archived_before(file):
+            streamer.ledger.lookup('user@host', 'bucket-dev', 'uuid/reads.fq', 'abc')
+            raise IOError('S3 error')
+
+        res = DataArchiverResult('uuid', files=[FileResult('uuid-1', 'reads.fq', 's3://bucket-dev/uuid/reads.fq')])
+        with patch.object(streamer, 'archived_before', archived_before), self.assertRaises(IOError):
+            streamer.start(res)
+        self.assertIsNone(streamer.ledger._conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest.mock import patch
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+import boto3
+from moto import mock_aws
+
+from data.archiver import localcopy
+from data.archiver.aws_s3_client import S3MetadataResolver
+from data.archiver.budget import ByteBudget
+from data.archiver.dataclass import DataArchiverResult, FileResult
+from data.archiver.ftp_index import remote_index
+from data.archiver.ftp_pool import ftp_pool
+from data.archiver.localcopy import LocalCopyPipeline
+
+BUCKET = 'org-hca-data-archive-upload-dev'
+KB = 1024
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+@unittest.skipUnless(ThreadedFTPServer, 'pyftpdlib not installed')
+@mock_aws
+class TestLocalCopyPipeline(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        # pyftpdlib changes the process working directory while serving CWD, concurrent
+        # connections can leave it inside the ftp root
+        self.cwd = os.getcwd()
+        self.ftp_root = tempfile.TemporaryDirectory()
+        self.scratch = tempfile.TemporaryDirectory()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'pwd', self.ftp_root.name, perm='elradfmwMT')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.server._exit = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.address
+        self.patches = [patch.multiple('data.archiver.ftp_pool', ENA_FTP_HOST=host, ENA_FTP_PORT=port,
+                                       ENA_WEBIN_USER='user', ENA_WEBIN_PWD='pwd'),
+                        patch('data.archiver.localcopy.ENA_FTP_DIR', 'dev')]
+        for p in self.patches:
+            p.start()
+
+        self.s3_cli = boto3.client('s3', region_name='us-east-1')
+        self.s3_cli.create_bucket(Bucket=BUCKET)
+        self.aws_cli = SimpleNamespace(s3_cli=self.s3_cli, metadata=S3MetadataResolver(self.s3_cli))
+        self.sub_uuid = str(uuid.uuid4())
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        ftp_pool.close()
+        remote_index.clear()
+        self.server.close_all()
+        os.chdir(self.cwd)
+        self.ftp_root.cleanup()
+        self.scratch.cleanup()
+
+    def put(self, name, data):
+        self.s3_cli.put_object(Bucket=BUCKET, Key=f'{self.sub_uuid}/{name}', Body=data)
+        return FileResult(str(uuid.uuid4()), name, f's3://{BUCKET}/{self.sub_uuid}/{name}')
+
+    def uploaded(self, name):
+        with open(os.path.join(self.ftp_root.name, 'dev', self.sub_uuid, name), 'rb') as f:
+            return f.read()
+
+    def pipeline(self, **kwargs):
+        self.done = []
+        return LocalCopyPipeline(self.aws_cli, scratch_dir=self.scratch.name, on_done=self.done.append, **kwargs)
+
+    def test_archive(self):
+        data = b'@read\nACGT\n+\nFFFF\n' * 1000
+        compressed = gzip.compress(data)
+        res = DataArchiverResult(self.sub_uuid, files=[self.put('reads.fq', data),
+                                                       self.put('reads_2.fq.gz', compressed),
+                                                       FileResult('missing', 'none.fq', f's3://{BUCKET}/none')])
+        self.pipeline().start(res)
+
+        plain, gzipped, missing = res.files
+        self.assertEqual(gzip.decompress(self.uploaded('reads.fq.gz')), data)
+        self.assertEqual(plain.md5, hashlib.md5(self.uploaded('reads.fq.gz')).hexdigest())
+        self.assertEqual(self.uploaded('reads.fq.gz.md5').decode(), plain.md5)
+        self.assertTrue(plain.compressed)
+        self.assertEqual(plain.ena_upload_path, f'dev/{self.sub_uuid}/reads.fq.gz')
+
+        self.assertEqual(self.uploaded('reads_2.fq.gz'), compressed)
+        self.assertEqual(gzipped.md5, hashlib.md5(compressed).hexdigest())
+        self.assertFalse(gzipped.compressed)
+
+        self.assertFalse(missing.success)
+        self.assertEqual(sorted(f.file_name for f in self.done), ['reads.fq.gz', 'reads_2.fq.gz'])
+        self.assertEqual(os.listdir(self.scratch.name), [])
+
+    def test_disk_budget(self):
+        size = 100 * KB
+        res = DataArchiverResult(self.sub_uuid, files=[self.put(f'reads_{n}.fq', os.urandom(size))
+                                                       for n in range(6)])
+        budget = 2 * LocalCopyPipeline.disk_usage(FileResult('', 'reads.fq', '', size=size))
+        pipeline = self.pipeline(workers=4, disk_budget=budget)
+        usage = []
+
+        def compress_md5(fname, out, *args):
+            usage.append(dir_size(os.path.dirname(fname)))
+            return original(fname, out, *args)
+
+        original = localcopy.compress_md5
+        with patch('data.archiver.localcopy.compress_md5', compress_md5):
+            pipeline.start(res)
+
+        self.assertTrue(all(file.success for file in res.files))
+        self.assertEqual(len(usage), 6)
+        self.assertLessEqual(max(usage), budget)
+
+    def test_batches_share_scratch_space(self):
+        size = 100 * KB
+        batches = [DataArchiverResult(self.sub_uuid, files=[self.put(f'reads_{batch}_{n}.fq', os.urandom(size))
+                                                            for n in range(3)]) for batch in range(2)]
+        budget = 2 * LocalCopyPipeline.disk_usage(FileResult('', 'reads.fq', '', size=size))
+        scratch = ByteBudget(budget)
+        usage = []
+
+        def compress_md5(fname, out, *args):
+            usage.append(dir_size(self.scratch.name))
+            return original(fname, out, *args)
+
+        original = localcopy.compress_md5
+        with patch('data.archiver.localcopy.compress_md5', compress_md5):
+            # batches of the same submission at once, each with the whole budget of its own
+            threads = [threading.Thread(target=self.pipeline(workers=2, disk_budget=budget, scratch=scratch).start,
+                                        args=(res,)) for res in batches]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertTrue(all(file.success for res in batches for file in res.files))
+        self.assertEqual(len(usage), 6)
+        self.assertLessEqual(max(usage), budget)
+        self.assertEqual(os.listdir(self.scratch.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import hashlib
+import io
+import os
+import threading
+import unittest
+
+from data.archiver.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_stages_in_order(self):
+        data = os.urandom(1024 * 1024)
+        fp = io.BytesIO(data)
+        out = io.BytesIO()
+        hash_md5 = hashlib.md5()
+
+        def md5(buf):
+            hash_md5.update(buf)
+            return buf
+
+        stats = Pipeline(2).source('read', lambda: fp.read(4096)).stage('md5', md5).sink('write', out.write).run()
+
+        self.assertEqual(out.getvalue(), data)
+        self.assertEqual(hash_md5.hexdigest(), hashlib.md5(data).hexdigest())
+        self.assertEqual(stats['read'].bytes, len(data))
+        self.assertEqual(stats['write'].bytes, len(data))
+
+    def test_finish_output(self):
+        fp = io.BytesIO(b'abc' * 10)
+        out = io.BytesIO()
+        Pipeline().source('read', lambda: fp.read(7)).stage('upper', bytes.upper, lambda: b'END').sink('write', out.write).run()
+        self.assertEqual(out.getvalue(), b'ABC' * 10 + b'END')
+
+    def test_stage_error_stops_pipeline(self):
+        def fail(buf):
+            raise IOError('send failed')
+
+        with self.assertRaises(IOError):
+            Pipeline(1).source('read', lambda: b'x' * 10).sink('write', fail).run()
+
+    def test_stages_overlap(self):
+        blocks = iter([b'x'] * 10 + [b''])
+        writing, reading = threading.Event(), threading.Event()
+        overlapped = []
+
+        def read():
+            # the next block is read while the previous one is being written
+            if writing.is_set() and not reading.is_set():
+                reading.set()
+            return next(blocks)
+
+        def write(buf):
+            if not writing.is_set():
+                writing.set()
+                overlapped.append(reading.wait(5))
+
+        Pipeline(4).source('read', read).sink('write', write).run()
+        self.assertEqual(overlapped, [True])
+
+    def test_buffers_released(self):
+        blocks = [bytearray(b'abc'), bytearray(b'def')]
+        released = []
+        upper = Pipeline(1, release=released.append).source('read', lambda: blocks.pop(0) if blocks else b'') \
+            .stage('same', lambda buf: buf).stage('upper', lambda buf: bytes(buf).upper()).sink('write', lambda buf: None)
+        upper.run()
+        # each input once, when replaced by the upper stage, then each output after being sent
+        self.assertEqual(released, [b'abc', b'ABC', b'def', b'DEF'])
+
+
+if __name__ == '__main__':
+    unittest.main()
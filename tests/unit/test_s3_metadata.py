@@ -0,0 +1,82 @@
+import hashlib
+import unittest
+import uuid
+
+import boto3
+from moto import mock_aws
+
+from data.archiver.aws_s3_client import S3MetadataResolver
+from data.archiver.dataclass import FileResult
+
+BUCKET = 'org-hca-data-archive-upload-dev'
+
+
+@mock_aws
+class TestS3MetadataResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.s3_cli = boto3.client('s3', region_name='us-east-1')
+        self.s3_cli.create_bucket(Bucket=BUCKET)
+        self.sub_uuid = str(uuid.uuid4())
+        self.calls = []
+        self.s3_cli.meta.events.register('before-call.s3', lambda model, **kwargs: self.calls.append(model.name))
+
+    def put(self, key, body):
+        self.s3_cli.put_object(Bucket=BUCKET, Key=key, Body=body)
+        return f's3://{BUCKET}/{key}'
+
+    def test_prefix_listed_once(self):
+        urls = [self.put(f'{self.sub_uuid}/file_{n}.fastq', b'x' * n) for n in range(1, 6)]
+        self.calls.clear()
+        infos = S3MetadataResolver(self.s3_cli, list_min_keys=2).resolve(urls + [f's3://{BUCKET}/{self.sub_uuid}/none'])
+
+        self.assertEqual(self.calls, ['ListObjectsV2'])
+        self.assertEqual([infos[url].size for url in urls], [1, 2, 3, 4, 5])
+        self.assertIsNone(infos[f's3://{BUCKET}/{self.sub_uuid}/none'])
+        etag = self.s3_cli.head_object(Bucket=BUCKET, Key=f'{self.sub_uuid}/file_1.fastq')['ETag'].strip('"')
+        self.assertEqual(infos[urls[0]].etag, etag)
+        self.assertIsNotNone(infos[urls[0]].last_modified)
+
+    def test_listed_etag_not_taken_as_md5(self):
+        body = b'ACGT' * 100
+        kms = f'{self.sub_uuid}/kms.fastq'
+        self.s3_cli.put_object(Bucket=BUCKET, Key=kms, Body=body, ServerSideEncryption='aws:kms')
+        urls = [f's3://{BUCKET}/{kms}', self.put(f'{self.sub_uuid}/plain.fastq', body)]
+        resolver = S3MetadataResolver(self.s3_cli, list_min_keys=2)
+        infos = resolver.resolve(urls)
+        self.assertEqual(self.calls[-1], 'ListObjectsV2')
+        self.assertIsNone(infos[urls[0]].checksums)
+
+        # HEADed before the ETag is used
+        self.assertNotIn('md5', resolver.checksums(urls[0], infos[urls[0]]))
+        self.assertEqual(resolver.checksums(urls[1], infos[urls[1]])['md5'], hashlib.md5(body).hexdigest())
+        self.assertEqual(self.calls[-2:], ['HeadObject', 'HeadObject'])
+
+    def test_pagination(self):
+        urls = [self.put(f'{self.sub_uuid}/file_{n}.fastq', b'x') for n in range(1005)]
+        infos = S3MetadataResolver(self.s3_cli, list_min_keys=2).resolve(urls)
+        self.assertTrue(all(infos[url] for url in urls))
+
+    def test_scattered_keys_use_head(self):
+        urls = [self.put('loose/file.fastq', b'abc'), self.put(f'{self.sub_uuid}/file.fastq', b'abcd')]
+        self.calls.clear()
+        infos = S3MetadataResolver(self.s3_cli, list_min_keys=2).resolve(urls + [f's3://{BUCKET}/loose/none'])
+
+        self.assertEqual(self.calls, ['HeadObject'] * 3)
+        self.assertEqual(infos[urls[0]].size, 3)
+        self.assertEqual(infos[urls[1]].size, 4)
+        self.assertIsNone(infos[f's3://{BUCKET}/loose/none'])
+
+    def test_resolve_files(self):
+        files = [FileResult('1', 'a.fastq', self.put(f'{self.sub_uuid}/a.fastq', b'abc')),
+                 FileResult('2', 'b.fastq', f's3://{BUCKET}/{self.sub_uuid}/b.fastq')]
+        S3MetadataResolver(self.s3_cli).resolve_files(files)
+
+        self.assertEqual(files[0].size, 3)
+        self.assertTrue(files[0].success)
+        self.assertFalse(files[1].success)
+        self.assertEqual(files[1].error, 'File not found in S3.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import threading
+import unittest
+
+from data.archiver.s3_reader import RangedS3Reader
+
+
+class InMemoryS3:
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def cat_file(self, url, start=None, end=None):
+        with self.lock:
+            self.ranges.append((start, end))
+        return self.objects[url][start:end]
+
+
+class TestRangedS3Reader(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(1000 * 1000 + 17)
+        self.s3 = InMemoryS3({'s3://bucket/key': self.data})
+
+    def test_read_in_order(self):
+        with RangedS3Reader(self.s3, 's3://bucket/key', len(self.data), part_size=65536, concurrency=3) as fp:
+            out = b''.join(iter(lambda: fp.read(10000), b''))
+        self.assertEqual(out, self.data)
+        self.assertEqual(sorted(self.s3.ranges)[0], (0, 65536))
+        self.assertEqual(len(self.s3.ranges), len(self.data) // 65536 + 1)
+
+    def test_read_from_offset(self):
+        fp = RangedS3Reader(self.s3, 's3://bucket/key', len(self.data), part_size=4096, offset=5000)
+        self.assertEqual(fp.tell(), 5000)
+        self.assertEqual(fp.read(), self.data[5000:])
+        fp.close()
+
+    def test_readinto_across_parts(self):
+        buf = bytearray(100000)
+        with RangedS3Reader(self.s3, 's3://bucket/key', len(self.data), part_size=4096, concurrency=2) as fp:
+            out = bytearray()
+            while 1:
+                n = fp.readinto(buf)
+                if not n:
+                    break
+                self.assertEqual(n, min(len(buf), len(self.data) - len(out)))
+                out += buf[:n]
+            self.assertEqual(fp.tell(), len(self.data))
+        self.assertEqual(out, self.data)
+
+    def test_parts_in_flight_bounded(self):
+        fp = RangedS3Reader(self.s3, 's3://bucket/key', len(self.data), part_size=4096, concurrency=2)
+        fp.read(1)
+        self.assertLessEqual(len(self.s3.ranges), 3)
+        fp.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+
+from data.archiver.budget import ResourceBudget
+from data.archiver.concurrency import AdaptiveConcurrency
+from data.archiver.scheduler import TransferScheduler, lpt_makespan
+
+
+class TestTransferScheduler(unittest.TestCase):
+
+    def run_recorded(self, scheduler, sizes, duration=0.0):
+        started = []
+        lock = threading.Lock()
+
+        def fn(size):
+            with lock:
+                started.append((size, scheduler.in_flight))
+            time.sleep(duration)
+
+        scheduler.run(sizes, fn, size=lambda size: size)
+        return started
+
+    def test_largest_first(self):
+        scheduler = TransferScheduler(workers=1, small_workers=0, small_size=0, max_bytes=10 ** 9)
+        started = self.run_recorded(scheduler, [3, 10, 1, 7])
+        self.assertEqual([size for size, _ in started], [10, 7, 3, 1])
+
+    def test_bytes_in_flight_capped(self):
+        scheduler = TransferScheduler(workers=4, small_workers=0, small_size=0, max_bytes=100)
+        started = self.run_recorded(scheduler, [60, 50, 40, 30, 20, 150], duration=0.05)
+        self.assertEqual(started[0][0], 150)
+        for size, in_flight in started:
+            self.assertTrue(in_flight == size or in_flight <= 100, (size, in_flight))
+        self.assertEqual(sorted(size for size, _ in started), [20, 30, 40, 50, 60, 150])
+        self.assertEqual(scheduler.in_flight, 0)
+
+    def test_small_files_not_starved(self):
+        scheduler = TransferScheduler(workers=1, small_workers=1, small_size=10, max_bytes=10 ** 9)
+        done = []
+        lock = threading.Lock()
+
+        def fn(size):
+            if size >= 10:
+                time.sleep(0.2)
+            with lock:
+                done.append(size)
+
+        scheduler.run([100, 90, 1, 2], fn, size=lambda size: size)
+        # both small files finish while the first large file is still running
+        self.assertEqual(sorted(done[:2]), [1, 2])
+
+    def test_only_large_files_charged_to_share(self):
+        budget = ResourceBudget(slots=4, max_bytes=100)
+        charged = []
+        with budget.share('a') as share:
+            scheduler = TransferScheduler(workers=1, small_workers=0, small_size=10, max_bytes=100, share=share)
+            scheduler.run([50, 1, 2], lambda size: charged.append((size, share.bytes)), size=lambda size: size)
+        self.assertEqual(sorted(charged), [(1, 0), (2, 0), (50, 50)])
+
+    def test_large_items_on_small_lane_take_controller_slot(self):
+        controller = AdaptiveConcurrency(initial=1, floor=1, ceiling=1)
+        scheduler = TransferScheduler(small_workers=2, small_size=10, max_bytes=10 ** 9, controller=controller)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def fn(size):
+            if size < 10:
+                return
+            with lock:
+                running.append(size)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(size)
+
+        # the small workers are done with the small files first and help with the large ones
+        scheduler.run([100, 90, 80, 70, 1, 2], fn, size=lambda size: size)
+        self.assertEqual(len(peak), 4)
+        self.assertEqual(max(peak), 1)
+
+    def test_error_raised_after_all_items(self):
+        done = []
+
+        def fn(size):
+            if size == 2:
+                raise IOError('transfer failed')
+            done.append(size)
+
+        with self.assertRaises(IOError):
+            TransferScheduler(workers=2, small_workers=0, small_size=0).run([1, 2, 3], fn, size=lambda size: size)
+        self.assertEqual(sorted(done), [1, 3])
+
+    def test_lpt_makespan(self):
+        self.assertEqual(lpt_makespan([7, 5, 4, 3, 1], 2), 10)
+        self.assertEqual(lpt_makespan([200, 1, 1, 1], 4), 200)
+        self.assertEqual(lpt_makespan([], 3), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest.mock import patch
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+from fsspec.implementations.memory import MemoryFileSystem
+from prometheus_client import REGISTRY
+
+from data.archiver.aws_s3_client import S3ObjectInfo
+from data.archiver.buffers import BufferPool
+from data.archiver.checkpoint import CheckpointStore
+from data.archiver.dataclass import FileResult
+from data.archiver.ftp_index import remote_index
+from data.archiver.ftp_pool import ftp_pool
+from data.archiver.ledger import ArchiveLedger
+from data.archiver.stream import S3FTPStreamer
+
+DROP_AFTER = 256 * 1024
+
+if ThreadedFTPServer:
+    class DroppingDTPHandler(DTPHandler):
+        """
+        closes the data connection once, mid transfer, after DROP_AFTER bytes.
+        """
+        drops = 0
+
+        def handle_read(self):
+            super().handle_read()
+            if DroppingDTPHandler.drops and self.tot_bytes_received > DROP_AFTER:
+                DroppingDTPHandler.drops -= 1
+                self._resp = ('426 Connection closed; transfer aborted.', logging.debug)
+                self.close()
+
+        handle_read_event = handle_read
+
+
+@unittest.skipUnless(ThreadedFTPServer, 'pyftpdlib not installed')
+class TestStreamResume(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        self.ftp_root = tempfile.TemporaryDirectory()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'pwd', self.ftp_root.name, perm='elradfmwMT')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer, 'dtp_handler': DroppingDTPHandler})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        # the exit event is shared by all servers unless set per instance
+        self.server._exit = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.address
+        self.patches = [patch.multiple('data.archiver.ftp_pool', ENA_FTP_HOST=host, ENA_FTP_PORT=port,
+                                       ENA_WEBIN_USER='user', ENA_WEBIN_PWD='pwd')]
+        for p in self.patches:
+            p.start()
+
+        self.checkpoints = tempfile.TemporaryDirectory()
+        self.streamer = S3FTPStreamer(buffers=BufferPool(64 * 1024, 8))
+        self.streamer.s3 = MemoryFileSystem()
+        self.streamer.checkpoints = CheckpointStore(self.checkpoints.name)
+        self.streamer.ledger = ArchiveLedger(':memory:')
+        self.sub_uuid = str(uuid.uuid4())
+        self.data = b''.join(b'@read%d\nACGTNACGT%d\n+\nFFFFFFFFF\n' % (i, i % 97) for i in range(60000))
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        ftp_pool.close()
+        remote_index.clear()
+        self.server.close_all()
+        self.ftp_root.cleanup()
+        self.checkpoints.cleanup()
+
+    def put(self, name, data):
+        url = f'memory://bucket-dev/{self.sub_uuid}/{name}'
+        self.streamer.s3.pipe(url, data)
+        return FileResult(str(uuid.uuid4()), name, url, size=len(data))
+
+    def uploaded(self, name):
+        with open(os.path.join(self.ftp_root.name, 'dev', self.sub_uuid, name), 'rb') as f:
+            return f.read()
+
+    def test_resume_uncompressed_upload(self):
+        DroppingDTPHandler.drops = 1
+        source = gzip.compress(self.data + os.urandom(DROP_AFTER))
+        file = self.put('reads.fq.gz', source)
+        retries = REGISTRY.get_sample_value('archiver_stream_retries_total') or 0
+
+        self.streamer.s3_ftp_stream(file, lambda n: None)
+
+        self.assertEqual(DroppingDTPHandler.drops, 0)
+        self.assertEqual(REGISTRY.get_sample_value('archiver_stream_retries_total'), retries + 1)
+        self.assertEqual(self.uploaded('reads.fq.gz'), source)
+        self.assertEqual(file.md5, hashlib.md5(source).hexdigest())
+        self.assertEqual(self.uploaded('reads.fq.gz.md5').decode(), file.md5)
+
+    def resume(self, file, known):
+        """
+        streams file with the connection dropped once, returning the offset the upload was
+        resumed from, the offset S3 was read from then and the progress reported by then.
+        """
+        DroppingDTPHandler.drops = 1
+        offsets, progress = [], []
+        resume_offset = self.streamer.resume_offset
+
+        def resumed(*args):
+            offsets.append(resume_offset(*args))
+            return offsets[-1]
+
+        with patch('data.archiver.stream.CHECKSUMS', ('md5',)), \
+                patch.object(self.streamer.metadata, 'checksums', return_value=known), \
+                patch.object(self.streamer, 'resume_offset', resumed), \
+                patch.object(self.streamer, 'open_s3', wraps=self.streamer.open_s3) as open_s3:
+            self.streamer.s3_ftp_stream(file, lambda n: progress.append((len(offsets), n)))
+        self.assertEqual(DroppingDTPHandler.drops, 0)
+        self.assertEqual(len(offsets), 2)
+        self.assertGreater(offsets[1], 0)
+        return offsets[1], open_s3.call_args[0][1], sum(n for attempt, n in progress if attempt == 2)
+
+    def test_resume_from_offset_when_md5_known(self):
+        source = gzip.compress(self.data + os.urandom(DROP_AFTER))
+        file = self.put('reads.fq.gz', source)
+        md5 = hashlib.md5(source).hexdigest()
+
+        offset, read_from, progress = self.resume(file, {'md5': md5})
+
+        self.assertEqual(read_from, offset)
+        self.assertEqual(progress, len(source) - offset)
+        self.assertEqual(self.uploaded('reads.fq.gz'), source)
+        self.assertEqual(self.uploaded('reads.fq.gz.md5').decode(), md5)
+
+    def test_reread_prefix_not_reported(self):
+        source = gzip.compress(self.data + os.urandom(DROP_AFTER))
+        file = self.put('reads.fq.gz', source)
+
+        offset, read_from, progress = self.resume(file, {})
+
+        self.assertEqual(read_from, 0)
+        self.assertLessEqual(progress, len(source) - offset)
+        self.assertEqual(self.uploaded('reads.fq.gz'), source)
+        self.assertEqual(file.md5, hashlib.md5(source).hexdigest())
+
+    def test_resume_compressed_upload(self):
+        DroppingDTPHandler.drops = 1
+        source = self.data + os.urandom(DROP_AFTER)
+        file = self.put('reads.fq', source)
+
+        self.streamer.s3_ftp_stream(file, lambda n: None)
+
+        self.assertEqual(DroppingDTPHandler.drops, 0)
+        uploaded = self.uploaded('reads.fq.gz')
+        self.assertEqual(gzip.decompress(uploaded), source)
+        self.assertEqual(file.md5, hashlib.md5(uploaded).hexdigest())
+        self.assertEqual(self.uploaded('reads.fq.gz.md5').decode(), file.md5)
+        self.assertTrue(file.compressed)
+
+
+if __name__ == '__main__':
+    unittest.main()
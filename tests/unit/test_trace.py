@@ -0,0 +1,100 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+from data.archiver.trace import RequestTrace, profiled
+
+
+def work():
+    return sum(i * i for i in range(10000))
+
+
+def other_work():
+    return sum(i * i for i in range(10000))
+
+
+class TestRequestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_spans_written(self):
+        trace = RequestTrace('sub-uuid', path=self.dir.name)
+        with trace.span('transfer', files=2) as span:
+            span.bytes = 1000
+            with trace.span('file', file='a.fq'):
+                pass
+        path = trace.write()
+
+        self.assertTrue(os.path.basename(path).startswith('sub-uuid-'))
+        with open(path) as f:
+            written = json.load(f)
+        self.assertEqual(written['sub_uuid'], 'sub-uuid')
+        self.assertIsNone(written['profile'])
+        self.assertEqual([span['name'] for span in written['spans']], ['transfer', 'file'])
+        transfer = written['spans'][0]
+        self.assertEqual(transfer['attrs'], {'files': 2})
+        self.assertAlmostEqual(transfer['throughput'], 1000 / transfer['duration'])
+        self.assertIsNone(written['spans'][1]['throughput'])
+
+    def test_span_recorded_on_error(self):
+        trace = RequestTrace(path=self.dir.name)
+        with self.assertRaises(ValueError):
+            with trace.span('ftp_dirs'):
+                raise ValueError()
+        self.assertIsNotNone(trace.spans[0].end)
+
+    def profiled_functions(self, path):
+        with open(path) as f:
+            profile = json.load(f)['profile']
+        self.assertTrue(os.path.exists(profile))
+        return [name for _, _, name in pstats.Stats(profile).stats]
+
+    def test_profile_includes_request_threads(self):
+        trace = RequestTrace('sub-uuid', path=self.dir.name)
+        trace.start_profile()
+        thread = threading.Thread(target=profiled(work))
+        thread.start()
+        thread.join()
+        # not started by the request
+        other = threading.Thread(target=other_work)
+        other.start()
+        other.join()
+        path = trace.write()
+
+        functions = self.profiled_functions(path)
+        self.assertIn('work', functions)
+        self.assertNotIn('other_work', functions)
+        self.assertIs(profiled(work), work)
+
+    def test_requests_profiled_at_once(self):
+        paths = {}
+
+        def request(name, fn):
+            trace = RequestTrace('sub-uuid', path=self.dir.name)
+            trace.start_profile()
+            thread = threading.Thread(target=profiled(fn))
+            thread.start()
+            thread.join()
+            paths[name] = trace.write()
+
+        requests = [threading.Thread(target=request, args=('a', work)),
+                    threading.Thread(target=request, args=('b', other_work))]
+        for thread in requests:
+            thread.start()
+        for thread in requests:
+            thread.join()
+
+        self.assertNotEqual(paths['a'], paths['b'])
+        self.assertIn('work', self.profiled_functions(paths['a']))
+        self.assertNotIn('other_work', self.profiled_functions(paths['a']))
+        self.assertIn('other_work', self.profiled_functions(paths['b']))
+
+if __name__ == '__main__':
+    unittest.main()
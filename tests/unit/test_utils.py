@@ -0,0 +1,49 @@
+import gzip
+import hashlib
+import os
+import tempfile
+import unittest
+import zlib
+
+from data.archiver.utils import checksum, compress_md5, md5
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.data = b''.join(b'@read%d\nACGTNACGT%d\n+\nFFFFFFFFF\n' % (i, i % 97) for i in range(50000))
+        self.path = os.path.join(self.dir.name, 'reads.fq')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_compress_md5(self):
+        out = f'{self.path}.gz'
+        checksums = compress_md5(self.path, out, read_size=64 * 1024, crc=True)
+
+        compressed = self.read(out)
+        self.assertEqual(gzip.decompress(compressed), self.data)
+        self.assertEqual(checksums.md5, hashlib.md5(compressed).hexdigest())
+        self.assertEqual(checksums.size, len(compressed))
+        self.assertEqual(checksums.crc32, zlib.crc32(compressed))
+        self.assertEqual(self.read(f'{out}.md5').decode(), checksums.md5)
+
+    def test_checksum(self):
+        checksums = checksum(self.path, read_size=1000)
+
+        self.assertEqual(checksums.md5, hashlib.md5(self.data).hexdigest())
+        self.assertEqual(checksums.md5, md5(self.path))
+        self.assertEqual(checksums.size, len(self.data))
+        self.assertIsNone(checksums.crc32)
+        self.assertEqual(self.read(f'{self.path}.md5').decode(), checksums.md5)
+
+
+if __name__ == '__main__':
+    unittest.main()